@@ -0,0 +1,546 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+from chat_core import WELCOME_MSG, ChatCore, pack_message, raise_fd_limit
+from chat_protocol import (HELLO, HEADER, FRAME_TEXT, FRAME_CONTROL, CTRL_WELCOME, CTRL_QUEUE, CTRL_READY, FrameHeader,
+                           encode_control, encode_text)
+from chat_workers import run_workers
+
+
+# 壓測client用asyncio StreamReader讀取「4 byte長度 + 內容」的訊息
+async def read_message(reader):
+    length = int.from_bytes(await reader.readexactly(4), 'big')
+    return await reader.readexactly(length)
+
+
+# 向系統要一個目前沒被使用的port
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _serve(port, image_port, kwargs):
+    raise_fd_limit()
+    core = ChatCore('127.0.0.1', port, image_port, log_dir=None, cache_dir=None, **kwargs)
+    core.serve_forever()
+
+
+def _serve_workers(port, workers, kwargs):
+    run_workers(workers, '127.0.0.1', port, log_dir=None, cache_dir=None, quiet=True, **kwargs)
+
+
+# 在子行程啟動headless server，避免和壓測client搶同一個GIL
+# images=True時另外開啟舊版協定的圖片port，回傳(process, 文字port, 圖片port或None)
+# workers大於1時以多行程模式啟動(會再產生worker子行程，所以這個行程不能是daemon)
+def start_server(images=False, workers=1, **kwargs):
+    port = free_port()
+    image_port = free_port() if images else None
+    if workers > 1:
+        proc = multiprocessing.Process(target=_serve_workers, args=(port, workers, kwargs))
+    else:
+        proc = multiprocessing.Process(target=_serve, args=(port, image_port, kwargs), daemon=True)
+    proc.start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return proc, port, image_port
+
+
+def stop_server(proc):
+    proc.terminate()
+    proc.join()
+
+
+# 子行程目前使用的記憶體(KB)，無法取得時(非Linux)回傳None
+def rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+# 子行程到目前為止使用的CPU秒數(user + system)，無法取得時(非Linux)回傳None
+def cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+# 排序後取第p百分位(p為0~100)
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# 模擬client連線並讀掉歡迎/排隊訊息
+# 先送出一則空的訊息表示使用舊版協定，server不必等待HELLO(見chat_core.LEGACY_WAIT)
+async def open_client(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(pack_message(b""))
+    await read_message(reader)
+    return reader, writer
+
+
+# 多房間吞吐量: 每間房room_size人，每人送出messages則訊息，統計server轉送到其他成員的總訊息數/秒
+async def bench_rooms(rooms, room_size, messages):
+    proc, port, _ = start_server(max_rooms=rooms, room_size=room_size)
+    try:
+        # 依序連線，前room_size人會在同一間房，以此類推
+        clients = [await open_client(port) for _ in range(rooms * room_size)]
+        expected = messages * (room_size - 1)
+        payload = pack_message(b"Client(127.0.0.1):" + b"x" * 32 + b"\n")
+
+        async def sender(writer):
+            for i in range(messages):
+                writer.write(payload)
+                if i % 64 == 63:
+                    await writer.drain()
+            await writer.drain()
+
+        async def receiver(reader):
+            for _ in range(expected):
+                await read_message(reader)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender(w) for _, w in clients), *(receiver(r) for r, _ in clients))
+        elapsed = time.perf_counter() - start
+        for _, writer in clients:
+            writer.close()
+        return rooms * room_size * expected / elapsed
+    finally:
+        stop_server(proc)
+
+
+# 一個壓測client行程: clients個client連線並進入聊天室後等其他行程就緒，
+# 接著每人送出messages則訊息並收完同房間其他人的訊息，把收到的總訊息數放進results
+def _load(port, clients, room_size, messages, barrier, results):
+    async def run():
+        conns = [await open_client(port) for _ in range(clients)]
+        barrier.wait() # 所有房間都坐滿後才開始送，訊息不會送進還沒有人的房間
+        payload = pack_message(b"Client(127.0.0.1):" + b"x" * 32 + b"\n")
+        expected = messages * (room_size - 1)
+
+        async def sender(writer):
+            for i in range(messages):
+                writer.write(payload)
+                if i % 64 == 63:
+                    await writer.drain()
+            await writer.drain()
+
+        async def receiver(reader):
+            for _ in range(expected):
+                await read_message(reader)
+
+        await asyncio.gather(*(sender(w) for _, w in conns), *(receiver(r) for r, _ in conns))
+        for _, writer in conns:
+            writer.close()
+        return clients * expected
+    results.put(asyncio.run(run()))
+
+
+# 單一連線模式(frame協定)的壓測client: 送出HELLO與CTRL_READY，讀掉HELLO回覆，直到收到歡迎/排隊訊息
+async def open_framed_client(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(HELLO + encode_control(CTRL_READY))
+    await reader.readexactly(len(HELLO))
+    while True:
+        header = FrameHeader._make(HEADER.unpack(await reader.readexactly(HEADER.size)))
+        payload = await reader.readexactly(header.length)
+        if header.frame_type == FRAME_CONTROL and payload[:1] in (bytes([CTRL_WELCOME]), bytes([CTRL_QUEUE])):
+            return reader, writer
+
+
+# 讀到count則文字frame為止，其他frame(傳送者名稱、控制訊息)略過
+async def read_text_frames(reader, count):
+    while count:
+        header = FrameHeader._make(HEADER.unpack(await reader.readexactly(HEADER.size)))
+        await reader.readexactly(header.length)
+        if header.frame_type == FRAME_TEXT:
+            count -= 1
+
+
+# 廣播成本: 一間room_size人的房間，一人送出messages則訊息，server轉送給其他所有人
+# 回傳(送達的總訊息數/秒, server每送達一則訊息花費的CPU微秒數，無法取得時為None)
+async def bench_fanout(room_size, messages, size):
+    proc, port, _ = start_server(room_size=room_size)
+    try:
+        clients = [await open_framed_client(port) for _ in range(room_size)]
+        (_, sender), receivers = clients[0], [r for r, _ in clients[1:]]
+        frame = encode_text("x" * size)
+        cpu_start = cpu_seconds(proc.pid)
+        start = time.perf_counter()
+
+        async def send():
+            for i in range(messages):
+                sender.write(frame)
+                if i % 64 == 63:
+                    await sender.drain()
+            await sender.drain()
+
+        await asyncio.gather(send(), *(read_text_frames(r, messages) for r in receivers))
+        elapsed = time.perf_counter() - start
+        cpu_end = cpu_seconds(proc.pid)
+        for _, writer in clients:
+            writer.close()
+        delivered = messages * len(receivers)
+        cpu = (cpu_end - cpu_start) / delivered * 1e6 if cpu_start is not None else None
+        return delivered / elapsed, cpu
+    finally:
+        stop_server(proc)
+
+
+# 多行程擴展性: 以workers個worker啟動server，procs個壓測行程共clients個client、每間房room_size人
+# 同一間房的成員可能被分到不同worker，訊息會經過主行程轉送；回傳server轉送的總訊息數/秒
+def bench_workers(workers, clients, room_size, messages, procs):
+    proc, port, _ = start_server(workers=workers, max_rooms=clients // room_size, room_size=room_size)
+    try:
+        barrier = multiprocessing.Barrier(procs + 1)
+        results = multiprocessing.Queue()
+        loads = [multiprocessing.Process(target=_load, args=(port, clients // procs, room_size, messages,
+                                                            barrier, results), daemon=True)
+                 for _ in range(procs)]
+        for load in loads:
+            load.start()
+        barrier.wait()
+        start = time.perf_counter()
+        delivered = sum(results.get() for _ in loads)
+        elapsed = time.perf_counter() - start
+        for load in loads:
+            load.join()
+        return delivered / elapsed
+    finally:
+        stop_server(proc)
+
+
+# 連線速度與每條連線的記憶體: clients個client以最多concurrency個同時連線，
+# 每個都等到收到第一則訊息(歡迎或排隊位置)才算連上；除了第一位以外都會進入排隊
+# 回傳(每秒連線數, 每個連線花費的秒數, server每條連線增加的bytes)
+async def bench_connect(clients, concurrency):
+    proc, port, _ = start_server()
+    try:
+        base = rss_kb(proc.pid)
+        limit = asyncio.Semaphore(concurrency)
+        times = []
+
+        async def connect():
+            async with limit:
+                start = time.perf_counter()
+                client = await open_client(port)
+                times.append(time.perf_counter() - start)
+                return client
+
+        start = time.perf_counter()
+        connected = await asyncio.gather(*(connect() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.5) # 等server處理完排隊名單的批次更新
+        used = rss_kb(proc.pid)
+        per_conn = (used - base) * 1024 / clients if base is not None and used is not None else None
+        for _, writer in connected:
+            writer.close()
+        return clients / elapsed, times, per_conn
+    finally:
+        stop_server(proc)
+
+
+# 端對端延遲: 同一房間的兩個client，一個以rate則/秒(0為不限速)送出帶有送出時間的訊息，另一個收到時計算延遲
+# 壓測client都在同一個行程，perf_counter可以直接相減
+# 回傳(每秒訊息數, 每則訊息的延遲秒數)
+async def bench_latency(messages, rate):
+    proc, port, _ = start_server(room_size=2)
+    try:
+        (_, sender_writer), (receiver_reader, receiver_writer) = [await open_client(port) for _ in range(2)]
+        latencies = []
+
+        async def sender():
+            start = time.perf_counter()
+            for i in range(messages):
+                if rate:
+                    delay = start + i / rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                sender_writer.write(pack_message(b"Client(127.0.0.1):%.9f\n" % time.perf_counter()))
+                if rate or i % 64 == 63:
+                    await sender_writer.drain()
+            await sender_writer.drain()
+
+        async def receiver():
+            for _ in range(messages):
+                data = await read_message(receiver_reader)
+                latencies.append(time.perf_counter() - float(data.rsplit(b":", 1)[1]))
+
+        start = time.perf_counter()
+        await asyncio.gather(sender(), receiver())
+        elapsed = time.perf_counter() - start
+        sender_writer.close()
+        receiver_writer.close()
+        return messages / elapsed, latencies
+    finally:
+        stop_server(proc)
+
+
+# 排隊遞補延遲: 聊天室1人，waiters人排隊；每次中斷目前聊天室內的client，
+# 量測排第一位的client收到歡迎訊息所需的時間
+async def bench_queue(waiters):
+    proc, port, _ = start_server()
+    try:
+        active = await open_client(port)
+        queued = [await open_client(port) for _ in range(waiters)]
+        welcome = WELCOME_MSG.encode()
+        delays = []
+        for reader, writer in queued:
+            start = time.perf_counter()
+            active[1].close()
+            while welcome not in await read_message(reader): # 略過排隊位置更新
+                pass
+            delays.append(time.perf_counter() - start)
+            active = (reader, writer)
+        active[1].close()
+        return delays
+    finally:
+        stop_server(proc)
+
+
+# 圖片傳輸(舊版協定的圖片port): 同一房間的兩個client，一個送出images張size bytes的圖片，另一個接收
+# 圖片內容開頭放送出時間，回傳(每秒bytes數, 每張圖片的延遲秒數)
+async def bench_image(images, size):
+    proc, port, image_port = start_server(images=True, room_size=2)
+    try:
+        clients = [await open_client(port) for _ in range(2)]
+        # server依連入順序配對圖片連線，逐一連線避免配錯
+        image_conns = []
+        for _ in clients:
+            image_conns.append(await asyncio.open_connection('127.0.0.1', image_port))
+            await asyncio.sleep(0.1)
+        (_, sender_writer), (receiver_reader, _) = image_conns
+        stamp = struct.Struct('!d')
+        body = bytes(size - stamp.size)
+        latencies = []
+
+        async def sender():
+            for _ in range(images):
+                sender_writer.write(pack_message(stamp.pack(time.perf_counter()) + body))
+                await sender_writer.drain()
+
+        async def receiver():
+            for _ in range(images):
+                data = await read_message(receiver_reader)
+                latencies.append(time.perf_counter() - stamp.unpack_from(data)[0])
+
+        start = time.perf_counter()
+        await asyncio.gather(sender(), receiver())
+        elapsed = time.perf_counter() - start
+        for _, writer in clients + image_conns:
+            writer.close()
+        return images * size / elapsed, latencies
+    finally:
+        stop_server(proc)
+
+
+# 畫面更新: 背景thread灌入messages則訊息，比較每則呼叫一次window.after(舊作法)與UiQueue批次處理
+# 統計每秒顯示的訊息數、訊息從送出到顯示的延遲，以及畫面tick(每16ms一次)被延誤的時間
+def bench_ui(messages, mode):
+    import tkinter as tk
+    from tkinter.scrolledtext import ScrolledText
+    from chat_ui import UiQueue
+    from chat_view import MessageView
+
+    root = tk.Tk()
+    root.geometry("600x600")
+    latencies = []
+    frame_delays = []
+    done = {"count": 0, "end": None}
+
+    if mode == "after":
+        log_text = ScrolledText(root)
+        log_text.pack(fill=tk.BOTH, expand=True)
+
+        def render(sent, line):
+            log_text.insert(tk.END, line)
+            log_text.see(tk.END)
+            rendered(sent)
+
+        def post(sent, line):
+            root.after(0, render, sent, line)
+    else:
+        view = MessageView(root, None, None)
+        view.pack(fill=tk.BOTH, expand=True)
+        ui = UiQueue(root)
+        ui.start()
+
+        def render(sent, line):
+            view.insert_text(line)
+            rendered(sent)
+
+        def post(sent, line):
+            ui.post(render, sent, line)
+
+    def rendered(sent):
+        now = time.perf_counter()
+        latencies.append(now - sent)
+        done["count"] += 1
+        if done["count"] == messages:
+            done["end"] = now
+            root.after(100, root.quit)
+
+    last_frame = [time.perf_counter()]
+
+    def frame():
+        now = time.perf_counter()
+        frame_delays.append(max(0.0, now - last_frame[0] - 0.016))
+        last_frame[0] = now
+        root.after(16, frame)
+
+    def flood():
+        for i in range(messages):
+            post(time.perf_counter(), f"[00:00:00] Client(127.0.0.1):message {i}\n")
+
+    root.update()
+    start = time.perf_counter()
+    root.after(16, frame)
+    threading.Thread(target=flood, daemon=True).start()
+    root.mainloop()
+    root.destroy()
+    elapsed = (done["end"] or time.perf_counter()) - start
+    return done["count"] / elapsed, latencies, frame_delays
+
+
+def ms(values, p):
+    return f"{percentile(values, p) * 1000:>7.2f}ms"
+
+
+def print_connect(rate, times, per_conn):
+    memory = f"{per_conn / 1024:,.1f} KB" if per_conn is not None else "n/a"
+    print(f"連線 {rate:,.0f} 個/秒  單一連線 p50 {ms(times, 50)}  p99 {ms(times, 99)}  每條連線記憶體 {memory}")
+
+
+# 預設參數的完整測試，數字可直接和之前的結果比較
+def report_all():
+    print("[connect] 1000 clients")
+    print_connect(*asyncio.run(bench_connect(1000, 100)))
+    print("[latency] 20000 則訊息，不限速 / 每秒1000則")
+    for rate in (0, 1000):
+        throughput, latencies = asyncio.run(bench_latency(20000, rate))
+        print(f"  {throughput:>10,.0f} msgs/s  p50 {ms(latencies, 50)}  p99 {ms(latencies, 99)}")
+    print("[queue] 200 人排隊")
+    delays = asyncio.run(bench_queue(200))
+    print(f"  遞補延遲 p50 {ms(delays, 50)}  p99 {ms(delays, 99)}")
+    print("[image] 50 張 1 MB 圖片")
+    speed, latencies = asyncio.run(bench_image(50, 1024 * 1024))
+    print(f"  {speed / 1024 / 1024:,.1f} MB/s  p50 {ms(latencies, 50)}  p99 {ms(latencies, 99)}")
+    print("[rooms] 8 間房 x 2 人")
+    print(f"  {asyncio.run(bench_rooms(8, 2, 2000)):,.0f} msgs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TCP Chatroom benchmark")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    p = sub.add_parser("rooms", help="同時進行的聊天室數量 vs. 總訊息吞吐量")
+    p.add_argument("--rooms", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    p.add_argument("--room-size", type=int, default=2)
+    p.add_argument("--messages", type=int, default=2000, help="每位client送出的訊息數")
+
+    p = sub.add_parser("connect", help="連線速度與每條連線佔用的server記憶體")
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument("--concurrency", type=int, default=100, help="同時進行中的連線數")
+
+    p = sub.add_parser("latency", help="兩個client之間的訊息吞吐量與端對端延遲")
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--rate", type=int, nargs="+", default=[0, 1000], help="每秒送出的訊息數，0為不限速")
+
+    p = sub.add_parser("queue", help="聊天室空出位置後排隊者遞補的延遲")
+    p.add_argument("--waiters", type=int, default=200)
+
+    p = sub.add_parser("image", help="舊版協定圖片port的傳輸速度與延遲")
+    p.add_argument("--images", type=int, default=50)
+    p.add_argument("--size", type=int, default=1024 * 1024, help="每張圖片的bytes數")
+
+    p = sub.add_parser("workers", help="多行程模式(SO_REUSEPORT)下worker數量 vs. 總訊息吞吐量")
+    p.add_argument("--workers", type=int, nargs="+", help="預設為1, 2, 4...直到CPU核心數")
+    p.add_argument("--clients", type=int, default=64)
+    p.add_argument("--room-size", type=int, default=2)
+    p.add_argument("--messages", type=int, default=2000, help="每位client送出的訊息數")
+    p.add_argument("--procs", type=int, default=4, help="壓測client的行程數")
+
+    p = sub.add_parser("fanout", help="房間人數 vs. 廣播的吞吐量與server每送達一則訊息的CPU時間")
+    p.add_argument("--room-size", type=int, nargs="+", default=[2, 8, 32, 128, 512])
+    p.add_argument("--messages", type=int, default=2000, help="送出的訊息數")
+    p.add_argument("--size", type=int, default=64, help="每則訊息的bytes數(超過256會被壓縮，每人各自壓縮)")
+
+    sub.add_parser("all", help="以預設參數執行connect/latency/queue/image/rooms，輸出一份摘要")
+
+    p = sub.add_parser("ui", help="訊息灌入時的畫面更新速度與延遲(需要圖形介面)")
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--mode", choices=["after", "queue"], nargs="+", default=["after", "queue"],
+                   help="after: 每則訊息各呼叫一次window.after；queue: UiQueue批次處理")
+
+    args = parser.parse_args()
+    if args.scenario == "all":
+        report_all()
+    elif args.scenario == "connect":
+        print_connect(*asyncio.run(bench_connect(args.clients, args.concurrency)))
+    elif args.scenario == "latency":
+        print(f"{'rate':>8} {'msgs/s':>10} {'lat p50':>9} {'lat p99':>9} {'lat max':>9}")
+        for rate in args.rate:
+            throughput, latencies = asyncio.run(bench_latency(args.messages, rate))
+            print(f"{rate or '不限':>8} {throughput:>10,.0f} {ms(latencies, 50)} {ms(latencies, 99)} "
+                  f"{max(latencies) * 1000:>7.2f}ms")
+    elif args.scenario == "queue":
+        delays = asyncio.run(bench_queue(args.waiters))
+        print(f"遞補延遲 p50 {ms(delays, 50)}  p99 {ms(delays, 99)}  max {max(delays) * 1000:.2f}ms")
+    elif args.scenario == "image":
+        speed, latencies = asyncio.run(bench_image(args.images, args.size))
+        print(f"{speed / 1024 / 1024:,.1f} MB/s  延遲 p50 {ms(latencies, 50)}  p99 {ms(latencies, 99)}")
+    elif args.scenario == "rooms":
+        print(f"{'rooms':>6} {'clients':>8} {'msgs/s':>12}")
+        for rooms in args.rooms:
+            rate = asyncio.run(bench_rooms(rooms, args.room_size, args.messages))
+            print(f"{rooms:>6} {rooms * args.room_size:>8} {rate:>12,.0f}")
+    elif args.scenario == "workers":
+        cores = os.cpu_count() or 1
+        counts = args.workers or [n for n in (1, 2, 4, 8, 16, 32, 64) if n < cores] + [cores]
+        print(f"CPU核心數 {cores}，{args.clients} 個client、每間房 {args.room_size} 人、{args.procs} 個壓測行程")
+        print(f"{'workers':>8} {'msgs/s':>12} {'倍數':>6}")
+        base = None
+        for workers in counts:
+            rate = bench_workers(workers, args.clients, args.room_size, args.messages, args.procs)
+            base = base or rate
+            print(f"{workers:>8} {rate:>12,.0f} {rate / base:>7.2f}x")
+    elif args.scenario == "fanout":
+        print(f"{'members':>8} {'delivered/s':>12} {'CPU/msg':>10}")
+        for room_size in args.room_size:
+            rate, cpu = asyncio.run(bench_fanout(room_size, args.messages, args.size))
+            print(f"{room_size:>8} {rate:>12,.0f} {f'{cpu:.2f}us' if cpu is not None else 'n/a':>10}")
+    elif args.scenario == "ui":
+        print(f"{'mode':>6} {'msgs/s':>10} {'lat p50':>9} {'lat p99':>9} {'frame p50':>10} {'frame p99':>10} {'frame max':>10}")
+        for mode in args.mode:
+            rate, latencies, frames = bench_ui(args.messages, mode)
+            print(f"{mode:>6} {rate:>10,.0f} {percentile(latencies, 50) * 1000:>7.1f}ms "
+                  f"{percentile(latencies, 99) * 1000:>7.1f}ms {percentile(frames, 50) * 1000:>8.1f}ms "
+                  f"{percentile(frames, 99) * 1000:>8.1f}ms {max(frames, default=0) * 1000:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    raise_fd_limit()
+    main()
@@ -0,0 +1,340 @@
+import argparse
+import asyncio
+import socket
+import struct
+import threading
+from chat_protocol import FIRST_SENDER_ID, ProtocolError, pack_file_offer, decode_file_offer
+from chat_queue import AdmissionQueue
+from chat_transfer import MAX_IMAGE_SIZE
+
+# 叢集模式: 多個server節點(ChatCore)共用房間與排隊名單，訊息經由MessageBus轉送
+# 座位分配與排隊都由唯一的Coordinator決定，所以排隊是整個叢集共用的:
+#   節點收到新連線 -> JOIN -> Coordinator依序分配座位(GRANT)或回覆排隊位置(POSITION)
+#   client離開 -> LEAVE -> 空出的座位交給排在最前面的client，不論它連在哪個節點
+#   房間內的訊息 -> MSG -> 轉送給在同一間房有成員的其他節點
+# MessageBus有兩種實作:
+#   LoopbackBus: 同一個行程內的多個ChatCore共用一個LoopbackHub(測試、單機多事件迴圈)
+#   RelayBus: 以TCP或Unix socket連到Relay(python chat_cluster.py)，Relay內含Coordinator
+
+# 節點與Relay之間的訊息: 4 byte長度 + 種類(1 byte) + 房間(2 bytes) + 連線id(4 bytes) + 內容
+# relay沒有驗證節點的身分，預設只監聽127.0.0.1；內容只以固定格式解析，不執行任何對方送來的資料
+BUS_HEADER = struct.Struct('!IBHI')
+MAX_BUS_SIZE = MAX_IMAGE_SIZE + 64 * 1024 # 一則訊息的上限(MSG最大為一整張圖片加上名稱)
+BUS_CONFIG = 1 # Coordinator -> 節點: 連上時告知房間數與每間人數，內容為CONFIG
+BUS_JOIN = 2 # 節點 -> Coordinator: 新的client要求座位
+BUS_LEAVE = 3 # 節點 -> Coordinator: client離開(不論在房間內或排隊中)
+BUS_GRANT = 4 # Coordinator -> 節點: client進入房間，內容為分配到的傳送者id(SENDER)
+BUS_POSITION = 5 # Coordinator -> 節點: client的新排隊位置，內容為POSITION
+BUS_MSG = 6 # 房間內的訊息，內容為MSG + 名稱 + 內容(見encode_msg)
+CONFIG = struct.Struct('!HH') # 房間數, 每間人數
+SENDER = struct.Struct('!H')
+POSITION = struct.Struct('!I')
+MSG = struct.Struct('!BHQH') # 種類, 傳送者id, 時間(毫秒), 名稱長度
+# MSG的種類: "text"(frame協定client的內容)、"raw"(舊版client已含名稱的文字)、"image"(bytes)、"file"(FileOffer)
+MSG_KINDS = ("text", "raw", "image", "file")
+
+
+def encode_bus(kind, room=0, conn=0, body=b""):
+    return BUS_HEADER.pack(BUS_HEADER.size - 4 + len(body), kind, room, conn) + body
+
+
+# 回傳(種類, 房間, 連線id, 內容)，長度不合理時丟出ProtocolError
+async def read_bus(reader):
+    length, kind, room, conn = BUS_HEADER.unpack(await reader.readexactly(BUS_HEADER.size))
+    if not BUS_HEADER.size - 4 <= length <= MAX_BUS_SIZE:
+        raise ProtocolError(f"bus訊息長度錯誤({length} bytes)")
+    return kind, room, conn, await reader.readexactly(length - (BUS_HEADER.size - 4))
+
+
+def encode_msg(kind, sender_id, display_name, data, timestamp=0):
+    if kind == "file":
+        data = pack_file_offer(data)
+    elif kind != "image":
+        data = data.encode()
+    name = display_name.encode()
+    return MSG.pack(MSG_KINDS.index(kind) + 1, sender_id, timestamp, len(name)) + name + data
+
+
+# 回傳(種類, 傳送者id, 名稱, 內容, 時間)，格式錯誤時丟出ValueError或struct.error
+def decode_msg(body):
+    code, sender_id, timestamp, name_length = MSG.unpack_from(body)
+    if not 1 <= code <= len(MSG_KINDS):
+        raise ProtocolError(f"未知的訊息種類({code})")
+    kind = MSG_KINDS[code - 1]
+    start = MSG.size + name_length
+    display_name = bytes(body[MSG.size:start]).decode()
+    if kind == "file":
+        data = decode_file_offer(body, start)
+    elif kind == "image":
+        data = bytes(body[start:])
+    else:
+        data = bytes(body[start:]).decode()
+    return kind, sender_id, display_name, data, timestamp
+
+
+# 被其他節點上的client送出的訊息，提供broadcast_message需要的傳送者id與名稱
+class RemoteOrigin:
+    def __init__(self, sender_id, display_name):
+        self.sender_id = sender_id
+        self.display_name = display_name
+
+
+# 叢集唯一的座位與排隊狀態，不做任何I/O
+# handle()回傳要送出的[(節點, 種類, 房間, 連線id, 內容)]，由LoopbackHub或Relay負責送達
+class Coordinator:
+    def __init__(self, max_rooms, room_size):
+        self.max_rooms = max_rooms
+        self.room_size = room_size
+        self.seats = {} # room_id -> {(節點, 連線id)}，只保留有人的房間
+        self.seated = {} # (節點, 連線id) -> room_id
+        self.queue = AdmissionQueue() # 全叢集的排隊名單，key與item都是(節點, 連線id)
+        self._next_sender = 0 # 傳送者id在整個叢集依序分配
+
+    def config(self):
+        return CONFIG.pack(self.max_rooms, self.room_size)
+
+    def handle(self, node, kind, room, conn, body):
+        out = []
+        if kind == BUS_JOIN:
+            position = self.queue.push((node, conn), (node, conn))
+            # 有空位時隊伍必定是空的，新的client會在_admit直接分配到座位；沒有空位才需要告知位置
+            if self._find_room() is None:
+                out.append((node, BUS_POSITION, 0, conn, POSITION.pack(position)))
+        elif kind == BUS_LEAVE:
+            self._leave((node, conn))
+        elif kind == BUS_MSG:
+            targets = {n for n, _ in self.seats.get(room, ())}
+            targets.discard(node)
+            return [(n, kind, room, conn, body) for n in targets]
+        self._admit(out)
+        return out
+
+    # 節點斷線: 它的client全部視為離開
+    def drop_node(self, node):
+        for key in [k for k in self.seated if k[0] == node] + [k for k in self.queue if k[0] == node]:
+            self._leave(key)
+        out = []
+        self._admit(out)
+        return out
+
+    def _leave(self, key):
+        room = self.seated.pop(key, None)
+        if room is None:
+            self.queue.remove(key)
+            return
+        members = self.seats[room]
+        members.discard(key)
+        if not members:
+            del self.seats[room]
+
+    # 優先填滿已經有人的房間，其次是編號最小的空房間；全部額滿時回傳None
+    def _find_room(self):
+        for room, members in self.seats.items():
+            if len(members) < self.room_size:
+                return room
+        if len(self.seats) >= self.max_rooms:
+            return None
+        return next(i for i in range(1, self.max_rooms + 1) if i not in self.seats)
+
+    # 依排隊順序分配座位，再把位置有變動的排隊者通知其節點
+    def _admit(self, out):
+        while self.queue:
+            room = self._find_room()
+            if room is None:
+                break
+            node, conn = key = self.queue.pop()
+            self.seats.setdefault(room, set()).add(key)
+            self.seated[key] = room
+            sender_id = FIRST_SENDER_ID + self._next_sender % (0x10000 - FIRST_SENDER_ID)
+            self._next_sender += 1
+            out.append((node, BUS_GRANT, room, conn, SENDER.pack(sender_id)))
+        for (node, conn), position in self.queue.changed_positions():
+            out.append((node, BUS_POSITION, 0, conn, POSITION.pack(position)))
+
+
+# ChatCore使用的介面；on_message(種類, 房間, 連線id, 內容)在節點的事件迴圈thread上被呼叫
+class MessageBus:
+    # 連上Coordinator，回傳(房間數, 每間人數)
+    async def connect(self, on_message):
+        raise NotImplementedError
+
+    # 連線中斷時完成的future，ChatCore據此結束
+    def closed(self):
+        raise NotImplementedError
+
+    def send(self, kind, room=0, conn=0, body=b""):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def join(self, conn_id):
+        self.send(BUS_JOIN, conn=conn_id)
+
+    def leave(self, conn_id):
+        self.send(BUS_LEAVE, conn=conn_id)
+
+    # kind: 見MSG_KINDS
+    def publish(self, room_id, kind, origin, data, timestamp=0):
+        self.send(BUS_MSG, room_id, body=encode_msg(kind, origin.sender_id, origin.display_name, data, timestamp))
+
+
+# 同一個行程內的節點共用的Coordinator，每個節點的事件迴圈在不同thread，以lock保護
+class LoopbackHub:
+    def __init__(self, max_rooms=1, room_size=1):
+        self.coordinator = Coordinator(max_rooms, room_size)
+        self._nodes = {} # 節點編號 -> 送達函式
+        self._next_node = 0
+        self._lock = threading.Lock()
+
+    def attach(self, deliver):
+        with self._lock:
+            node = self._next_node
+            self._next_node += 1
+            self._nodes[node] = deliver
+        return node
+
+    def detach(self, node):
+        with self._lock:
+            self._nodes.pop(node, None)
+            self._deliver(self.coordinator.drop_node(node))
+
+    def handle(self, node, kind, room, conn, body):
+        with self._lock:
+            self._deliver(self.coordinator.handle(node, kind, room, conn, body))
+
+    def _deliver(self, out):
+        for node, *message in out:
+            deliver = self._nodes.get(node)
+            if deliver is not None:
+                deliver(*message)
+
+
+class LoopbackBus(MessageBus):
+    def __init__(self, hub: LoopbackHub):
+        self.hub = hub
+        self.node = None
+        self._closed = None
+
+    async def connect(self, on_message):
+        loop = asyncio.get_running_loop()
+        self._closed = loop.create_future()
+
+        def deliver(*message):
+            try:
+                loop.call_soon_threadsafe(on_message, *message)
+            except RuntimeError: # 事件迴圈已關閉
+                pass
+        self.node = self.hub.attach(deliver)
+        return self.hub.coordinator.max_rooms, self.hub.coordinator.room_size
+
+    def closed(self):
+        return self._closed
+
+    def send(self, kind, room=0, conn=0, body=b""):
+        if self.node is not None:
+            self.hub.handle(self.node, kind, room, conn, body)
+
+    def close(self):
+        if self.node is not None:
+            self.hub.detach(self.node)
+            self.node = None
+
+
+# 連到Relay的節點；address為Unix socket路徑或(host, port)
+class RelayBus(MessageBus):
+    def __init__(self, address):
+        self.address = address
+        self._writer = None
+        self._task = None
+
+    async def connect(self, on_message):
+        if isinstance(self.address, str):
+            reader, self._writer = await asyncio.open_unix_connection(self.address)
+        else:
+            reader, self._writer = await asyncio.open_connection(*self.address)
+            self._writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        kind, _, _, body = await read_bus(reader)
+        if kind != BUS_CONFIG:
+            raise ConnectionError("relay未回覆設定")
+        self._task = asyncio.get_running_loop().create_task(self._read(reader, on_message))
+        return CONFIG.unpack(body)
+
+    async def _read(self, reader, on_message):
+        try:
+            while True:
+                on_message(*await read_bus(reader))
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+
+    def closed(self):
+        return self._task
+
+    def send(self, kind, room=0, conn=0, body=b""):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(encode_bus(kind, room, conn, body))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+# Coordinator的網路前端，每條連線是一個節點；MSG只看標頭就轉送，不解開內容
+class Relay:
+    def __init__(self, max_rooms=1, room_size=1):
+        self.coordinator = Coordinator(max_rooms, room_size)
+        self._nodes = {} # 節點編號 -> writer
+        self._next_node = 0
+
+    # address為Unix socket路徑或(host, port)
+    async def start(self, address):
+        if isinstance(address, str):
+            return await asyncio.start_unix_server(self._handle, address)
+        return await asyncio.start_server(self._handle, *address)
+
+    async def _handle(self, reader, writer):
+        node = self._next_node
+        self._next_node += 1
+        self._nodes[node] = writer
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.write(encode_bus(BUS_CONFIG, body=self.coordinator.config()))
+        try:
+            while True:
+                self._deliver(self.coordinator.handle(node, *await read_bus(reader)))
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            del self._nodes[node]
+            writer.close()
+            self._deliver(self.coordinator.drop_node(node))
+
+    def _deliver(self, out):
+        for node, *message in out:
+            writer = self._nodes.get(node)
+            if writer is not None and not writer.is_closing():
+                writer.write(encode_bus(*message))
+
+
+def run_relay(host='127.0.0.1', port=10100, max_rooms=1, room_size=1):
+    async def main():
+        server = await Relay(max_rooms, room_size).start((host, port))
+        print(f"Relay 監聽 {host}:{port}({max_rooms} 間房，每間 {room_size} 人)，按Ctrl-C結束")
+        async with server:
+            await server.serve_forever()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nRelay已關閉。")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="TCP Chatroom cluster relay")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="relay沒有驗證節點，只在受信任的網路上改成其他位址(例如0.0.0.0)")
+    parser.add_argument("--port", type=int, default=10100)
+    parser.add_argument("--rooms", type=int, default=1, help="整個叢集同時進行的聊天室數量")
+    parser.add_argument("--room-size", type=int, default=1, help="每個聊天室可容納的client數")
+    args = parser.parse_args()
+    run_relay(args.host, args.port, args.rooms, args.room_size)
@@ -0,0 +1,1336 @@
+import asyncio
+import os
+import socket
+import itertools
+import secrets
+import struct
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from datetime import datetime
+from chat_heartbeat import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, IDLE_TIMEOUT, TimerWheel, set_keepalive
+from chat_history import HISTORY_FILE, HistoryStore
+from chat_log import FSYNC_ROTATE, LogWriter
+from chat_metrics import ServerMetrics
+from chat_outbox import SEND_HIGH_WATER, SEND_LOW_WATER, SEND_BUDGET, SLOW_NOTICE_DELAY, POLICY_DISCONNECT
+from chat_queue import AdmissionQueue
+from chat_protocol import (MAGIC, VERSION, HELLO, HEADER, FRAME_TEXT, FRAME_IMAGE, FRAME_IMAGE_BEGIN, FRAME_RESUME,
+                           FRAME_IMAGE_OFFER, FRAME_IMAGE_ACCEPT, FRAME_IMAGE_FETCH, FRAME_CONTROL, FRAME_NAMES,
+                           ACCEPT_HAVE, CTRL_WELCOME, CTRL_QUEUE, CTRL_COMPRESS, CTRL_RESUME, CTRL_BYE, CTRL_PING,
+                           CTRL_PONG, CTRL_FILE_OFFER, CTRL_PREVIEW, CTRL_READY, OFFSET, OFFER, MAX_FRAME_SIZE, MAX_TEXT_LENGTH,
+                           SENDER_NONE, SENDER_SERVER, FIRST_SENDER_ID, now_ms, pack_header, encode_control,
+                           encode_member, encode_frame, encode_resume, encode_session, decode_session_resume,
+                           encode_file_offer, decode_file_offer,
+                           decode_image_offer, encode_image_accept, encode_image_preview, encode_image_fetch,
+                           decode_image_fetch,
+                           checked_length, ProtocolError, FrameProtocol, Sequence, StreamIds, TextCodec)
+from chat_store import CONTENT_DIR, ContentStore
+from chat_transfer import (OFFER_TIMEOUT, MAX_IMAGE_SIZE, MAX_TRANSFERS, MAX_TRANSFER_BYTES, OutgoingTransfer,
+                           TransferReceiver, progress_percent)
+from chat_cluster import BUS_GRANT, BUS_POSITION, BUS_MSG, SENDER, POSITION, MessageBus, RemoteOrigin, decode_msg
+try:
+    from chat_images import PREVIEW, make_preview
+except ImportError: # 沒有安裝Pillow時不產生縮圖，圖片照常完整傳送
+    make_preview = None
+
+WELCOME_MSG = "歡迎進入聊天室\n"
+METRICS_INTERVAL = 10 # 指標寫入檔案的間隔秒數
+RESUME_GRACE = 30 # 聊天室內的client斷線後保留座位的秒數，期間可以用token接回(0為不保留)
+REPLAY_FRAMES = 1000 # 每個client保留最近送出的文字/控制訊息數，重新連線時補送沒收到的部分
+REPLAY_BYTES = 512 * 1024 # 同上，保留的文字總量上限
+LEGACY_WAIT = 0.3 # 連線後這麼多秒內沒有收到HELLO就當作舊版client，先安排座位(舊版client不會主動送資料)
+HANDSHAKE_TIMEOUT = 10 # 送出HELLO後必須在這麼多秒內送完交握(CTRL_READY)
+
+
+# 自動抓取本地IP位址
+def get_local_ip():
+    # 透過對內部網路建立一次連線來得到本地ip位址
+    # socket會自動偵測本機的網路介面，並綁定適當的IP連接，透過這個原理可以不用設定本地IP就得到本地位址
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(('10.255.255.255', 1))
+        ip = s.getsockname()[0]
+    except OSError:
+        ip = '127.0.0.1'
+    finally:
+        s.close()
+    return ip
+
+
+# 將資料加上4 byte長度標頭，與原本的傳輸格式相同
+def pack_message(data: bytes):
+    return len(data).to_bytes(4, 'big') + data
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# 要送給多個client的文字只編碼一次，所有人共用同一份bytes(也共用在各自的補送紀錄中)
+# 每個人只另外產生自己的frame標頭(序號不同)，以writelines把標頭與共用的內容一起送出
+# legacy: 舊版client收到的文字(例如「名稱:內容」)，與frame的內容不同時才需要指定
+class EncodedText:
+    __slots__ = ("text", "data", "_legacy_text", "_legacy")
+
+    def __init__(self, text, legacy=None):
+        self.text = text
+        self.data = text.encode()
+        self._legacy_text = legacy
+        self._legacy = None
+
+    # 舊版格式的(4 byte長度, 內容)，第一次需要時才產生
+    def legacy_parts(self):
+        if self._legacy is None:
+            data = self.data if self._legacy_text is None else self._legacy_text.encode()
+            self._legacy = (len(data).to_bytes(4, 'big'), data)
+        return self._legacy
+
+
+# origin送出的訊息: frame協定的內容只有body，舊版client收到「名稱:內容」
+def message_text(origin, body):
+    return EncodedText(body, f"{origin.display_name}:{body}\n")
+
+
+# server為一張圖片產生的縮圖: 原圖的digest與大小 + 縮圖內容，同一房間的成員共用
+ImagePreview = namedtuple("ImagePreview", "digest total data")
+
+
+# 單一client連線的狀態
+class Peer:
+    def __init__(self, reader, writer, addr, conn_id=0):
+        self.conn_id = conn_id
+        self.reader = reader
+        self.writer = writer
+        self.addr = addr
+        self.identifier = f"{addr[0]}:{addr[1]}"
+        self.display_name = f"Client({addr[0]})" # 顯示在訊息前的名稱，與舊版client自己加上的相同
+        self.sender_id = FIRST_SENDER_ID + (conn_id - 1) % (0x10000 - FIRST_SENDER_ID)
+        self.seq = Sequence() # 送給這個client的文字/控制訊息序號
+        self.known_senders = set() # 已經告知過名稱的傳送者id
+        self.token = None # 可以恢復連線的client(frame協定)才有，見ChatCore._resume
+        self.sent = deque() # 最近送出的(序號, 大小, 內容)，內容為未壓縮的frame或(EncodedText, 傳送者id, 時間)
+        self.sent_bytes = 0
+        self.detached = False # 連線已中斷，座位保留中
+        self.leaving = False # client送出CTRL_BYE，斷線時不保留座位
+        self.resumed_as = None # 這條連線接回了哪個保留中的Peer
+        self.expire_timer = None
+        self.last_active = time.monotonic() # 最後一次發言(或進入聊天室)的時間，見ChatCore.idle_timeout
+        self.codec = TextCodec(max_text=MAX_TEXT_LENGTH) # 文字壓縮(雙方都送過CTRL_COMPRESS後啟用)
+        self.image_writer = None # 圖片傳輸的連線(連入image port後才會有)
+        self.pending = [] # 排隊期間收到的訊息(種類, 內容)，進入聊天室後才轉交
+        self.admitted = False # 已經安排座位或排入隊伍(使用frame協定的client在交握完成後才安排)
+        self.session: Session = None # 所在的聊天室
+        self.framed = False # 對方送過HELLO後改用frame協定，文字圖片共用同一條連線
+        self.previews = False # 對方送過CTRL_PREVIEW，圖片先送縮圖，原圖等它要求(FRAME_IMAGE_FETCH)時才送
+        self.stream_ids = StreamIds()
+        self.receiver = TransferReceiver(MAX_TRANSFERS, MAX_TRANSFER_BYTES) # 對方上傳中的圖片
+        self.outgoing = {} # transfer id -> 傳送中的OutgoingTransfer
+        self.relays = {} # 對方上傳的transfer id -> [[轉送對象, 對象端的transfer id(轉送失敗時為None)]]
+        self.offers = {} # 已送出OFFER的transfer id -> 等待對方回覆的future(結果為是否已有該圖片)
+        self.on_progress = None # (peer, "send", percent)
+        self.on_slow = None # (peer, slow): 對方接收太慢/已恢復
+        self.on_overflow = None # (peer): 暫存超過send_budget而被中斷連線
+        self.send_budget = SEND_BUDGET
+        self.slow_policy = POLICY_DISCONNECT
+        self.slow = False
+        self.dropped = 0 # 因超過send_budget被丟掉的訊息數
+        self.metrics: ServerMetrics = None
+        self._slow_timer = None
+        self._tasks = set()
+        # 送出緩衝區超過高水位時stream_image的drain會等待(背壓)，持續太久才視為對方太慢
+        writer.set_write_buffer_limits(SEND_HIGH_WATER, SEND_LOW_WATER)
+        writer.on_write_paused = self._on_write_paused
+
+    def can_receive_images(self):
+        return self.framed or self.image_writer is not None
+
+    # 送往這個client的資料都經過這裡，回傳是否已放進送出緩衝區
+    # 對方長時間不接收、暫存超過send_budget時依slow_policy丟棄這則資料或中斷連線
+    def write(self, *parts, writer=None):
+        writer = writer or self.writer
+        if not self._within_budget(writer, sum(len(p) for p in parts)):
+            return False
+        writer.writelines(parts)
+        return True
+
+    # 送出緩衝區還放得下size bytes時回傳True，否則計為丟棄並依slow_policy處理
+    def _within_budget(self, writer, size):
+        if writer.is_closing():
+            return False
+        if writer.write_buffer_size() + size > self.send_budget:
+            self.dropped += 1
+            if self.metrics:
+                self.metrics.dropped.inc()
+            if self.slow_policy == POLICY_DISCONNECT:
+                writer.abort()
+                if self.on_overflow:
+                    self.on_overflow(self)
+            return False
+        return True
+
+    # 壓縮的context是連續的，編碼過的frame被丟掉後對方就解不開下一則
+    # 所以先以壓縮前的大小確認放得進送出緩衝區才編碼，編碼後一定送出
+    def _write_text(self, data, seq, sender, timestamp):
+        if not self._within_budget(self.writer, HEADER.size + len(data)):
+            return False
+        self.writer.writelines(self.codec.encode_parts(data, seq, sender, timestamp))
+        return True
+
+    # 已經包含傳送者名稱的文字(系統訊息、舊版client的訊息等)
+    # encoded: 廣播時共用的EncodedText(text)
+    def send_text(self, text: str, encoded=None):
+        encoded = encoded or EncodedText(text)
+        if self.framed:
+            return self._send_text_frame(encoded)
+        return self.write(*encoded.legacy_parts())
+
+    # origin(Peer或ChatCore)送出的訊息；frame協定只送出內容與傳送者id，舊版client收到「名稱:內容」
+    # encoded: 廣播時共用的message_text(origin, body)
+    def send_message(self, origin, body, timestamp, encoded=None):
+        encoded = encoded or message_text(origin, body)
+        if self.framed:
+            self.introduce(origin)
+            return self._send_text_frame(encoded, origin.sender_id, timestamp)
+        return self.write(*encoded.legacy_parts())
+
+    # 第一次收到某個傳送者的訊息前先告知其名稱
+    def introduce(self, origin):
+        if origin.sender_id not in self.known_senders:
+            self.known_senders.add(origin.sender_id)
+            seq = self.seq.next()
+            self._send_frame(seq, encode_member(origin.sender_id, origin.display_name, seq))
+
+    # 控制訊息(歡迎/排隊位置)，舊版client收到的是同樣內容的一般文字
+    def send_control(self, code, text):
+        if self.framed:
+            seq = self.seq.next()
+            return self._send_frame(seq, encode_control(code, text, seq))
+        return self.write(pack_message(text.encode()))
+
+    # 有序號的frame先記下再送出，連線中斷期間也照常記錄，重新連線後補送
+    def _send_text_frame(self, encoded, sender=SENDER_NONE, timestamp=None):
+        seq = self.seq.next()
+        timestamp = now_ms() if timestamp is None else timestamp
+        self._remember(seq, len(encoded.data), (encoded, sender, timestamp))
+        return self._write_text(encoded.data, seq, sender, timestamp)
+
+    def _send_frame(self, seq, frame):
+        self._remember(seq, len(frame), frame)
+        return self.write(frame)
+
+    def _remember(self, seq, size, entry):
+        if self.token is None:
+            return
+        self.sent.append((seq, size, entry))
+        self.sent_bytes += size
+        while len(self.sent) > REPLAY_FRAMES or self.sent_bytes > REPLAY_BYTES:
+            self.sent_bytes -= self.sent.popleft()[1]
+
+    # 補送序號在last_seq之後的訊息(文字以目前連線的壓縮狀態重新編碼)
+    # 回傳(補送的則數, 是否有部分訊息已超出保留範圍)
+    def replay_since(self, last_seq):
+        entries = [e for e in self.sent if e[0] > last_seq]
+        missing = bool(self.sent) and self.sent[0][0] > last_seq + 1
+        for seq, _, entry in entries:
+            if isinstance(entry, tuple):
+                encoded, sender, timestamp = entry
+                self._write_text(encoded.data, seq, sender, timestamp)
+            else:
+                self.write(entry)
+        return len(entries), missing
+
+    # 重新連線: 接手other(剛連上的Peer)的連線與壓縮狀態，房間、傳送者id、訊息序號與token不變
+    # 中斷前傳到一半的圖片不會續傳
+    def take_over(self, other):
+        self.reader, self.writer = other.reader, other.writer
+        self.addr, self.identifier = other.addr, other.identifier
+        self.codec = other.codec
+        self.previews = other.previews
+        self.framed = True
+        self.detached = False
+        self.stream_ids = StreamIds()
+        self.receiver = TransferReceiver(MAX_TRANSFERS, MAX_TRANSFER_BYTES)
+        self.relays = {}
+        self.writer.set_write_buffer_limits(SEND_HIGH_WATER, SEND_LOW_WATER)
+        self.writer.on_write_paused = self._on_write_paused
+        other.resumed_as = self
+
+    # origin分享的檔案；舊版client無法下載，只收到提示
+    def send_file_offer(self, origin, offer):
+        if not self.framed:
+            return self.write(pack_message(f"{origin.display_name} 分享了檔案 {offer.name}，"
+                                           f"請使用單一連線模式接收\n".encode()))
+        self.introduce(origin)
+        seq = self.seq.next()
+        return self._send_frame(seq, encode_file_offer(offer, seq, origin.sender_id))
+
+    # source可以是檔案路徑或bytes；frame協定下分段串流，舊版協定一次送出整張圖片
+    # origin為圖片的傳送者(Peer或ChatCore)，None代表不指定
+    def send_image(self, source, origin=None):
+        if self.framed:
+            task = asyncio.get_running_loop().create_task(self.stream_image(source, origin))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return True
+        if self.image_writer is None:
+            return False
+        if isinstance(source, str):
+            source = read_file(source)
+        return self.write(len(source).to_bytes(4, 'big'), source, writer=self.image_writer)
+
+    # server產生的縮圖(ImagePreview)，整張放在一個frame內送出
+    def send_preview(self, preview, origin=None):
+        sender = SENDER_NONE
+        if origin is not None:
+            self.introduce(origin)
+            sender = origin.sender_id
+        if self.metrics:
+            self.metrics.previews.labels("preview").inc()
+        return self.write(encode_image_preview(preview.digest, preview.total, preview.data, sender))
+
+    # 先送出內容hash詢問對方是否已有這張圖片，需要時才一段一段送出
+    # 每段之後等送出緩衝區消化，其間的文字訊息可以插隊送出
+    # digest: 已知的內容hash(例如快取中的原圖)，可省去重新計算
+    async def stream_image(self, source, origin=None, digest=None):
+        if origin is not None:
+            self.introduce(origin)
+        transfer = OutgoingTransfer(self.stream_ids.next(), source,
+                                    sender=origin.sender_id if origin is not None else SENDER_NONE)
+        self.outgoing[transfer.transfer_id] = transfer
+        try:
+            have = await self._offer(transfer, digest)
+            if have is None: # 超過send_budget，連線已中斷或這張圖片被丟棄
+                return
+            if have:
+                transfer.skip()
+                if self.on_progress:
+                    self.on_progress(self, "send", 100)
+                return
+            if not self.write(transfer.begin_frame()):
+                return
+            while (parts := transfer.next_frame()) is not None:
+                if not self.write(*parts):
+                    return
+                await self.writer.drain()
+                percent = progress_percent(transfer)
+                if percent is not None and self.on_progress:
+                    self.on_progress(self, "send", percent)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            transfer.close()
+            self.outgoing.pop(transfer.transfer_id, None)
+
+    # 回傳對方是否已經有這張圖片；對方逾時未回覆時當作沒有，OFFER送不出去時回傳None
+    async def _offer(self, transfer, digest=None):
+        loop = asyncio.get_running_loop()
+        if digest is None:
+            digest = await loop.run_in_executor(None, transfer.digest)
+        future = loop.create_future()
+        self.offers[transfer.transfer_id] = future
+        try:
+            if not self.write(transfer.offer_frame(digest)):
+                return None
+            return await asyncio.wait_for(future, OFFER_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.offers.pop(transfer.transfer_id, None)
+
+    # 送出緩衝區超過高水位持續SLOW_NOTICE_DELAY秒才標記為太慢，降回低水位時恢復
+    def _on_write_paused(self, paused):
+        if paused:
+            if self._slow_timer is None and not self.slow:
+                self._slow_timer = asyncio.get_running_loop().call_later(SLOW_NOTICE_DELAY, self._set_slow, True)
+            return
+        if self._slow_timer is not None:
+            self._slow_timer.cancel()
+            self._slow_timer = None
+        if self.slow:
+            self._set_slow(False)
+
+    def _set_slow(self, slow):
+        self._slow_timer = None
+        self.slow = slow
+        if self.on_slow:
+            self.on_slow(self, slow)
+
+    # force=True時不等待尚未送出的資料(server關閉時使用)
+    def close(self, force=False):
+        if self._slow_timer is not None:
+            self._slow_timer.cancel()
+            self._slow_timer = None
+        for future in self.offers.values():
+            future.cancel()
+        for w in (self.writer, self.image_writer):
+            if w is not None:
+                try: w.abort() if force else w.close()
+                except Exception: pass
+
+
+# 一個聊天室(房間)的狀態，取代原本單一的text_conn/image_conn
+class Session:
+    def __init__(self, room_id, capacity):
+        self.room_id = room_id
+        self.capacity = capacity
+        self.members = [] # 房間內的client(Peer)
+
+    def is_full(self):
+        return len(self.members) >= self.capacity
+
+    # 房間內廣播已包含傳送者名稱的文字，exclude為發送者本身
+    def broadcast_text(self, text, exclude=None):
+        encoded = EncodedText(text)
+        for member in self.members:
+            if member is not exclude:
+                member.send_text(text, encoded)
+
+    # 房間內廣播origin送出的訊息；encoded可以由呼叫端傳入，讓多個房間共用
+    def broadcast_message(self, origin, body, timestamp, exclude=None, encoded=None):
+        encoded = encoded or message_text(origin, body)
+        for member in self.members:
+            if member is not exclude:
+                member.send_message(origin, body, timestamp, encoded)
+
+    # skip_framed: 使用frame協定的成員已經邊收邊轉送過了，只需補送給舊版client(先收縮圖的成員不會邊收邊轉送)
+    # preview: server產生的縮圖(ImagePreview)，先收縮圖的成員只收到它；None時一律送原圖
+    def broadcast_image(self, source, exclude=None, skip_framed=False, origin=None, preview=None):
+        for member in self.members:
+            if member is exclude:
+                continue
+            if member.previews:
+                if preview is not None:
+                    member.send_preview(preview, origin)
+                else:
+                    member.send_image(source, origin)
+            elif not (skip_framed and member.framed):
+                member.send_image(source, origin)
+
+
+# 不依賴GUI的聊天室server核心
+# 所有連線都在同一個asyncio事件迴圈內處理，不再為每個連線/排隊client開thread
+# 前端(Tk GUI或headless)透過on_xxx callback取得事件，callback都在事件迴圈的thread上被呼叫
+class ChatCore:
+    # max_rooms: 同時進行的聊天室數量；room_size: 每個聊天室可容納的client數
+    # 預設1間房、1位client，與原本一對一聊天加排隊的行為相同
+    # cache_dir: 收到的圖片以內容hash保存的位置，為None時不保存(每張圖片都會完整傳送)
+    # log_fsync: 紀錄檔的fsync策略(見chat_log.py)
+    # replay: 曾經發言過的client重新連線時，補送該房間最近幾則訊息(0為不補送)
+    # send_budget/slow_policy: 每個client最多暫存多少尚未送出的資料，超過時丟棄訊息或中斷連線(見chat_outbox.py)
+    # metrics_port: 在127.0.0.1的這個port以Prometheus text format提供指標(HTTP)，None時不開啟
+    # metrics_file: 每METRICS_INTERVAL秒把指標寫入這個檔案，None時不寫
+    # bus: 叢集模式的MessageBus(見chat_cluster.py)，座位與排隊由整個叢集共用，房間內的訊息同時轉送給其他節點；
+    #      房間數與每間人數以Coordinator的設定為準
+    # reuse_port: 以SO_REUSEPORT監聽，讓同一台機器上的多個行程共用text port(見chat_workers.py)
+    # resume_grace: 聊天室內的client(frame協定)斷線後保留座位的秒數，期間重新連線可以接回並補收訊息
+    # heartbeat/heartbeat_timeout: frame協定的client沒有送來資料多少秒後送出PING/中斷連線(見chat_heartbeat.py)
+    # idle_timeout: 聊天室內的client沒有發言多少秒後請它離開，0為不限制
+    # previews: 對送過CTRL_PREVIEW的client先送server產生的縮圖，點開時才傳原圖(需要cache_dir與Pillow)
+    def __init__(self, host='0.0.0.0', text_port=10000, image_port=10001, log_dir="chat_logs", name="Server",
+                 max_rooms=1, room_size=1, cache_dir=CONTENT_DIR, log_fsync=FSYNC_ROTATE, replay=0,
+                 send_budget=SEND_BUDGET, slow_policy=POLICY_DISCONNECT, metrics_port=None, metrics_file=None,
+                 bus: MessageBus = None, reuse_port=False, resume_grace=RESUME_GRACE, heartbeat=HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT, idle_timeout=IDLE_TIMEOUT, previews=True):
+        self.HOST = host
+        self.TEXT_PORT = text_port
+        self.IMAGE_PORT = image_port
+        self.name = name
+        self.local_ip = get_local_ip()
+        self.display_name = f"{name}({self.local_ip})"
+        self.sender_id = SENDER_SERVER
+        self.max_rooms = max_rooms
+        self.room_size = room_size
+        self.replay = replay
+        self.send_budget = send_budget
+        self.slow_policy = slow_policy
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.bus = bus
+        self.reuse_port = reuse_port
+        self.resume_grace = resume_grace
+        self.heartbeat = heartbeat
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+
+        self.sessions = {} # room_id -> Session，只保留有人的房間
+        self.waiting = AdmissionQueue() # 排隊中的client(Peer)，以conn_id索引；叢集模式下只有這個節點上的
+        self._conn_ids = itertools.count(1)
+        self.detached = {} # token -> 連線中斷、座位保留中的Peer
+        self.wheel = TimerWheel() # 每條連線下一次檢查是否還活著/閒置的時間
+        self._waiting_dirty = False
+
+        self.on_log = None # (line, tag): 系統訊息/紀錄
+        self.on_text = None # (peer, message): 收到client文字訊息
+        self.on_image = None # (peer, img): 收到client圖片，img為bytes或快取中的檔案路徑
+        self.on_waiting_changed = None # (identifiers): 排隊名單變動
+        self.on_client_connected = None # (peer): 有client進入聊天室
+        self.on_progress = None # (peer, kind, percent): 圖片傳送("send")/接收("recv")進度
+        self.on_file_offer = None # (peer, offer): client分享檔案(FileOffer，host已填入該client的位址)
+
+        # 計數器與處理時間統計，成本很低，一律開啟
+        self.metrics = ServerMetrics(active=self.client_count, waiting=lambda: len(self.waiting))
+
+        # 文字記錄由背景thread批次寫入，檔案名稱設定為目前時間並會定期換檔；log_dir為None時不寫檔
+        self.log_writer = LogWriter(log_dir, fsync=log_fsync, write_time=self.metrics.log_write) if log_dir else None
+        # 可搜尋的訊息歷史，與紀錄檔放在同一個資料夾
+        self.history = HistoryStore(os.path.join(log_dir, HISTORY_FILE),
+                                    write_time=self.metrics.history_write) if log_dir else None
+
+        self.content_store = ContentStore(cache_dir) if cache_dir else None
+        # 原圖要留在快取中等client要求，所以沒有快取時不送縮圖
+        self.previews = bool(previews and self.content_store and make_preview)
+
+        self.loop: asyncio.AbstractEventLoop = None
+        self._servers = []
+        self._tasks = set() # 每個連線的處理coroutine，關閉時等待其結束
+        self._thread = None
+        self._ready = threading.Event()
+        self._stopped = None
+        self._closing = False
+
+    # ---- 對外介面(可從任何thread呼叫) ----
+
+    # 在背景thread啟動事件迴圈(給GUI使用)
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    # 在目前thread執行事件迴圈直到stop()(headless模式直接呼叫)
+    def serve_forever(self):
+        try:
+            asyncio.run(self._main())
+        finally:
+            self._ready.set()
+            self.close_log()
+
+    def stop(self):
+        if self.loop and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                pass
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        self.close_log()
+
+    # 目前的紀錄檔路徑(換檔後會改變)
+    @property
+    def log_file_path(self):
+        return self.log_writer.path if self.log_writer else None
+
+    # 把尚未寫出的紀錄與歷史訊息寫入檔案並關閉，可重複呼叫
+    def close_log(self):
+        if self.log_writer:
+            self.log_writer.close()
+        if self.history:
+            self.history.close()
+
+    def has_client(self):
+        return bool(self.sessions)
+
+    def client_count(self):
+        return sum(len(session.members) for session in list(self.sessions.values()))
+
+    # 傳送文字訊息給所有聊天室內的client，沒有client時回傳False
+    def send_text(self, msg):
+        if not self.sessions:
+            return False
+        timestamp = now_ms()
+        full_msg = f"{self.display_name}:{msg}\n"
+        self._write_log(f"{self._now()} {full_msg}")
+        self._call_soon(self._send_text, msg, full_msg, timestamp)
+        return True
+
+    # 傳送圖片(檔案路徑或bytes)給所有聊天室內的client，沒有任何client建立圖片連線時回傳False
+    def send_image(self, img_bytes):
+        if not any(m.can_receive_images() for session in list(self.sessions.values()) for m in list(session.members)):
+            return False
+        self._call_soon(self._send_image, img_bytes)
+        return True
+
+    # 把server分享的檔案(chat_files.FileShare.offer())告知所有聊天室內的client，沒有client時回傳False
+    def send_file_offer(self, offer):
+        if not self.sessions:
+            return False
+        self._call_soon(self._send_file_offer, offer)
+        return True
+
+    # 系統訊息，同時寫入聊天紀錄檔
+    def log(self, msg, tag=None):
+        line = f"{self._now()} {msg}"
+        self._write_log(line)
+        if self.on_log:
+            self.on_log(line, tag)
+
+    # ---- 事件迴圈內部 ----
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        try:
+            if self.bus:
+                # 與Coordinator的連線中斷時這個節點也跟著結束
+                self.max_rooms, self.room_size = await self.bus.connect(self._on_bus_message)
+                self.bus.closed().add_done_callback(lambda _: self._stopped.set())
+            # FrameProtocol讓事件迴圈直接recv_into預先配置的緩衝區
+            self._servers.append(await self.loop.create_server(
+                lambda: self._protocol(self._handle_text_conn, "text"), self.HOST, self.TEXT_PORT, backlog=1024,
+                reuse_port=self.reuse_port or None))
+            if self.IMAGE_PORT is not None:
+                self._servers.append(await self.loop.create_server(
+                    lambda: self._protocol(self._handle_image_conn, "image"), self.HOST, self.IMAGE_PORT,
+                    backlog=1024))
+            if self.metrics_port is not None:
+                self._servers.append(await asyncio.start_server(self._handle_metrics, '127.0.0.1',
+                                                                self.metrics_port))
+        except OSError as e:
+            self.log(f"[錯誤] 無法監聽 port 或連線到 relay: {e}\n", tag="error")
+            self._ready.set()
+            return
+        self._ready.set()
+        self.log("等待 client 連線中...\n", tag="system")
+        if self.metrics_file:
+            self._spawn(self._dump_metrics())
+        if self.heartbeat or self.idle_timeout:
+            self._spawn(self._run_wheel())
+        try:
+            await self._stopped.wait()
+        finally:
+            self._closing = True
+            if self.metrics_file:
+                self._write_metrics()
+            for server in self._servers:
+                server.close()
+            for peer in [m for session in self.sessions.values() for m in session.members] + list(self.waiting):
+                peer.close(force=True)
+            if self._tasks:
+                await asyncio.wait(self._tasks, timeout=1)
+            self.sessions.clear()
+            self.waiting = AdmissionQueue()
+            if self.bus:
+                self.bus.close()
+
+    def _protocol(self, handler, port):
+        self.metrics.connections.labels(port).inc()
+        return FrameProtocol(handler, bytes_in=self.metrics.bytes_in.labels(port),
+                             bytes_out=self.metrics.bytes_out.labels(port))
+
+    # 極簡的HTTP回應: 不論路徑都回傳全部指標
+    async def _handle_metrics(self, reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            body = self.metrics.render().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: %d\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dump_metrics(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            await self.loop.run_in_executor(None, self._write_metrics)
+
+    async def _run_wheel(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for peer in self.wheel.advance():
+                self._check_peer(peer)
+
+    # 第一次檢查時已經知道對方是否使用frame協定
+    def _watch(self, peer):
+        delays = [d for d in (self.heartbeat, self.idle_timeout) if d]
+        if delays:
+            self.wheel.schedule(peer, min(delays))
+
+    # TimerWheel到期: 依最後收到資料/發言的時間送出PING、中斷連線，或排定下一次檢查
+    def _check_peer(self, peer):
+        if peer.detached or peer.resumed_as is not None or peer.writer.is_closing():
+            return
+        now = time.monotonic()
+        delays = []
+        if self.heartbeat and peer.framed:
+            silent = now - peer.reader.last_recv
+            if silent >= self.heartbeat_timeout:
+                self._reap(peer, "heartbeat", f"{int(silent)} 秒沒有回應")
+                return
+            if silent >= self.heartbeat:
+                peer.write(encode_control(CTRL_PING))
+                delays.append(min(self.heartbeat, self.heartbeat_timeout - silent))
+            else:
+                delays.append(self.heartbeat - silent)
+        if self.idle_timeout:
+            idle = now - peer.last_active
+            if peer.session is None: # 排隊中不算閒置，進入聊天室時重新計時
+                delays.append(self.idle_timeout)
+            elif idle >= self.idle_timeout:
+                self._reap(peer, "idle", f"超過 {self.idle_timeout} 秒沒有發言")
+                return
+            else:
+                delays.append(self.idle_timeout - idle)
+        if delays:
+            self.wheel.schedule(peer, min(delays))
+
+    # 沒有回應的連線直接中斷(之後可以在保留時間內接回)；閒置的client先告知原因，不保留座位
+    def _reap(self, peer, reason, note):
+        self.metrics.reaped.labels(reason).inc()
+        self.log(f"{peer.identifier} {note}，已中斷連線\n", tag="error")
+        if reason == "heartbeat":
+            peer.writer.abort()
+            return
+        peer.leaving = True
+        peer.send_control(CTRL_BYE, f"{note}，已離開聊天室\n")
+        peer.writer.close()
+
+    def _write_metrics(self):
+        try:
+            self.metrics.registry.dump(self.metrics_file)
+        except OSError as e:
+            print(f"[指標寫入失敗]: {e}")
+
+    # 被忽略的例外計數，依發生的位置分類
+    def _error(self, where):
+        self.metrics.errors.labels(where).inc()
+
+    def _call_soon(self, fn, *args):
+        if self.loop is None or self.loop.is_closed():
+            return
+        try:
+            self.loop.call_soon_threadsafe(fn, *args)
+        except RuntimeError:
+            pass
+
+    def _send_text(self, msg, full_msg, timestamp):
+        encoded = EncodedText(msg, full_msg)
+        for session in self.sessions.values():
+            if self.history:
+                self.history.add(session.room_id, self.name, self.local_ip, full_msg, timestamp / 1000)
+            try:
+                session.broadcast_message(self, msg, timestamp, encoded=encoded)
+            except Exception:
+                self._error("send_text")
+                self.log("[錯誤] 傳送失敗\n", tag="error")
+
+    def _send_file_offer(self, offer):
+        for session in self.sessions.values():
+            for member in session.members:
+                member.send_file_offer(self, offer)
+            if self.bus: # 其他節點的client不是連到這台server，需要明確的位址
+                self.bus.publish(session.room_id, "file", self, offer._replace(host=self.local_ip))
+
+    def _send_image(self, img_bytes):
+        try:
+            self._broadcast_image(list(self.sessions.values()), img_bytes, origin=self)
+        except Exception as e:
+            self._error("send_image")
+            self.log(f"[錯誤] 圖片傳送失敗: {e}\n", tag="error")
+
+    # 每個文字連線一個coroutine，負責排隊/進入聊天室與接收訊息
+    async def _handle_text_conn(self, reader, writer):
+        peer = Peer(reader, writer, writer.get_extra_info('peername'), next(self._conn_ids))
+        peer.on_progress = self._progress
+        peer.on_slow = self._peer_slow
+        peer.on_overflow = self._peer_overflow
+        peer.send_budget = self.send_budget
+        peer.slow_policy = self.slow_policy
+        peer.metrics = self.metrics
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        set_keepalive(writer.get_extra_info('socket'))
+        self._watch(peer)
+
+        # 流程:
+        # 1. 每段文字訊息都會先傳送第一段內容表示接下來訊息的長度
+        # 2. 持續接收訊息直到超過長度
+        # 第一段若是HELLO則之後改用frame協定讀取，讀完交握(含接回座位)才安排座位
+        # 舊版client連上後不會主動送資料，等LEGACY_WAIT秒沒有收到HELLO就先安排座位
+        # 排隊中的client也持續讀取，以便即時發現其斷線；期間的訊息先暫存
+        try:
+            try:
+                length_data = await asyncio.wait_for(reader.read_exact(4), LEGACY_WAIT)
+            except asyncio.TimeoutError:
+                self._admit(peer)
+                length_data = await reader.read_exact(4)
+            if length_data == MAGIC:
+                version = (await reader.read_exact(len(HELLO) - len(MAGIC)))[0]
+                if version != VERSION:
+                    self.log(f"[錯誤] {peer.identifier} 的協定版本({version})不相容，已中斷連線\n", tag="error")
+                    return
+                peer.framed = True
+                writer.write(HELLO)
+                peer = await asyncio.wait_for(self._handshake(peer), HANDSHAKE_TIMEOUT)
+                # 交握後才由負責這條連線的Peer告知token，接回座位時沿用原本的token
+                # CTRL_SESSION與交握的CTRL_COMPRESS回覆都不帶序號也不保留，序號只屬於會補送的訊息，
+                # 否則接回座位前佔用了新Peer的序號，client收到的序號會倒退
+                if self.resume_grace:
+                    peer.token = peer.token or secrets.token_bytes(16)
+                    peer.write(encode_session(peer.token, self.resume_grace))
+                if not peer.admitted:
+                    self._admit(peer)
+                await self._read_frames(peer)
+            else:
+                if not peer.admitted:
+                    self._admit(peer)
+                data = await reader.read_exact(checked_length(length_data, MAX_TEXT_LENGTH))
+                while True:
+                    if data:
+                        self._on_message(peer, "text", str(data, "utf-8", "replace"))
+                    data = await reader.read_message(limit=MAX_TEXT_LENGTH)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+        # zlib.error: 壓縮的文字無法解開；struct.error/ValueError: frame格式錯誤或超過上限
+        # 都視為協定錯誤中斷連線，不保留座位
+        except (zlib.error, struct.error, ValueError) as e:
+            (peer.resumed_as or peer).leaving = True
+            self.log(f"[錯誤] {peer.identifier} 協定錯誤({e})，已中斷連線\n", tag="error")
+        finally:
+            self._tasks.discard(task)
+            self._drop(peer.resumed_as or peer)
+
+    # 安排座位: 有空位時進入聊天室，否則排入隊伍
+    def _admit(self, peer):
+        peer.admitted = True
+        if self.bus:
+            # 先在本地排隊，Coordinator回覆座位(GRANT)或排隊位置(POSITION)
+            self.waiting.push(peer.conn_id, peer)
+            self.bus.join(peer.conn_id)
+            self._waiting_changed()
+        elif (session := self._find_room()) is not None:
+            self._activate(peer, session)
+        else:
+            self._waiting_changed()
+            self._send_position(peer, self.waiting.push(peer.conn_id, peer))
+
+    # 交握: HELLO之後的控制訊息(壓縮、縮圖、接回座位)，收到CTRL_READY為止
+    # 回傳之後負責這條連線的Peer(接回座位時為保留中的Peer)
+    async def _handshake(self, peer):
+        while True:
+            header, payload = await peer.reader.read_frame()
+            if header.frame_type != FRAME_CONTROL or not payload:
+                raise ProtocolError("交握完成前收到其他訊息")
+            if payload[0] == CTRL_READY:
+                return peer
+            peer = self._on_control(peer, payload)
+
+    # frame協定的接收迴圈
+    async def _read_frames(self, peer: Peer):
+        while True:
+            # payload指向接收緩衝區，需要保留的內容都在這一輪處理中複製出去
+            header, payload = await peer.reader.read_frame()
+            start = time.perf_counter()
+            frame_type, stream = header.frame_type, header.stream
+            if frame_type == FRAME_TEXT:
+                self._on_message(peer, "text", peer.codec.decode_text(header.flags, payload))
+            elif frame_type == FRAME_IMAGE_BEGIN:
+                peer.receiver.begin(stream, payload)
+                self._relay_begin(peer, stream, payload)
+            elif frame_type == FRAME_IMAGE:
+                self._on_image_chunk(peer, header.flags, stream, payload)
+            elif frame_type == FRAME_RESUME:
+                transfer = peer.outgoing.get(stream)
+                if transfer is not None:
+                    transfer.seek(OFFSET.unpack_from(payload)[0])
+            elif frame_type == FRAME_IMAGE_OFFER:
+                self._on_image_offer(peer, stream, payload)
+            elif frame_type == FRAME_IMAGE_ACCEPT:
+                future = peer.offers.get(stream)
+                if future is not None and not future.done():
+                    future.set_result(bytes(payload[:1]) == bytes([ACCEPT_HAVE]))
+            elif frame_type == FRAME_IMAGE_FETCH:
+                self._on_image_fetch(peer, payload)
+            elif frame_type == FRAME_CONTROL:
+                peer = self._on_control(peer, payload) # 接回座位後這條連線的訊息都屬於接回的Peer
+            # 其他種類目前server端不需處理
+            self.metrics.frames.labels(FRAME_NAMES.get(frame_type, "unknown")).inc()
+            self.metrics.frame_time.observe(time.perf_counter() - start)
+
+    # 控制訊息，回傳之後負責這條連線的Peer
+    def _on_control(self, peer, payload):
+        code = payload[0] if payload else 0
+        # client可以解壓縮，回覆後雙方開始壓縮較長的文字
+        if code == CTRL_COMPRESS and not peer.codec.enabled:
+            peer.codec.enabled = True
+            peer.write(encode_control(CTRL_COMPRESS))
+        elif code == CTRL_PREVIEW:
+            peer.previews = self.previews
+        elif code == CTRL_RESUME and peer.resumed_as is None:
+            return self._resume(peer, payload)
+        elif code == CTRL_BYE:
+            peer.leaving = True
+        elif code == CTRL_PING:
+            peer.write(encode_control(CTRL_PONG))
+        elif code == CTRL_FILE_OFFER:
+            self._on_file_offer(peer, decode_file_offer(payload))
+        # CTRL_PONG不需處理，收到任何資料時FrameProtocol都會更新last_recv；交握之後的CTRL_READY忽略
+        return peer
+
+    # 圖片片段: 寫入預先配置的緩衝區，同時直接轉送給同房間使用frame協定的成員
+    def _on_image_chunk(self, peer, flags, stream, payload):
+        transfer, ok = peer.receiver.chunk(stream, flags, payload)
+        if transfer is None:
+            return
+        if not ok:
+            peer.write(encode_resume(stream, transfer.received))
+            return
+        targets = peer.relays.get(stream)
+        if targets:
+            data = bytes(payload) # 複製一次後所有轉送對象共用
+            for target in targets:
+                member, member_stream = target
+                if member_stream is not None and not member.write(
+                        pack_header(FRAME_IMAGE, len(data), member_stream, flags, sender=peer.sender_id), data):
+                    target[1] = None # 對方太慢，這張圖片改在收完後以背壓控制的方式補送
+        percent = progress_percent(transfer)
+        if percent is not None:
+            self._progress(peer, "recv", percent)
+        if transfer.complete:
+            targets = peer.relays.pop(stream, None)
+            self._on_message(peer, "image", (transfer.buf, targets is not None))
+            for member, member_stream in targets or ():
+                if member_stream is None and member.session is peer.session and not member.writer.is_closing():
+                    member.send_image(transfer.buf, peer)
+
+    # client詢問是否已有某張圖片: 快取中有就不必上傳，直接當作收到該檔案
+    # 沒有時回覆ACCEPT_SEND，之後照常收到BEGIN與片段
+    def _on_image_offer(self, peer, stream, payload):
+        digest, _, _ = decode_image_offer(payload)
+        path = self.content_store.path(digest) if self.content_store else None
+        peer.write(encode_image_accept(stream, path is not None))
+        if path is not None:
+            self._on_message(peer, "image", (path, False))
+
+    # client點開縮圖時要求原圖: 從快取串流給它，快取中沒有(例如已被刪除)時以同一種frame回覆
+    def _on_image_fetch(self, peer, payload):
+        digest = decode_image_fetch(payload)
+        path = self.content_store.path(digest) if self.content_store else None
+        if path is None:
+            peer.write(encode_image_fetch(digest))
+            return
+        self.metrics.previews.labels("fetch").inc()
+        self._spawn(peer.stream_image(path, digest=digest))
+
+    # client分享檔案: 填上它的位址後轉送給同房間的其他人，檔案內容由接收端直接向它下載
+    def _on_file_offer(self, peer, offer):
+        if peer.session is None:
+            return
+        offer = offer._replace(host=peer.addr[0])
+        self.log(f"{self._room_label(peer.session)}{peer.display_name} 分享檔案 {offer.name}"
+                 f"({offer.size:,} bytes)\n", tag="info")
+        if self.on_file_offer:
+            self.on_file_offer(peer, offer)
+        for member in peer.session.members:
+            if member is not peer:
+                member.send_file_offer(peer, offer)
+        if self.bus:
+            self.bus.publish(peer.session.room_id, "file", peer, offer)
+
+    # 上傳開始時決定要邊收邊轉送的對象(排隊中的client等完整收到後再處理)
+    # 先收縮圖的成員不轉送片段，收完後才送縮圖
+    def _relay_begin(self, peer, stream, payload):
+        if peer.session is None:
+            return
+        targets = []
+        for member in peer.session.members:
+            if member is not peer and member.framed and not member.previews:
+                member_stream = member.stream_ids.next()
+                member.introduce(peer)
+                if member.write(encode_frame(FRAME_IMAGE_BEGIN, payload, member_stream, sender=peer.sender_id)):
+                    targets.append([member, member_stream])
+                else:
+                    targets.append([member, None])
+        peer.relays[stream] = targets
+
+    # 對方接收太慢時提醒，恢復時一併回報期間丟棄的訊息數
+    def _peer_slow(self, peer, slow):
+        if slow:
+            self.log(f"[注意] {peer.identifier} 接收速度過慢，訊息暫存中...\n", tag="error")
+            return
+        dropped, peer.dropped = peer.dropped, 0
+        note = f"(期間丟棄 {dropped} 則訊息)" if dropped else ""
+        self.log(f"{peer.identifier} 已恢復正常接收{note}\n", tag="system")
+
+    def _peer_overflow(self, peer):
+        self.metrics.overflows.inc()
+        self.log(f"[錯誤] {peer.identifier} 暫存資料超過上限，已中斷連線\n", tag="error")
+
+    def _progress(self, peer, kind, percent):
+        if self.on_progress:
+            self.on_progress(peer, kind, percent)
+
+    # 聊天室內的client直接處理，排隊中的先暫存
+    def _on_message(self, peer, kind, data):
+        peer.last_active = time.monotonic()
+        if peer.session is None:
+            peer.pending.append((kind, data))
+        elif kind == "text":
+            self._on_text(peer, data)
+        else:
+            self._on_image(peer, *data)
+
+    # 找一間還有空位的房間，必要時開新房間；全部額滿時回傳None
+    def _find_room(self):
+        for session in self.sessions.values():
+            if not session.is_full():
+                return session
+        if len(self.sessions) >= self.max_rooms:
+            return None
+        room_id = next(i for i in range(1, self.max_rooms + 1) if i not in self.sessions)
+        session = Session(room_id, self.room_size)
+        self.sessions[room_id] = session
+        return session
+
+    def _room_label(self, session):
+        return f"[房間 {session.room_id}] " if self.max_rooms > 1 else ""
+
+    # 讓client進入聊天室
+    def _activate(self, peer: Peer, session: Session):
+        session.members.append(peer)
+        peer.session = session
+        peer.last_active = time.monotonic()
+        if self.on_client_connected:
+            self.on_client_connected(peer)
+        self.log(f"{self._room_label(session)}Client {peer.addr} 已連線！\n", tag="info")
+        try:
+            peer.send_control(CTRL_WELCOME, WELCOME_MSG)
+        except Exception:
+            self._error("control")
+        if self.replay and self.history:
+            self._spawn(self._replay(peer, session))
+        pending, peer.pending = peer.pending, []
+        for kind, data in pending:
+            self._on_message(peer, kind, data)
+
+    # 重新連線的client補看最近的訊息，查詢在executor內進行，合併成幾則送出
+    async def _replay(self, peer, session):
+        def query():
+            if not self.history.has_peer(peer.addr[0]):
+                return []
+            return self.history.recent(self.replay, room=session.room_id)
+        messages = await self.loop.run_in_executor(None, query)
+        if not messages or peer.session is not session:
+            return
+        lines = [f"----- 最近 {len(messages)} 則訊息 -----\n"]
+        lines += [f"{datetime.fromtimestamp(m.ts).strftime('[%m/%d %H:%M:%S]')} {m.body}" for m in messages]
+        lines.append("-----\n")
+        # 每則不超過MAX_TEXT_LENGTH，合併後仍在對方接收frame的上限內
+        batches, batch, size = [], [], 0
+        for line in lines:
+            if batch and size + len(line.encode()) > MAX_TEXT_LENGTH:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(line)
+            size += len(line.encode())
+        batches.append(batch)
+        try:
+            for batch in batches:
+                peer.send_text("".join(batch))
+        except Exception:
+            self._error("replay")
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # 收到房間內client的訊息：寫入紀錄、通知前端並轉送給同房間的其他人
+    # frame協定的client只送出內容，舊版client送來的是已包含名稱的「Client(ip):內容\n」
+    def _on_text(self, peer, message):
+        timestamp = now_ms()
+        line = f"{peer.display_name}:{message}\n" if peer.framed else message
+        self._write_log(f"{self._now()} {self._room_label(peer.session)}{line}")
+        if self.history:
+            self.history.add(peer.session.room_id, peer.identifier, peer.addr[0], line, timestamp / 1000)
+        if self.on_text:
+            self.on_text(peer, line)
+        try:
+            if peer.framed:
+                peer.session.broadcast_message(peer, message, timestamp, exclude=peer)
+            else:
+                peer.session.broadcast_text(message, exclude=peer)
+        except Exception:
+            self._error("broadcast_text")
+        if self.bus:
+            self.bus.publish(peer.session.room_id, "text" if peer.framed else "raw", peer, message, timestamp)
+
+    def _on_image(self, peer, img_data, relayed=False):
+        sessions = [peer.session]
+        # 收到的圖片存入快取，之後同一張圖片只需要交換hash(要產生縮圖時一併存入)
+        if self.content_store and not isinstance(img_data, str) and not self._wants_preview(sessions, peer):
+            self.loop.run_in_executor(None, self.content_store.put, img_data)
+        if self.on_image:
+            self.on_image(peer, img_data)
+        try:
+            self._broadcast_image(sessions, img_data, exclude=peer, skip_framed=relayed, origin=peer)
+        except Exception:
+            self._error("broadcast_image")
+        if self.bus:
+            self._spawn(self._publish_image(peer, peer.session.room_id, img_data))
+
+    def _wants_preview(self, sessions, exclude=None):
+        return self.previews and any(m.previews and m is not exclude for s in sessions for m in s.members)
+
+    # 有成員要先收縮圖時，先在executor準備好縮圖(每張圖片只產生一次)再一起送出，否則直接送原圖
+    def _broadcast_image(self, sessions, source, exclude=None, skip_framed=False, origin=None):
+        if not self._wants_preview(sessions, exclude):
+            for session in sessions:
+                session.broadcast_image(source, exclude=exclude, skip_framed=skip_framed, origin=origin)
+            return
+        self._spawn(self._broadcast_preview(sessions, source, exclude, skip_framed, origin))
+
+    async def _broadcast_preview(self, sessions, source, exclude, skip_framed, origin):
+        try:
+            preview = await self.loop.run_in_executor(None, self._load_preview, source)
+        except Exception: # 不是Pillow能解開的圖片，照常送原圖
+            self._error("preview")
+            preview = None
+        for session in sessions:
+            try:
+                session.broadcast_image(source, exclude, skip_framed, origin, preview)
+            except Exception:
+                self._error("broadcast_image")
+
+    # 原圖存入快取(之後client要求時從這裡送出)，縮圖產生過就直接讀出(executor內執行)
+    # 縮圖沒有比原圖小時回傳None
+    def _load_preview(self, source):
+        digest = self.content_store.put(source)
+        path = self.content_store.variant(digest, PREVIEW)
+        if path is not None:
+            data = read_file(path)
+        else:
+            data = make_preview(source)
+            self.content_store.put_variant(digest, PREVIEW, data)
+        if not data or OFFER.size + len(data) > MAX_FRAME_SIZE: # 縮圖必須放得進一個frame
+            return None
+        total = os.path.getsize(source) if isinstance(source, str) else len(source)
+        return ImagePreview(digest, total, data)
+
+    # 其他節點不一定在同一台機器上，快取中的圖片也讀出內容再轉送
+    async def _publish_image(self, peer, room_id, img_data):
+        if isinstance(img_data, str):
+            try:
+                img_data = await self.loop.run_in_executor(None, read_file, img_data)
+            except OSError:
+                self._error("bus")
+                return
+        self.bus.publish(room_id, "image", peer, bytes(img_data))
+
+    # Coordinator的回覆與其他節點轉送來的訊息
+    def _on_bus_message(self, kind, room_id, conn_id, body):
+        if self._closing:
+            return
+        if kind == BUS_GRANT:
+            # 已經離開的client不必處理，它的LEAVE會讓Coordinator收回座位
+            peer = self.waiting.remove(conn_id)
+            if peer is None:
+                return
+            peer.sender_id = SENDER.unpack(body)[0] # 整個叢集內不重複
+            session = self.sessions.get(room_id)
+            if session is None:
+                session = self.sessions[room_id] = Session(room_id, self.room_size)
+            self._activate(peer, session)
+            self._waiting_changed()
+        elif kind == BUS_POSITION:
+            peer = self.waiting.get(conn_id)
+            if peer is not None:
+                self._send_position(peer, POSITION.unpack(body)[0])
+        elif kind == BUS_MSG and room_id in self.sessions:
+            self._on_remote_message(self.sessions[room_id], body)
+
+    def _on_remote_message(self, session, body):
+        try:
+            kind, sender_id, display_name, data, timestamp = decode_msg(body)
+        except (ValueError, struct.error): # 格式錯誤的訊息直接忽略
+            self._error("bus")
+            return
+        origin = RemoteOrigin(sender_id, display_name)
+        try:
+            if kind == "text":
+                session.broadcast_message(origin, data, timestamp)
+            elif kind == "raw":
+                session.broadcast_text(data)
+            elif kind == "file":
+                for member in session.members:
+                    member.send_file_offer(origin, data)
+            else:
+                self._broadcast_image([session], data, origin=origin)
+        except Exception:
+            self._error("bus")
+
+    # client斷線時清除狀態，若是聊天室內的client則讓排隊者補上空位
+    # 可以恢復連線的client先保留座位resume_grace秒，逾時才真正離開
+    def _drop(self, peer: Peer):
+        peer.close()
+        self.wheel.cancel(peer)
+        summary = peer.codec.summary()
+        if summary:
+            self.log(f"{peer.identifier} {summary}\n", tag="system")
+        if peer.token and peer.session is not None and not peer.leaving and self.resume_grace and not self._closing:
+            peer.detached = True
+            self.detached[peer.token] = peer
+            peer.expire_timer = self.loop.call_later(self.resume_grace, self._expire, peer)
+            self.log(f"{self._room_label(peer.session)}{peer.identifier} 連線中斷，保留座位 {self.resume_grace} 秒\n",
+                     tag="system")
+            return
+        self._leave(peer)
+
+    def _expire(self, peer):
+        if self.detached.get(peer.token) is peer:
+            del self.detached[peer.token]
+            self._leave(peer)
+
+    # 讓出座位或離開排隊；quiet=True時不寫紀錄(連線被接回保留中的座位)
+    def _leave(self, peer, quiet=False):
+        if not peer.admitted: # 交握完成前就斷線
+            return
+        session = peer.session
+        if session is not None:
+            peer.session = None
+            session.members.remove(peer)
+            if not session.members:
+                self.sessions.pop(session.room_id, None)
+            if not quiet:
+                self.log(f"{self._room_label(session)}(目前連線之Client已離線)\n", tag="system")
+            if not self._closing and not self.bus:
+                self._fill_rooms()
+        elif self.waiting.remove(peer.conn_id) is not None:
+            self._waiting_changed()
+            if not quiet:
+                self.log(f"({peer.identifier} 離開等待隊列。)\n", tag="system")
+        if self.bus:
+            self.bus.leave(peer.conn_id)
+
+    # client以token要求接回斷線前的座位: 不必重新排隊，只補送斷線期間沒收到的訊息
+    # 通常在交握時處理，這條新連線還沒有座位；HELLO來得太晚(已被當作舊版client安排座位)時先讓出來
+    # 之後由保留中的Peer接手
+    def _resume(self, peer, payload):
+        token, last_seq = decode_session_resume(payload)
+        held = self.detached.pop(token, None)
+        if held is None:
+            peer.send_control(CTRL_RESUME, "無法恢復先前的連線(已逾時)，以新的連線加入\n")
+            return peer
+        held.expire_timer.cancel()
+        self._leave(peer, quiet=True)
+        held.take_over(peer)
+        count, missing = held.replay_since(last_seq)
+        note = "，部分較早的訊息已無法補送" if missing else ""
+        held.send_control(CTRL_RESUME, f"已恢復先前的連線，補送 {count} 則訊息{note}\n")
+        self.metrics.resumes.inc()
+        self._watch(held)
+        self.log(f"{self._room_label(held.session)}{held.identifier} 已恢復連線(補送 {count} 則)\n", tag="info")
+        return held
+
+    # 依排隊順序把client放進有空位的房間
+    def _fill_rooms(self):
+        promoted = False
+        while self.waiting:
+            session = self._find_room()
+            if session is None:
+                break
+            self._activate(self.waiting.pop(), session)
+            promoted = True
+        if promoted:
+            self._waiting_changed()
+
+    # 排隊名單變動時不立即處理，同一輪事件迴圈內的多次變動合併成一次批次更新
+    def _waiting_changed(self):
+        if self._waiting_dirty or self._closing:
+            return
+        self._waiting_dirty = True
+        self.loop.call_soon(self._flush_waiting)
+
+    # 把新的排隊位置一次推送給所有位置有變動的client，並通知前端
+    # 叢集模式下的排隊位置由Coordinator通知(BUS_POSITION)
+    def _flush_waiting(self):
+        self._waiting_dirty = False
+        if not self.bus:
+            for peer, position in self.waiting.changed_positions():
+                self._send_position(peer, position)
+        if self.on_waiting_changed:
+            self.on_waiting_changed([p.identifier for p in self.waiting])
+
+    def _send_position(self, peer, position):
+        try:
+            peer.send_control(CTRL_QUEUE, f"您是第 {position} 位等待中，請稍候...\n")
+        except Exception:
+            self._error("control")
+
+    # image port連入時，配對給聊天室內尚未建立圖片連線的client(優先配對相同IP)
+    # 使用frame協定的client不需要圖片連線
+    def _match_image_peer(self, addr):
+        candidates = [m for session in self.sessions.values() for m in session.members
+                      if m.image_writer is None and not m.framed]
+        for peer in candidates:
+            if peer.addr[0] == addr[0]:
+                return peer
+        return candidates[0] if candidates else None
+
+    async def _handle_image_conn(self, reader, writer):
+        peer = self._match_image_peer(writer.get_extra_info('peername'))
+        if peer is None:
+            writer.close()
+            return
+        peer.image_writer = writer
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.log(f"{peer.addr} 圖片 socket 已連接\n", tag="info")
+        try:
+            while True:
+                # 整張圖片直接收進獨立的緩衝區
+                img_data = await reader.read_message(keep=True, limit=MAX_IMAGE_SIZE)
+                self._on_message(peer, "image", (img_data, False))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        except ValueError as e: # 圖片超過MAX_IMAGE_SIZE
+            self.log(f"[錯誤] {peer.addr} 協定錯誤({e})，已中斷圖片連線\n", tag="error")
+        finally:
+            self._tasks.discard(task)
+            if peer.image_writer is writer:
+                peer.image_writer = None
+            writer.close()
+
+    def _now(self):
+        return datetime.now().strftime("[%H:%M:%S]")
+
+    # server會保存文字聊天紀錄，實際寫檔在LogWriter的背景thread
+    def _write_log(self, line):
+        if self.log_writer:
+            self.log_writer.write(line)
+
+
+# 無GUI模式下盡量提高可開啟的檔案數上限，讓單一process能維持大量閒置連線
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError: # Windows沒有resource模組
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard and hard != resource.RLIM_INFINITY:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def run_headless(host='0.0.0.0', text_port=10000, image_port=10001, max_rooms=1, room_size=1,
+                 log_fsync=FSYNC_ROTATE, replay=0, send_budget=SEND_BUDGET, slow_policy=POLICY_DISCONNECT,
+                 metrics_port=None, metrics_file=None, bus=None, resume_grace=RESUME_GRACE,
+                 heartbeat=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 previews=True):
+    raise_fd_limit()
+    core = ChatCore(host, text_port, image_port, max_rooms=max_rooms, room_size=room_size, log_fsync=log_fsync,
+                    replay=replay, send_budget=send_budget, slow_policy=slow_policy, metrics_port=metrics_port,
+                    metrics_file=metrics_file, bus=bus, resume_grace=resume_grace, heartbeat=heartbeat,
+                    heartbeat_timeout=heartbeat_timeout, idle_timeout=idle_timeout, previews=previews)
+    core.on_log = lambda line, tag: print(line, end="")
+    core.on_text = lambda peer, message: print(message, end="")
+    core.on_image = lambda peer, img: print(f"[圖片] {peer.identifier} "
+                                            f"({os.path.getsize(img) if isinstance(img, str) else len(img)} bytes)")
+    try:
+        core.serve_forever()
+    except KeyboardInterrupt:
+        print("\n伺服器已關閉。")
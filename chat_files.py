@@ -0,0 +1,131 @@
+import hashlib
+import mmap
+import os
+import secrets
+import socket
+import struct
+import threading
+import time
+from chat_protocol import FileOffer
+from chat_store import DIGEST_SIZE, content_digest
+
+# 任意檔案的點對點傳輸: 檔案內容不經過聊天連線，也不經過server
+# 1. 分享端計算內容hash，開一個暫時的port(FileShare)，在聊天室送出CTRL_FILE_OFFER(token、hash、大小、port、檔名)
+# 2. server把offer轉送給同房間的其他人，client分享時填上該client的位址
+# 3. 接收端直接連到分享端，送出token(與起始offset)；分享端以sendfile從磁碟送出，不經過使用者空間
+# 4. 接收端預先把檔案延伸到完整大小，一段一段mmap後以recv_into直接收進檔案，收完的部分同時計算hash
+# 兩端的記憶體用量與檔案大小無關；hash不符時刪除收到的檔案
+
+SHARE_TIMEOUT = 600 # 分享的檔案保留多少秒可供下載
+CONNECT_TIMEOUT = 10
+RECV_TIMEOUT = 60 # 對方多少秒沒有送來資料時放棄
+MAP_WINDOW = 16 * 1024 * 1024 # 接收端每次mmap的範圍，需為mmap.ALLOCATIONGRANULARITY的倍數
+REQUEST = struct.Struct('!16sQ') # 接收端連上後送出: token + 起始offset
+
+
+def format_size(size):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:,} {unit}" if unit == "bytes" else f"{size:,.1f} {unit}"
+        size /= 1024
+
+
+# 分享中的檔案，每個連上來的接收端一個thread，以socket.sendfile(os.sendfile)送出
+# on_sent(addr, error): 送完或失敗時在傳送thread上呼叫，error為None代表成功
+class FileShare:
+    def __init__(self, path, host='0.0.0.0', timeout=SHARE_TIMEOUT, on_sent=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.token = secrets.token_bytes(16)
+        self.digest = None
+        self.timeout = timeout
+        self.on_sent = on_sent
+        self._sock = socket.create_server((host, 0))
+        self._sock.settimeout(1.0) # 定期檢查是否已逾時或被關閉
+        self.port = self._sock.getsockname()[1]
+        self._closed = threading.Event()
+
+    # 計算內容hash並開始接受連線；會整個讀過檔案一次，請在背景thread呼叫
+    def start(self):
+        self.digest = content_digest(self.path)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    # host見FileOffer，server分享時為空字串
+    def offer(self, host=""):
+        return FileOffer(self.token, self.digest, self.size, self.port, host, self.name)
+
+    def close(self):
+        self._closed.set()
+
+    def _serve(self):
+        deadline = time.monotonic() + self.timeout
+        try:
+            while not self._closed.is_set() and time.monotonic() < deadline:
+                try:
+                    conn, addr = self._sock.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self._send, args=(conn, addr), daemon=True).start()
+        finally:
+            self._sock.close()
+
+    def _send(self, conn, addr):
+        error = None
+        try:
+            with conn:
+                conn.settimeout(RECV_TIMEOUT)
+                request = b""
+                while len(request) < REQUEST.size:
+                    data = conn.recv(REQUEST.size - len(request))
+                    if not data:
+                        raise ConnectionError("connection closed")
+                    request += data
+                token, offset = REQUEST.unpack(request)
+                if not secrets.compare_digest(token, self.token):
+                    raise PermissionError("token不符")
+                with open(self.path, "rb") as f:
+                    conn.sendfile(f, offset, self.size - offset)
+        except (OSError, ValueError) as e:
+            error = e
+        if self.on_sent:
+            self.on_sent(addr, error)
+
+
+# 從分享端下載offer描述的檔案到path，host為分享端位址
+# on_progress(percent): 百分比有變動時在呼叫端thread上呼叫
+# 先寫到path.part，hash相符才改名為path；失敗時刪除並丟出例外
+def receive_file(offer: FileOffer, host, path, on_progress=None, window=MAP_WINDOW):
+    tmp = path + ".part"
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    last_percent = -1
+    try:
+        with socket.create_connection((host, offer.port), timeout=CONNECT_TIMEOUT) as sock, open(tmp, "w+b") as f:
+            sock.settimeout(RECV_TIMEOUT)
+            sock.sendall(REQUEST.pack(offer.token, 0))
+            f.truncate(offer.size)
+            received = 0
+            while received < offer.size:
+                length = min(window, offer.size - received)
+                with mmap.mmap(f.fileno(), length, offset=received) as mm, memoryview(mm) as view:
+                    pos = 0
+                    while pos < length:
+                        n = sock.recv_into(view[pos:])
+                        if not n:
+                            raise ConnectionError("分享端已中斷連線")
+                        pos += n
+                        percent = (received + pos) * 100 // offer.size
+                        if percent != last_percent and on_progress:
+                            last_percent = percent
+                            on_progress(percent)
+                    digest.update(view)
+                received += length
+        if digest.hexdigest() != offer.digest:
+            raise ValueError("檔案內容hash不符")
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
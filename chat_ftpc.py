@@ -1,11 +1,31 @@
+import os
 import socket
 import threading
+import time
 import tkinter as tk
-from tkinter.scrolledtext import ScrolledText
 from tkinter import simpledialog, messagebox, filedialog, Toplevel, Canvas
-from PIL import Image, ImageTk
-import io
+from PIL import ImageTk
+import os
 from datetime import datetime
+from chat_protocol import (MAGIC, VERSION, HELLO, HEADER, OFFSET, FRAME_TEXT, FRAME_IMAGE, FRAME_IMAGE_BEGIN,
+                           FRAME_RESUME, FRAME_CONTROL, FRAME_IMAGE_OFFER, FRAME_IMAGE_ACCEPT, FRAME_IMAGE_PREVIEW,
+                           FRAME_IMAGE_FETCH, ACCEPT_HAVE, CTRL_WELCOME, CTRL_MEMBER, CTRL_COMPRESS, CTRL_SESSION,
+                           CTRL_BYE, CTRL_PING, CTRL_PONG, CTRL_FILE_OFFER, CTRL_PREVIEW, CTRL_READY, SENDER_NONE,
+                           encode_control, encode_file_offer, decode_file_offer, encode_resume, encode_session_resume,
+                           decode_control, decode_member, decode_session, decode_image_offer, encode_image_accept,
+                           decode_image_preview, encode_image_fetch, decode_image_fetch, MAX_TEXT_LENGTH,
+                           checked_length, FrameReader, Sequence, StreamIds, TextCodec)
+from chat_transfer import (OFFER_TIMEOUT, MAX_IMAGE_SIZE, MAX_TRANSFERS, OutgoingTransfer, TransferReceiver,
+                           progress_percent)
+from chat_outbox import SocketOutbox
+from chat_heartbeat import set_keepalive
+from chat_files import FileShare, format_size, receive_file
+
+from chat_images import ImagePipeline, ImageStore
+from chat_ui import TEXT_IMAGE_GAP, UiQueue
+from chat_view import MessageView
+
+RECONNECT_DELAY = 1000 # 連線意外中斷後多久自動重新連線一次(毫秒)
 
 class ChatClient:
     def __init__(self):
@@ -14,11 +34,35 @@ class ChatClient:
         self.server_image_port = 10001
         self.text_socket = None
         self.image_socket = None
+        # 送出的資料都先放進佇列，由writer thread負責sendall，server太慢時Tk主執行緒也不會卡住
+        self.outbox = None
+        self.image_outbox = None
         self.local_ip = self.get_local_ip()
-        self.image_refs = []
         self.selected_image = None
+        self.last_text_time = 0 # 最近一次收到文字訊息的時間，用來判斷緊接著的圖片是否屬於同一則訊息
+        self.framed = False # 已送出HELLO，文字與圖片都改用frame走同一條連線
+        self.stream_ids = StreamIds()
+        self.seq = Sequence() # 送出的文字訊息序號
+        self.members = {} # 傳送者id -> 名稱(server以CTRL_MEMBER告知)
+        self.codec = TextCodec() # 文字壓縮，每次連線重新建立
+        self.outgoing = {} # transfer id -> 傳送中的OutgoingTransfer
+        self.offers = {} # 已送出OFFER的transfer id -> [Event, server是否已有該圖片]
+        self.fetching = set() # 點開縮圖後向server要求、還沒收完的原圖digest
+        # 恢復連線: server給的token與保留秒數，斷線後在保留時間內重新連線可以接回座位並補收漏掉的訊息
+        self.session_token = None
+        self.session_grace = 0
+        self.session_server = None # token所屬的(server ip, port)
+        self.last_seq = 0 # 最後收到的frame序號
+        self.disconnected_at = 0
+        self.user_disconnect = False # 按下中斷連線，不自動重連
 
+        self.image_store = ImageStore() # 縮圖LRU + 原圖磁碟快取，取代保留所有圖片的image_refs
         self.setup_gui()
+        # 接收thread的畫面更新都放進同一個佇列，由Tk主執行緒定期一次處理
+        self.ui = UiQueue(self.window)
+        self.ui.start()
+        # 圖片解碼/縮圖在背景thread進行
+        self.image_pipeline = ImagePipeline(self.window, self.image_store, post=self.ui.post)
 
     # 自動抓取本地IP位址
     def get_local_ip(self):
@@ -50,6 +94,10 @@ class ChatClient:
         tk.Label(top_frame, text="本機 IP:").grid(row=0, column=0, sticky="w", padx=5)
         tk.Label(top_frame, text=self.local_ip).grid(row=0, column=1, sticky="w")
 
+        # 單一連線模式: 文字與圖片共用一條連線，連線到舊版server時需取消勾選
+        self.use_frames_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(top_frame, text="單一連線模式", variable=self.use_frames_var).grid(row=0, column=2, columnspan=2, sticky="w")
+
         tk.Label(top_frame, text="Server IP:").grid(row=1, column=0, sticky="w", padx=5)
         self.server_ip_entry = tk.Entry(top_frame)
         self.server_ip_entry.insert(0, "127.0.0.1")
@@ -68,8 +116,9 @@ class ChatClient:
         self.server_text_port = 10000
 
         # 中間訊息視窗
-        self.log_text = ScrolledText(self.window, width=50, height=20)
-        self.log_text.grid(row=1, column=0, sticky="nsew")
+        # 只保留畫面附近訊息的訊息框，聊天再久插入與捲動的成本都不會增加
+        self.log_view = MessageView(self.window, self.image_store, self.show_full_image, width=50, height=20)
+        self.log_view.grid(row=1, column=0, sticky="nsew")
 
         # 下層輸入與傳送
         bottom_frame = tk.Frame(self.window)
@@ -80,10 +129,15 @@ class ChatClient:
         self.input_text = tk.Text(bottom_frame, height=3)
         self.input_text.grid(row=0, column=1, sticky="ew")
         tk.Button(bottom_frame, text="傳送", command=self.send_message).grid(row=0, column=2, padx=5)
+        tk.Button(bottom_frame, text="傳送檔案", command=self.share_file).grid(row=0, column=3, padx=5)
 
         self.img_label = tk.Label(self.window)
         self.img_label.grid(row=3, column=0, pady=5)
 
+        # 圖片傳送/接收進度
+        self.progress_label = tk.Label(self.window, fg="gray")
+        self.progress_label.grid(row=4, column=0)
+
     # client連線按鈕操作(嘗試和輸入欄位位址之Server IP和Port連線)
     def connect(self):
         self.server_ip = self.server_ip_entry.get().strip()
@@ -94,74 +148,205 @@ class ChatClient:
             return
         try:
             self.connect_button.config(state="disabled")
+            self.user_disconnect = False
             self.text_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.text_socket.connect((self.server_ip, self.server_text_port))
-            
+            set_keepalive(self.text_socket) # server主機消失時也能發現，不會一直等在recv
+            if self.use_frames_var.get():
+                self.codec = TextCodec()
+                # 表示可以接收壓縮的文字，圖片先收server產生的縮圖，點開時才下載原圖
+                hello = HELLO + encode_control(CTRL_COMPRESS) + encode_control(CTRL_PREVIEW)
+                self.fetching = set()
+                if self.can_resume():
+                    # 接回原本的座位時server記得已告知過的傳送者名稱，members保留
+                    hello += encode_session_resume(self.session_token, self.last_seq)
+                    self.log("嘗試恢復先前的連線...\n", tag="system")
+                else:
+                    self.members = {}
+                    self.session_token = None
+                # 交握結束，server之後才安排座位
+                self.text_socket.sendall(hello + encode_control(CTRL_READY))
+                self.framed = True
+            self.outbox = self.create_outbox(self.text_socket)
+
             self.log(f"已連線到 Server {self.server_ip}:{self.server_text_port}\n", tag="info")
             threading.Thread(target=self.receive_text, daemon=True).start()
         except Exception as e:
             self.log(f"[錯誤] 無法連線到 Server: {e}\n", tag="error")
 
+    def can_resume(self):
+        return (self.session_token is not None and self.session_server == (self.server_ip, self.server_text_port)
+                and time.monotonic() - self.disconnected_at < self.session_grace)
+
+    # 連線意外中斷時自動重新連線一次，保留時間內會接回原本的座位
+    def reconnect(self):
+        if self.user_disconnect or self.text_socket is None or not self.can_resume():
+            return
+        self.close_sockets()
+        self.connect()
+
+    # 送出佇列，server太慢或佇列已滿時在訊息框提示
+    def create_outbox(self, sock):
+        return SocketOutbox(sock, on_slow=lambda slow: self.ui.post(self.show_slow, slow),
+                            on_error=lambda e: self.ui.post(self.log, f"[錯誤] 傳送失敗: {e}\n", "error"))
+
+    def show_slow(self, slow):
+        if slow:
+            self.log("[注意] 與 server 的連線緩慢，訊息暫存中...\n", tag="error")
+        else:
+            self.log("與 server 的連線已恢復\n", tag="system")
+
     # 文字訊息接收處理
     def receive_text(self):
+        framed = False # 收到server的HELLO回覆後改用frame協定讀取
+        receiver = TransferReceiver()
+        fetches = {} # server送來的原圖transfer id -> digest(之前點開縮圖時要求的)
+        reader = FrameReader(self.text_socket) # 以recv_into讀進預先配置的緩衝區
         while True:
             # 流程:
             # 1. 每段文字訊息都會先傳送第一段內容表示接下來訊息的長度
             # 2. 持續接收訊息直到超過長度
-            # 不論多長的訊息都能進行傳輸           
+            # 不論多長的訊息都能進行傳輸
             try:
-                length_data = self.text_socket.recv(4)
-                if not length_data:
-                    break
-                length = int.from_bytes(length_data, 'big')
-                data = b''
-                while len(data) < length:
-                    chunk = self.text_socket.recv(length-len(data))
-                    if not chunk:
+                if framed:
+                    header, payload = reader.read_frame()
+                    frame_type, stream = header.frame_type, header.stream
+                    # 序號只會增加；不帶序號(0)的控制訊息與較舊的序號不影響要求補送的位置
+                    if header.seq > self.last_seq:
+                        self.last_seq = header.seq
+                    if frame_type == FRAME_TEXT:
+                        # 標頭帶有傳送者id時內容不含名稱，由之前收到的CTRL_MEMBER查表
+                        message = self.codec.decode_text(header.flags, payload)
+                        if header.sender != SENDER_NONE:
+                            message = f"{self.sender_name(header.sender)}:{message}\n"
+                        self.on_server_text(message, header.timestamp)
+                    elif frame_type == FRAME_IMAGE_BEGIN:
+                        receiver.begin(stream, payload)
+                    elif frame_type == FRAME_IMAGE:
+                        transfer, ok = receiver.chunk(stream, header.flags, payload)
+                        if transfer is None:
+                            continue
+                        if not ok:
+                            self.outbox.put(encode_resume(stream, transfer.received))
+                            continue
+                        percent = progress_percent(transfer)
+                        if percent is not None:
+                            self.ui.post(self.show_progress, "recv", percent)
+                        if transfer.complete and stream in fetches:
+                            self.open_fetched(fetches.pop(stream), transfer.buf)
+                        elif transfer.complete:
+                            self.display_image(transfer.buf, sender=self.sender_name(header.sender), block=True)
+                    elif frame_type == FRAME_RESUME:
+                        outgoing = self.outgoing.get(stream)
+                        if outgoing is not None:
+                            outgoing.seek(OFFSET.unpack_from(payload)[0])
+                    elif frame_type == FRAME_IMAGE_OFFER:
+                        # server詢問是否已有這張圖片，本機快取中有就直接顯示不必再傳
+                        digest, _, _ = decode_image_offer(payload)
+                        path = self.image_store.original(digest)
+                        self.outbox.put(encode_image_accept(stream, path is not None))
+                        if digest in self.fetching: # 之前要求的原圖
+                            if path is not None:
+                                self.open_fetched(digest, path)
+                            else:
+                                fetches[stream] = digest
+                        elif path is not None:
+                            self.display_image(path, sender=self.sender_name(header.sender), block=True)
+                    elif frame_type == FRAME_IMAGE_PREVIEW:
+                        # server產生的縮圖，本機已經有原圖時直接用原圖
+                        digest, _, data = decode_image_preview(payload)
+                        path = self.image_store.original(digest)
+                        self.display_image(path or data, sender=self.sender_name(header.sender), block=True,
+                                           preview_of=None if path else digest)
+                    elif frame_type == FRAME_IMAGE_FETCH: # server已經沒有這張原圖
+                        self.fetching.discard(decode_image_fetch(payload))
+                        self.ui.post(self.log, "[錯誤] Server 已無法提供這張圖片的原圖\n", "error")
+                    elif frame_type == FRAME_IMAGE_ACCEPT:
+                        answer = self.offers.get(stream)
+                        if answer is not None:
+                            answer[1] = bytes(payload[:1]) == bytes([ACCEPT_HAVE])
+                            answer[0].set()
+                    elif frame_type == FRAME_CONTROL:
+                        if payload[0] == CTRL_MEMBER:
+                            sender, name = decode_member(payload)
+                            self.members[sender] = name
+                            continue
+                        if payload[0] == CTRL_COMPRESS: # server也支援，之後較長的文字會壓縮後送出
+                            self.codec.enabled = True
+                            continue
+                        if payload[0] == CTRL_SESSION:
+                            token, self.session_grace = decode_session(payload)
+                            if token != self.session_token: # 新的session(沒有接回)，序號從頭開始
+                                self.last_seq = 0
+                            self.session_token = token
+                            self.session_server = (self.server_ip, self.server_text_port)
+                            continue
+                        if payload[0] == CTRL_FILE_OFFER:
+                            self.ui.post(self.ask_file, self.sender_name(header.sender), decode_file_offer(payload))
+                            continue
+                        if payload[0] == CTRL_PING:
+                            self.outbox.put(encode_control(CTRL_PONG))
+                            continue
+                        if payload[0] == CTRL_BYE: # server請我們離開(例如閒置過久)，斷線後不自動重連
+                            self.session_token = None
+                        code, text = decode_control(payload)
+                        self.ui.post(self.log, text, "info" if code == CTRL_WELCOME else "system")
+                    continue
+
+                length_data = reader.read_exact(4)
+                if length_data == MAGIC:
+                    version = reader.read_exact(len(HELLO) - len(MAGIC))[0]
+                    if version != VERSION:
+                        self.ui.post(self.log, f"[錯誤] Server 的協定版本({version})不相容，請取消勾選單一連線模式\n",
+                                     "error")
                         break
-                    data += chunk
+                    framed = True
+                    continue
+                data = reader.read_exact(checked_length(length_data))
                 if not data:
                     break
-                message = data.decode()
-                self.received_text = message
-                self.received_image_pending = True
-
-                # 延遲顯示直到圖片來，避免當圖文同時接收時訊息框連跳兩次傳送者標頭
-                def flush_text():
-                    if self.received_text:
-                        self.log(self.received_text)
-                        self.received_text = ""
-                        self.received_image_pending = False
-                self.window.after(300, flush_text)
-                    
-                if ("已連線" in message or "歡迎進入聊天室" in message) and not self.image_socket:
+                message = str(data, "utf-8", "replace")
+                self.on_server_text(message)
+
+                # 舊版協定需要另外建立圖片連線
+                if ("已連線" in message or "歡迎進入聊天室" in message) and not self.image_socket and not self.framed:
                     try:
                         self.image_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                         self.image_socket.connect((self.server_ip, self.server_image_port))
+                        self.image_outbox = self.create_outbox(self.image_socket)
                         threading.Thread(target=self.receive_image, daemon=True).start()
                         # self.log("圖片通道已建立\n", tag="system")
                     except Exception as e:
-                        self.log(f"[錯誤] 圖片連線失敗: {e}\n", tag="error")
+                        self.ui.post(self.log, f"[錯誤] 圖片連線失敗: {e}\n", "error")
             except:
                 break
-        self.connect_button.config(state="normal")
-        self.log("(與server連線已中斷)\n", tag="system")
+        self.disconnected_at = time.monotonic()
+        self.ui.post(self.connect_button.config, {"state": "normal"})
+        self.ui.post(self.log, "(與server連線已中斷)\n", "system")
+        summary = self.codec.summary()
+        if summary:
+            self.ui.post(self.log, summary + "\n", "system")
+        if self.session_token is not None and not self.user_disconnect:
+            self.ui.post(self.log, f"{self.session_grace} 秒內重新連線可以接回原本的座位\n", "system")
+            self.ui.post(self.window.after, RECONNECT_DELAY, self.reconnect)
+
+    # 文字訊息(接收thread)，記下時間讓緊接著的圖片不再重複顯示傳送者標頭
+    # timestamp為frame標頭上的時間(毫秒)，舊版協定沒有時使用收到的時間
+    def on_server_text(self, message, timestamp=None):
+        self.last_text_time = time.monotonic()
+        self.ui.post(self.log, message, None, timestamp)
+
+    def sender_name(self, sender):
+        return self.members.get(sender) or f"Server ({self.server_ip})"
 
     # 圖片訊息接收處理
     def receive_image(self):
+        reader = FrameReader(self.image_socket)
         while True:
             try:
-                length_data = self.image_socket.recv(4)
-                if not length_data:
-                    break
-                length = int.from_bytes(length_data, 'big')
-                img_data = b''
-                while len(img_data) < length:
-                    chunk = self.image_socket.recv(length - len(img_data))
-                    if not chunk:
-                        break
-                    img_data += chunk
-                self.display_image(img_data, sender=f"Server ({self.server_ip})")
+                # 整張圖片直接recv_into進獨立的緩衝區
+                img_data = reader.read_message(keep=True, limit=MAX_IMAGE_SIZE)
+                self.display_image(img_data, sender=f"Server ({self.server_ip})", block=True)
             except:
                 break
 
@@ -169,14 +354,11 @@ class ChatClient:
     def select_image(self):
         filepath = filedialog.askopenfilename(title="選擇圖片",
             filetypes=[("Image files", "*.png *.jpg *.jpeg *.gif *.bmp")])
-        if filepath:
-            with open(filepath, "rb") as f:
-                self.selected_image = f.read()
-            img = Image.open(io.BytesIO(self.selected_image))
-            img.thumbnail((200, 200))
-            photo = ImageTk.PhotoImage(img)
-            self.img_label.config(image=photo)
-            self.img_label.image = photo
+        if filepath and os.path.getsize(filepath) > MAX_IMAGE_SIZE:
+            self.log(f"[錯誤] 圖片超過 {MAX_IMAGE_SIZE // (1024 * 1024)} MB，無法傳送\n", tag="error")
+        elif filepath:
+            self.selected_image = filepath # 只記錄路徑，送出時才邊讀邊送
+            self.image_pipeline.submit(filepath, self.show_preview, block=False)
 
     # 處理送出訊息(圖片/文字)
     def send_message(self):
@@ -185,110 +367,259 @@ class ChatClient:
         sent_image = False
         
         if self.text_socket:
-            if msg:
-                full_msg = f"Client({self.local_ip}):{msg}\n"
-                try:
+            if len(msg.encode()) > MAX_TEXT_LENGTH:
+                self.log(f"[錯誤] 訊息超過 {MAX_TEXT_LENGTH // 1024} KB，無法傳送\n", tag="error")
+            elif msg:
+                # 只放進送出佇列，不等待server接收
+                if self.framed: # 名稱由server依連線加上；壓縮的context是連續的，確定放得進佇列才編碼
+                    seq = self.seq.next()
+                    accepted = self.outbox.put_encoded(HEADER.size + len(msg.encode()),
+                                                       lambda: self.codec.encode_text(msg, seq))
+                else:
+                    full_msg = f"Client({self.local_ip}):{msg}\n"
                     encoded_msg = full_msg.encode()
-                    self.text_socket.sendall((len(encoded_msg).to_bytes(4, 'big') + encoded_msg))
+                    accepted = self.outbox.put(len(encoded_msg).to_bytes(4, 'big') + encoded_msg)
+                if accepted:
                     sent_text = True
-                except:
-                    self.log("[錯誤] 傳送失敗\n", tag="error")
-                self.input_text.delete("1.0", tk.END)
+                    self.input_text.delete("1.0", tk.END)
+                else:
+                    self.log("[錯誤] 傳送佇列已滿，訊息未送出(與 server 的連線過慢)\n", tag="error")
 
-        if self.image_socket and self.selected_image:
+        # frame協定: 在背景thread分段讀檔送出，GUI不會被大圖片卡住
+        if self.framed and self.text_socket and self.selected_image and len(self.outgoing) >= MAX_TRANSFERS:
+            self.log("[錯誤] 傳送中的圖片過多，請稍候再送出\n", tag="error")
+        elif self.framed and self.text_socket and self.selected_image:
             try:
-                self.image_socket.sendall(len(self.selected_image).to_bytes(4, 'big') + self.selected_image)
+                transfer = OutgoingTransfer(self.stream_ids.next(), self.selected_image)
+                self.outgoing[transfer.transfer_id] = transfer
+                threading.Thread(target=self.send_transfer, args=(transfer,), daemon=True).start()
                 sent_image = True
             except Exception as e:
                 self.log(f"[錯誤] 圖片傳送失敗: {e}\n", tag="error")
+        elif self.image_socket and self.selected_image:
+            try:
+                with open(self.selected_image, "rb") as f:
+                    img_bytes = f.read()
+                if self.image_outbox.put([len(img_bytes).to_bytes(4, 'big'), img_bytes]):
+                    sent_image = True
+                else:
+                    self.log("[錯誤] 傳送佇列已滿，圖片未送出\n", tag="error")
+            except Exception as e:
+                self.log(f"[錯誤] 圖片傳送失敗: {e}\n", tag="error")
                 
         # 最後才來處理訊息框顯示，圖文任何一者成功就log+顯示
         if sent_text or sent_image:
             timestamp = datetime.now().strftime("[%H:%M:%S]")
             sender = f"{timestamp} Client({self.local_ip}):"
-            self.log_text.insert(tk.END, sender + ("" + msg + "\n" if sent_text else "") + "")
+            self.log_view.insert_text(sender + ("" + msg + "\n" if sent_text else "") + "")
             if sent_image:
                 self.display_image(self.selected_image, sender="")
                 self.log(f"[圖片已送出 - {self.local_ip} (Client)]\n", tag="system")
-            self.log_text.see(tk.END)
+            self.log_view.see_end()
         # 送出後重置已選擇圖片
         self.selected_image = None
         self.img_label.config(image='')
         self.img_label.image = None
 
-    # 圖片顯示前處理
-    def display_image(self, img_bytes, sender="Server"):
-        if self.received_text:
-            self.log(self.received_text)
-            self.received_text = ""
-            sender = None
-        self.received_image_pending = False
+    # 逐段放進送出佇列，佇列超過高水位時等待(背壓)，文字訊息最多只排在幾個片段之後
+    # server已經有同一張圖片時只送出hash
+    def send_transfer(self, transfer):
         try:
-            img = Image.open(io.BytesIO(img_bytes))
-            img.thumbnail((200, 200))
-            photo = ImageTk.PhotoImage(img)
-            self.log_image(sender, photo, img_bytes)
+            if self.offer_transfer(transfer):
+                transfer.skip()
+                self.ui.post(self.show_progress, "send", 100)
+                return
+            if not self.outbox.put(transfer.begin_frame(), block=True):
+                return
+            while (parts := transfer.next_frame()) is not None:
+                if not self.outbox.put(parts, block=True):
+                    return
+                percent = progress_percent(transfer)
+                if percent is not None:
+                    self.ui.post(self.show_progress, "send", percent)
         except Exception as e:
-            self.log(f"[錯誤] 圖片顯示失敗: {e}\n", tag="error")
+            self.ui.post(self.log, f"[錯誤] 圖片傳送失敗: {e}\n", "error")
+        finally:
+            transfer.close()
+            self.outgoing.pop(transfer.transfer_id, None)
+
+    # 送出圖片的內容hash並等待server回覆，回傳server是否已有這張圖片(逾時未回覆時當作沒有)
+    def offer_transfer(self, transfer):
+        answer = [threading.Event(), False]
+        self.offers[transfer.transfer_id] = answer
+        try:
+            digest = transfer.digest()
+            if not self.outbox.put(transfer.offer_frame(digest), block=True):
+                return False
+            answer[0].wait(OFFER_TIMEOUT)
+            return answer[1]
+        finally:
+            self.offers.pop(transfer.transfer_id, None)
+
+    # 顯示圖片傳送/接收進度
+    def show_progress(self, kind, percent, what="圖片"):
+        action = "傳送" if kind == "send" else "接收"
+        self.progress_label.config(text="" if percent >= 100 else f"{what}{action}中... {percent}%")
+
+    # 分享任意檔案(見chat_files.py): 檔案內容不經過server，由對方直接連過來下載
+    # 計算hash需要讀過整個檔案，在背景thread進行
+    def share_file(self):
+        if not (self.framed and self.text_socket):
+            self.log("[錯誤] 請先以單一連線模式連線到 Server\n", tag="error")
+            return
+        path = filedialog.askopenfilename(title="選擇要傳送的檔案")
+        if not path:
+            return
+        outbox = self.outbox
+
+        def run():
+            try:
+                share = FileShare(path, on_sent=lambda addr, error: self.ui.post(self.file_sent, path, addr, error))
+                share.start()
+            except OSError as e:
+                self.ui.post(self.log, f"[錯誤] 無法分享檔案: {e}\n", "error")
+                return
+            if outbox.put(encode_file_offer(share.offer())):
+                self.ui.post(self.log, f"[檔案分享中 - {share.name} ({format_size(share.size)})]\n", "system")
+            else:
+                share.close()
+                self.ui.post(self.log, "[錯誤] 傳送佇列已滿，檔案未分享\n", "error")
+        threading.Thread(target=run, daemon=True).start()
+
+    def file_sent(self, path, addr, error):
+        if error is None:
+            self.log(f"[檔案已送出 - {os.path.basename(path)} → {addr[0]}]\n", tag="system")
+        else:
+            self.log(f"[錯誤] 檔案傳送給 {addr[0]} 失敗: {error}\n", tag="error")
+
+    # 對方分享檔案時詢問是否接收，下載在背景thread進行
+    def ask_file(self, sender, offer):
+        info = f"{offer.name} ({format_size(offer.size)})"
+        self.log(f"{sender} 分享檔案 {info}\n", tag="info")
+        if not messagebox.askyesno("接收檔案", f"{sender} 分享檔案:\n{info}\n\n是否接收?"):
+            return
+        path = filedialog.asksaveasfilename(title="儲存檔案", initialfile=offer.name)
+        if not path:
+            return
+        host = offer.host or self.server_ip # 空白代表server本身分享的檔案
+
+        def run():
+            try:
+                receive_file(offer, host, path,
+                             on_progress=lambda percent: self.ui.post(self.show_progress, "recv", percent, "檔案"))
+            except Exception as e:
+                self.ui.post(self.log, f"[錯誤] 檔案接收失敗: {e}\n", "error")
+                return
+            self.ui.post(self.log, f"[檔案已接收 - {path}]\n", "system")
+        threading.Thread(target=run, daemon=True).start()
+
+    # 圖片顯示前處理: 解碼與縮圖交給背景worker，完成後才回到Tk主執行緒顯示
+    # 可從任何thread呼叫；block=True時處理佇列已滿會等待(供接收thread使用)
+    # preview_of: img_bytes是server產生的縮圖時為原圖的digest，點開時才向server要求原圖
+    def display_image(self, img_bytes, sender="Server", block=False, preview_of=None):
+        if sender and time.monotonic() - self.last_text_time < TEXT_IMAGE_GAP:
+            sender = None
+        # 先在畫面更新佇列佔住位置，圖片處理完才填入，和前後的文字訊息保持原本的順序
+        seq = self.ui.reserve()
+        callback = lambda thumb, digest: self.show_thumbnail(thumb, digest, sender)
+        on_error = lambda e: self.log(f"[錯誤] 圖片顯示失敗: {e}\n", tag="error")
+        post = lambda fn, *args: self.ui.fulfil(seq, fn, *args)
+        if preview_of is not None:
+            submitted = self.image_pipeline.submit_preview(preview_of, img_bytes, callback, on_error, block, post)
+        else:
+            submitted = self.image_pipeline.submit_message_image(img_bytes, callback, on_error, block, post)
+        if not submitted:
+            self.ui.fulfil(seq, self.log, "[錯誤] 圖片處理佇列已滿，略過一張圖片\n", "error")
+
+    # 縮圖完成後(Tk主執行緒)，原圖已存入磁碟快取，之後只用digest參照
+    def show_thumbnail(self, thumb, digest, sender):
+        photo = self.image_store.get_thumbnail(digest) or ImageTk.PhotoImage(thumb)
+        self.log_image(sender, photo, digest)
+
+    # 選取圖片後的預覽縮圖
+    def show_preview(self, thumb):
+        photo = ImageTk.PhotoImage(thumb)
+        self.img_label.config(image=photo)
+        self.img_label.image = photo
 
     # 在訊息框內顯示圖片
-    def log_image(self, sender, photo, original_bytes):
+    def log_image(self, sender, photo, digest):
         # 紀錄時間
         now = datetime.now().strftime("[%H:%M:%S]")
         if sender == "":
             sender = None
-            self.log_text.insert(tk.END, f"\n")
+            self.log_view.insert_text("\n")
         if sender:
-            self.log_text.insert(tk.END, f"{now} {sender}:\n")
-        # self.log_text.insert(tk.END, f"{now} {sender}:\n")
-        img_widget = tk.Label(self.log_text, image=photo, cursor="hand2")
-        img_widget.image = photo
-        img_widget.bind("<Button-1>", lambda e: self.show_full_image(original_bytes))
-        self.log_text.window_create(tk.END, window=img_widget)
-        self.log_text.insert(tk.END, "\n")
-        self.image_refs.append(photo)
-        self.log_text.see(tk.END)
-
-    # 點擊訊息框內的圖片可放大檢視
-    def show_full_image(self, img_bytes):
-        try:
-            img = Image.open(io.BytesIO(img_bytes))
-            top = Toplevel(self.window)
-            top.title("圖片預覽")
-            width, height = img.size
-            top.geometry(f"{width}x{height}")
-
-            photo = ImageTk.PhotoImage(img)
-            canvas = Canvas(top, width=width, height=height)
-            canvas.pack()
-            canvas.create_image(0, 0, anchor=tk.NW, image=photo)
-            canvas.image = photo
-        except:
+            self.log_view.insert_text(f"{now} {sender}:\n")
+        self.image_store.add_thumbnail(digest, photo) # 超過記憶體上限時舊縮圖會被換成文字
+        self.log_view.insert_image(digest)
+        self.log_view.insert_text("\n")
+
+    # 點擊訊息框內的圖片可放大檢視，原圖從磁碟快取讀回並在背景解碼
+    # 只收過server縮圖的圖片這時才向server要求原圖，收完後再開啟
+    def show_full_image(self, digest):
+        source = self.image_store.original(digest)
+        preview = self.image_store.preview(digest)
+        if source is not None:
+            self.image_pipeline.submit(source, self.open_full_image, size=None, block=False,
+                                       on_error=lambda e: messagebox.showerror("錯誤", "無法開啟圖片"))
+        elif preview is not None and self.framed and self.outbox is not None:
+            if digest not in self.fetching:
+                self.fetching.add(digest)
+                self.outbox.put(encode_image_fetch(digest))
+                self.log("下載原圖中...\n", tag="system")
+        else:
             messagebox.showerror("錯誤", "無法開啟圖片")
+            return
+        # 縮圖已被換出記憶體時順便重新產生
+        if not self.image_store.has_thumbnail(digest):
+            self.image_pipeline.submit(source or preview, lambda thumb: self.image_store.restore_thumbnail(
+                digest, ImageTk.PhotoImage(thumb)), block=False)
+
+    # 點開縮圖後下載的原圖(接收thread): 存入快取後開啟大圖
+    def open_fetched(self, digest, source):
+        self.fetching.discard(digest)
+        self.image_pipeline.submit_message_image(
+            source, lambda img, _: self.open_full_image(img), block=True, size=None,
+            on_error=lambda e: self.log(f"[錯誤] 無法開啟圖片: {e}\n", tag="error"))
+
+    def open_full_image(self, img):
+        top = Toplevel(self.window)
+        top.title("圖片預覽")
+        width, height = img.size
+        top.geometry(f"{width}x{height}")
+
+        # 使用canvas+toplevel模塊來額外彈出視窗顯示原圖片
+        photo = ImageTk.PhotoImage(img)
+        canvas = Canvas(top, width=width, height=height)
+        canvas.pack()
+        canvas.create_image(0, 0, anchor=tk.NW, image=photo)
+        canvas.image = photo
 
     # 於聊天框內顯示訊息，透過tag區分顏色
-    def log(self, msg, tag=None):
+    def log(self, msg, tag=None, timestamp=None):
         # 紀錄時間
-        now = datetime.now().strftime("[%H:%M:%S]")
+        when = datetime.fromtimestamp(timestamp / 1000) if timestamp else datetime.now()
+        now = when.strftime("[%H:%M:%S]")
         msg = f"{now} {msg}"
-        if tag and tag not in self.log_text.tag_names():
-            if tag == "error":
-                self.log_text.tag_configure(tag, foreground="red")
-            elif tag == "info":
-                self.log_text.tag_configure(tag, foreground="blue")
-            elif tag == "system":
-                self.log_text.tag_configure(tag, foreground="gray")
-            else:
-                self.log_text.tag_configure(tag, foreground="black")
-
-        if tag:
-            self.log_text.insert(tk.END, msg, tag)
-        else:
-            self.log_text.insert(tk.END, msg)
-        self.log_text.see(tk.END)
+        self.log_view.insert_text(msg, tag)
 
     # 中斷連線按鈕對應操作(中斷目前client對server連線)
+    # 主動中斷連線: 告知server不必保留座位
     def disconnect(self):
+        self.user_disconnect = True
+        self.session_token = None
+        if self.framed and self.outbox:
+            self.outbox.put(encode_control(CTRL_BYE))
+            self.outbox.flush(0.5)
+        self.close_sockets()
+        self.connect_button.config(state="normal")
+
+    def close_sockets(self):
+        for outbox in (self.outbox, self.image_outbox):
+            if outbox:
+                outbox.close()
+        self.outbox = self.image_outbox = None
         if self.text_socket:
             try: self.text_socket.close()
             except: pass
@@ -297,7 +628,7 @@ class ChatClient:
             try: self.image_socket.close()
             except: pass
             self.image_socket = None
-        self.connect_button.config(state="normal")
+        self.framed = False
     
     def run(self):
         self.window.mainloop()
@@ -1,55 +1,66 @@
-import socket
-import threading
+import argparse
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
-from tkinter import messagebox, filedialog, Toplevel, Canvas
-from PIL import Image, ImageTk
-import io
-import select
-import queue
+from tkinter import messagebox, filedialog, simpledialog, Toplevel, Canvas
+from PIL import ImageTk
 import subprocess
 import os
+import threading
+import time
 from datetime import datetime
+from chat_cluster import RelayBus
+from chat_core import RESUME_GRACE, ChatCore, run_headless
+from chat_heartbeat import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, IDLE_TIMEOUT
+from chat_workers import run_workers
+from chat_log import FSYNC_NEVER, FSYNC_ROTATE, FSYNC_ALWAYS
+from chat_outbox import SEND_BUDGET, POLICY_DROP, POLICY_DISCONNECT
+from chat_files import FileShare, format_size, receive_file
+from chat_protocol import MAX_TEXT_LENGTH
+from chat_transfer import MAX_IMAGE_SIZE
+
+from chat_images import ImagePipeline, ImageStore
+from chat_ui import TEXT_IMAGE_GAP, UiQueue
+from chat_view import MessageView
 
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', text_port=10000, image_port=10001):
-        # 初始化chat server的設定
+    def __init__(self, host='0.0.0.0', text_port=10000, image_port=10001, max_rooms=1, room_size=1,
+                 log_fsync=FSYNC_ROTATE, replay=0, send_budget=SEND_BUDGET, slow_policy=POLICY_DISCONNECT,
+                 metrics_port=None, metrics_file=None, bus=None, resume_grace=RESUME_GRACE,
+                 heartbeat=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 previews=True):
+        # 初始化chat server的設定，網路部分全部交給ChatCore處理，這裡只負責GUI
+        self.core = ChatCore(host, text_port, image_port, max_rooms=max_rooms, room_size=room_size,
+                             log_fsync=log_fsync, replay=replay, send_budget=send_budget, slow_policy=slow_policy,
+                             metrics_port=metrics_port, metrics_file=metrics_file, bus=bus,
+                             resume_grace=resume_grace, heartbeat=heartbeat, heartbeat_timeout=heartbeat_timeout,
+                             idle_timeout=idle_timeout, previews=previews)
         self.HOST = host
         self.TEXT_PORT = text_port
         self.IMAGE_PORT = image_port
-        self.text_conn: socket.socket = None # 文字傳輸的連線
-        self.image_conn: socket.socket = None # 圖片傳輸的連線
-        self.client_addr = None
-        self.local_ip = self.get_local_ip()
-        self.image_refs = [] # 保留紀錄圖片傳輸紀錄
-        self.selected_image = None # 暫存目前選取要傳送的圖片
-
-        self.waiting_clients = queue.Queue()
-        self.waiting_addrs = [] # 紀錄等待連線中的client IP
-        
-        # 文字記錄保存相關參數，檔案名稱設定為目前時間
-        LOG_DIR = "chat_logs"
-        os.makedirs(LOG_DIR, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.log_file_path = os.path.join(LOG_DIR, f"chat_log_{timestamp}.txt")
-        
+        self.local_ip = self.core.local_ip
+        self.selected_image = None # 目前選取要傳送的圖片路徑，送出時才從檔案邊讀邊送
+        self.last_text_time = 0 # 最近一次收到文字訊息的時間，用來判斷緊接著的圖片是否屬於同一則訊息
+
+        # 縮圖LRU + 原圖磁碟快取，原圖快取與ChatCore共用，收過的圖片再次出現時只需交換hash
+        self.image_store = ImageStore(content=self.core.content_store)
         self.setup_gui() # 初始化界面
-        threading.Thread(target=self.start_text_server, daemon=True).start() # 初始化socket監聽
-    
-    # 自動抓取本地IP位址
-    def get_local_ip(self):
-        # 透過對內部網路建立一次連線來得到本地ip位址
-        # socket會自動偵測本機的網路介面，並綁定適當的IP連接，透過這個原理可以不用設定本地IP就得到本地位址
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(('10.255.255.255', 1))
-            ip = s.getsockname()[0]
-        except:
-            ip = '127.0.0.1'
-        finally:
-            s.close()
-        return ip
+        # 背景thread的畫面更新都放進同一個佇列，由Tk主執行緒定期一次處理
+        self.ui = UiQueue(self.window)
+        self.ui.start()
+        # 圖片解碼/縮圖在背景thread進行
+        self.image_pipeline = ImagePipeline(self.window, self.image_store, post=self.ui.post,
+                                            decode_time=self.core.metrics.image_decode)
+
+        # core的callback都在事件迴圈thread上觸發，統一轉回Tk主執行緒處理
+        self.core.on_log = lambda line, tag: self.ui.post(self.show_log, line, tag)
+        self.core.on_text = lambda peer, message: self.on_client_text(message)
+        self.core.on_image = lambda peer, img: self.display_image(img, f"Client({peer.addr[0]})")
+        self.core.on_waiting_changed = lambda addrs: self.ui.post(self.update_waiting_label, addrs)
+        self.core.on_client_connected = lambda peer: self.ui.post(self.on_client_connected)
+        self.core.on_progress = lambda peer, kind, percent: self.ui.post(self.show_progress, kind, percent)
+        self.core.on_file_offer = lambda peer, offer: self.ui.post(self.ask_file, peer.display_name, offer)
+        self.core.start() # 初始化socket監聽
 
     # Server GUI畫面建立
     def setup_gui(self):
@@ -75,7 +86,7 @@ class ChatServer:
 
         tk.Label(top_frame, text=f"本機 IP:{self.local_ip}", fg="green").grid(row=0, column=0, sticky="w", padx=5)
         tk.Label(top_frame, text=f"Text Port:{self.TEXT_PORT}").grid(row=0, column=1, sticky="w")
-        tk.Label(top_frame, text=f"Image Port:{self.IMAGE_PORT}").grid(row=0, column=2, sticky="w")
+        tk.Label(top_frame, text=f"Image Port:{self.IMAGE_PORT or '停用'}").grid(row=0, column=2, sticky="w")
         tk.Button(top_frame, text="結束程式", command=self.close_server).grid(row=0, column=6, sticky="e", padx=5)
 
         # middle_frame: 訊息框
@@ -84,8 +95,9 @@ class ChatServer:
         middle_frame.grid_rowconfigure(0, weight=1)
         middle_frame.grid_columnconfigure(0, weight=1)
 
-        self.log_text = ScrolledText(middle_frame, width=50, height=20)
-        self.log_text.grid(row=0, column=0, sticky="nsew")
+        # 只保留畫面附近訊息的訊息框，聊天再久插入與捲動的成本都不會增加
+        self.log_view = MessageView(middle_frame, self.image_store, self.show_full_image, width=50, height=20)
+        self.log_view.grid(row=0, column=0, sticky="nsew")
 
         # bottom_frame: 傳送訊息
         bottom_frame = tk.Frame(self.window)
@@ -96,198 +108,50 @@ class ChatServer:
         self.input_text = tk.Text(bottom_frame, height=3)
         self.input_text.grid(row=0, column=1, sticky="ew")
         tk.Button(bottom_frame, text="傳送", command=self.send_message).grid(row=0, column=2, padx=5)
+        tk.Button(bottom_frame, text="傳送檔案", command=self.share_file).grid(row=0, column=3, padx=5)
 
         self.img_label: tk.Label = tk.Label(self.window)
         self.img_label.grid(row=4, column=0, pady=5)
-        
-        # 開啟連天記錄存檔的資料夾
-        tk.Button(self.window, text="📁 開啟紀錄", command=self.open_log_folder).grid(row=5, column=0, pady=(0, 10))
 
-    # 更新server端顯示的client等待佇列    
-    def update_waiting_label(self):
-        if self.waiting_addrs:
-            text = "\n".join(f"- {addr}" for addr in self.waiting_addrs)
+        # 圖片傳送/接收進度
+        self.progress_label = tk.Label(self.window, fg="gray")
+        self.progress_label.grid(row=6, column=0)
+        
+        # 開啟連天記錄存檔的資料夾 / 搜尋歷史訊息
+        log_frame = tk.Frame(self.window)
+        log_frame.grid(row=5, column=0, pady=(0, 10))
+        tk.Button(log_frame, text="📁 開啟紀錄", command=self.open_log_folder).pack(side=tk.LEFT, padx=5)
+        tk.Button(log_frame, text="🔍 搜尋紀錄", command=self.search_history).pack(side=tk.LEFT, padx=5)
+
+    # 更新server端顯示的client等待佇列(人數很多時只列出前幾位)
+    def update_waiting_label(self, waiting_addrs):
+        if waiting_addrs:
+            text = "\n".join(f"- {addr}" for addr in waiting_addrs[:10])
+            if len(waiting_addrs) > 10:
+                text += f"\n... 共 {len(waiting_addrs)} 位等待中"
         else:
             text = "無等待中 client"
         self.waiting_label.config(text=text)
 
-    # 當client連入時，建立與client端的文字訊息傳輸連線
-    def start_text_server(self):
-        # 建立並等待與client的TCP連線
-        # 分成兩個Thread來處理列隊等待中的client
-        # 1. handle_client(): 處理當client嘗試連線時的排隊情況，並在client連入或排隊等到時進一步進到後續接收訊息階段
-        # 2. queue_monitor(): 實際管理排隊並進一步放入client連線
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((self.HOST, self.TEXT_PORT))
-        server_socket.listen(5)
-        self.log("等待 client 連線中...\n", tag="system")
-
-        def handle_client(conn, addr):
-            if self.text_conn is None:
-                self.text_conn = conn
-                self.client_addr = addr
-                self.log_text.delete("0.0", tk.END) # 新連線清空聊天紀錄
-                self.log(f"Client {addr} 已連線！\n", tag="info")
-                self.text_conn.sendall(len("歡迎進入聊天室\n".encode()).to_bytes(4, 'big') + "歡迎進入聊天室\n".encode())
-                threading.Thread(target=self.receive_text, daemon=True).start()
-                threading.Thread(target=self.start_image_server, args=(addr,), daemon=True).start()
-            else:
-                identifier = f"{addr[0]}:{addr[1]}"
-                self.waiting_clients.put((conn, addr))
-                self.waiting_addrs.append(identifier)
-                self.update_waiting_label()
-                pos = self.waiting_clients.qsize()
-                try:
-                    msg = f"您是第 {pos} 位等待中，請稍候...\n".encode()
-                    conn.sendall((len(msg).to_bytes(4, 'big') + msg))
-                except:
-                    conn.close()
-
-                # monitor_queue_socket(): 監控client端是否在排隊時中斷連線
-                # 原理是偵測與該client連線的socket通道是否有中斷，若中斷即代表離開等待連入server佇列
-                import select
-                def monitor_queue_socket():
-                    try:
-                        while True:
-                            rlist, _, _ = select.select([conn], [], [], 0.5)
-                            if rlist:
-                                # 確保socket有資料可讀才來check
-                                peek = conn.recv(1, socket.MSG_PEEK)
-                                if not peek:
-                                    break
-                    except:
-                        pass
-
-                    # 一旦連線中斷就移除
-                    if (conn, addr) in list(self.waiting_clients.queue):
-                        with self.waiting_clients.mutex:
-                            self.waiting_clients.queue.remove((conn, addr))
-                        self.waiting_addrs.remove(identifier)
-                        self.update_waiting_label()
-                        self.log(f"({identifier} 離開等待隊列。)\n", tag="system")
-
-                threading.Thread(target=monitor_queue_socket, daemon=True).start()
-
-        def queue_monitor():
-            import time
-            while True:
-                if self.text_conn is None and not self.waiting_clients.empty():
-                    try:
-                        #self.log_text.delete("0.0", tk.END) # 新連線清空聊天紀錄
-                        conn, addr = self.waiting_clients.get(timeout=0.1)
-                        identifier = f"{addr[0]}:{addr[1]}"
-                        if identifier in self.waiting_addrs:
-                            self.waiting_addrs.remove(identifier)
-                        self.window.after(0, self.update_waiting_label)
-                        self.window.after(0, lambda: handle_client(conn, addr))
-                    except queue.Empty:
-                        pass
-                time.sleep(0.2) 
-
-        threading.Thread(target=queue_monitor, daemon=True).start()
-        while True:
-            conn, addr = server_socket.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
-    
-    # 當client連入時，建立與client端的圖片訊息傳輸連線
-    def start_image_server(self, addr):
-        # 建立與client的img socket連線
-        img_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        img_server.bind((self.HOST, self.IMAGE_PORT))
-        img_server.listen(1)
-        self.log(f"等待 {addr} 的圖片連線中...\n", tag="system")
-        conn, _ = img_server.accept()
-        self.image_conn = conn
-        self.log(f"{addr} 圖片 socket 已連接\n", tag="info")
-
-        def handle_image_receive(sock):
-            while True:
-                try:
-                    length_data = sock.recv(4)
-                    if not length_data:
-                        break
-                    length = int.from_bytes(length_data, 'big')
-                    img_data = b''
-                    while len(img_data) < length:
-                        chunk = sock.recv(length - len(img_data))
-                        if not chunk:
-                            break
-                        img_data += chunk
-                    self.display_image(img_data, sender=f"Client ({addr[0]})")
-                except:
-                    break
-
-        threading.Thread(target=handle_image_receive, args=(conn,), daemon=True).start()        
-
-    # 文字訊息接收處理
-    def receive_text(self):
-        self.received_text = ""
-        self.received_image_pending = False
-        while True:
-            # 流程:
-            # 1. 每段文字訊息都會先傳送第一段內容表示接下來訊息的長度
-            # 2. 持續接收訊息直到超過長度
-            # 不論多長的訊息都能進行傳輸
-            try:
-                length_data = self.text_conn.recv(4)
-                if not length_data:
-                    break
-                length = int.from_bytes(length_data, 'big')
-                data = b''
-                while len(data) < length:
-                    chunk = self.text_conn.recv(length-len(data))
-                    if not chunk:
-                        break
-                    data += chunk
-                if not data:
-                    break
-                message = data.decode()
-                self.received_text = message
-                self.received_image_pending = True
-
-                # 延遲顯示直到圖片來，避免當圖文同時接收時訊息框連跳兩次傳送者標頭
-                def flush_text():
-                    if self.received_text:
-                        self.log(self.received_text)
-                        self.received_text = ""
-                        self.received_image_pending = False
-                self.window.after(300, flush_text)
-            except:
-                break
-        self.log("(目前連線之Client已離線)\n", tag="system")
-        self.text_conn = None
-        self.image_conn = None
-
-    # 圖片訊息接收處理
-    def receive_image(self):
-        while True:
-            try:
-                length_data = self.image_conn.recv(4)
-                if not length_data:
-                    break
-                length = int.from_bytes(length_data, 'big')
-                img_data = b''
-                while len(img_data) < length:
-                    chunk = self.image_conn.recv(length - len(img_data))
-                    if not chunk:
-                        break
-                    img_data += chunk
-                self.display_image(img_data, sender=f"Client({self.client_addr[0]})")
-            except:
-                break
-    
+    # 第一位client連入時清空聊天紀錄(多房間時其他人加入不清空)
+    def on_client_connected(self):
+        if self.core.client_count() <= 1:
+            self.log_view.clear()
+
+    # 文字訊息接收處理(事件迴圈thread)，記下時間讓緊接著的圖片不再重複顯示傳送者標頭
+    def on_client_text(self, message):
+        self.last_text_time = time.monotonic()
+        self.ui.post(self.show_log, f"{datetime.now().strftime('[%H:%M:%S]')} {message}")
+
     # 從本地資料夾選取要傳送的圖片
     def select_image(self):
         filepath = filedialog.askopenfilename(title="選擇圖片",
             filetypes=[("Image files", "*.png *.jpg *.jpeg *.gif *.bmp")])
-        if filepath:
-            with open(filepath, "rb") as f:
-                self.selected_image = f.read()
-            img = Image.open(io.BytesIO(self.selected_image)) # 透過BytesIO將讀入的圖片轉成pillow可處理的形式
-            img.thumbnail((200, 200))
-            photo = ImageTk.PhotoImage(img)
-            self.img_label.config(image=photo)
-            self.img_label.image = photo
+        if filepath and os.path.getsize(filepath) > MAX_IMAGE_SIZE:
+            self.log(f"[錯誤] 圖片超過 {MAX_IMAGE_SIZE // (1024 * 1024)} MB，無法傳送\n", tag="error")
+        elif filepath:
+            self.selected_image = filepath
+            self.image_pipeline.submit(filepath, self.show_preview, block=False)
     
     # 處理送出訊息(圖片/文字)
     def send_message(self):
@@ -296,118 +160,155 @@ class ChatServer:
         sent_image = False
         
         # 根據目前狀況(是否有文字輸入/圖片選擇)送出訊息
-        if self.text_conn:
-            if msg:
-                full_msg = f"Server({self.local_ip}):{msg}\n"
-                try:
-                    encoded_msg = full_msg.encode()
-                    self.text_conn.sendall((len(encoded_msg).to_bytes(4, 'big') + encoded_msg))
-                    sent_text = True
-                except:
-                    self.log("[錯誤] 傳送失敗\n", tag="error")
+        # 實際傳送在core的事件迴圈內進行，不會卡住GUI
+        if self.core.has_client():
+            if len(msg.encode()) > MAX_TEXT_LENGTH:
+                self.log(f"[錯誤] 訊息超過 {MAX_TEXT_LENGTH // 1024} KB，無法傳送\n", tag="error")
+            elif msg:
+                sent_text = self.core.send_text(msg)
                 self.input_text.delete("1.0", tk.END)
         # 處理圖片傳送
-        if self.image_conn and self.selected_image:
-            try:
-                self.image_conn.sendall(len(self.selected_image).to_bytes(4, 'big') \
-                                        + self.selected_image) # 送出圖片大小byte+實際圖片byte的TCP封包
-                sent_image = True
-            except Exception as e:
-                self.log(f"[錯誤] 圖片傳送失敗: {e}\n", tag="error")
+        if self.selected_image:
+            sent_image = self.core.send_image(self.selected_image) # 由core分段讀檔送出，不會卡住GUI
             
         # 最後才來處理訊息框顯示，圖文任何一者成功就log+顯示
         if sent_text or sent_image:
             timestamp = datetime.now().strftime("[%H:%M:%S]")
             sender = f"{timestamp} Server({self.local_ip}):"
-            self.log_text.insert(tk.END, sender + ("" + msg + "\n" if sent_text else "") + "")
+            self.log_view.insert_text(sender + ("" + msg + "\n" if sent_text else "") + "")
             if sent_image:
                 self.display_image(self.selected_image, sender="")
                 self.log(f"[圖片已送出 - {self.local_ip} (Server)]\n", tag="system")
-            self.log_text.see(tk.END)
+            self.log_view.see_end()
         # 送出後重置已選擇圖片
         self.selected_image = None
         self.img_label.config(image='')
         self.img_label.image = None    
     
-    # 圖片顯示前處理
-    def display_image(self, img_bytes, sender="Client"):
-        if self.received_text:
-            self.log(self.received_text)
-            self.received_text = ""
+    # 圖片顯示前處理: 解碼與縮圖交給背景worker，完成後才回到Tk主執行緒顯示
+    # 可從任何thread呼叫；block=True時處理佇列已滿會等待(供接收thread使用)
+    def display_image(self, img_bytes, sender="Client", block=False):
+        if sender and time.monotonic() - self.last_text_time < TEXT_IMAGE_GAP:
             sender = None
-        self.received_image_pending = False
-        try:
-            img = Image.open(io.BytesIO(img_bytes))
-            img.thumbnail((200, 200))
-            photo = ImageTk.PhotoImage(img)
-            self.log_image(sender, photo, img_bytes)
-        except Exception as e:
-            self.log(f"[錯誤] 圖片顯示失敗: {e}\n", tag="error")
-            
+        # 先在畫面更新佇列佔住位置，圖片處理完才填入，和前後的文字訊息保持原本的順序
+        seq = self.ui.reserve()
+        submitted = self.image_pipeline.submit_message_image(
+            img_bytes, lambda thumb, digest: self.show_thumbnail(thumb, digest, sender),
+            on_error=lambda e: self.log(f"[錯誤] 圖片顯示失敗: {e}\n", tag="error"), block=block,
+            post=lambda fn, *args: self.ui.fulfil(seq, fn, *args))
+        if not submitted:
+            self.ui.fulfil(seq, self.log, "[錯誤] 圖片處理佇列已滿，略過一張圖片\n", "error")
+
+    # 縮圖完成後(Tk主執行緒)，原圖已存入磁碟快取，之後只用digest參照
+    def show_thumbnail(self, thumb, digest, sender):
+        photo = self.image_store.get_thumbnail(digest) or ImageTk.PhotoImage(thumb)
+        self.log_image(sender, photo, digest)
+
+    # 選取圖片後的預覽縮圖
+    def show_preview(self, thumb):
+        photo = ImageTk.PhotoImage(thumb)
+        self.img_label.config(image=photo)
+        self.img_label.image = photo
+
     # 在訊息框內顯示圖片
-    def log_image(self, sender, photo, original_bytes):
+    def log_image(self, sender, photo, digest):
         # 紀錄時間
         now = datetime.now().strftime("[%H:%M:%S]")
         if sender == "":
             sender = None
-            self.log_text.insert(tk.END, f"\n")
+            self.log_view.insert_text("\n")
         if sender:
-            self.log_text.insert(tk.END, f"{now} {sender}:\n")
-        img_widget = tk.Label(self.log_text, image=photo, cursor="hand2")
-        img_widget.image = photo
-        img_widget.bind("<Button-1>", lambda e: self.show_full_image(original_bytes))
-        self.log_text.window_create(tk.END, window=img_widget)
-        self.log_text.insert(tk.END, "\n")
-        self.image_refs.append(photo)
-        self.log_text.see(tk.END)
-    
-    # 點擊訊息框內的圖片可放大檢視
-    def show_full_image(self, img_bytes):
-        try:
-            img = Image.open(io.BytesIO(img_bytes))
-            top = Toplevel(self.window)
-            top.title("圖片預覽")
-            width, height = img.size
-            top.geometry(f"{width}x{height}")
-
-            # 使用canvas+toplevel模塊來額外彈出視窗顯示原圖片
-            photo = ImageTk.PhotoImage(img)
-            canvas = Canvas(top, width=width, height=height)
-            canvas.pack()
-            canvas.create_image(0, 0, anchor=tk.NW, image=photo)
-            canvas.image = photo
-        except:
+            self.log_view.insert_text(f"{now} {sender}:\n")
+        self.image_store.add_thumbnail(digest, photo) # 超過記憶體上限時舊縮圖會被換成文字
+        self.log_view.insert_image(digest)
+        self.log_view.insert_text("\n")
+
+    # 點擊訊息框內的圖片可放大檢視，原圖從磁碟快取讀回並在背景解碼
+    def show_full_image(self, digest):
+        source = self.image_store.original(digest)
+        if source is None:
             messagebox.showerror("錯誤", "無法開啟圖片")
+            return
+        self.image_pipeline.submit(source, self.open_full_image, size=None, block=False,
+                                   on_error=lambda e: messagebox.showerror("錯誤", "無法開啟圖片"))
+        # 縮圖已被換出記憶體時順便重新產生
+        if not self.image_store.has_thumbnail(digest):
+            self.image_pipeline.submit(source, lambda thumb: self.image_store.restore_thumbnail(
+                digest, ImageTk.PhotoImage(thumb)), block=False)
+
+    def open_full_image(self, img):
+        top = Toplevel(self.window)
+        top.title("圖片預覽")
+        width, height = img.size
+        top.geometry(f"{width}x{height}")
+
+        # 使用canvas+toplevel模塊來額外彈出視窗顯示原圖片
+        photo = ImageTk.PhotoImage(img)
+        canvas = Canvas(top, width=width, height=height)
+        canvas.pack()
+        canvas.create_image(0, 0, anchor=tk.NW, image=photo)
+        canvas.image = photo
     
-    # 於聊天框內顯示訊息，透過tag區分顏色
-    def log(self, msg, tag=None):
-        # 紀錄時間
-        now = datetime.now().strftime("[%H:%M:%S]")
-        msg = f"{now} {msg}"
-        
-        if tag and tag not in self.log_text.tag_names():
-            if tag == "error":
-                self.log_text.tag_configure(tag, foreground="red")
-            elif tag == "info":
-                self.log_text.tag_configure(tag, foreground="blue")
-            elif tag == "system":
-                self.log_text.tag_configure(tag, foreground="gray")
+    # 顯示圖片傳送/接收進度
+    def show_progress(self, kind, percent, what="圖片"):
+        action = "傳送" if kind == "send" else "接收"
+        self.progress_label.config(text="" if percent >= 100 else f"{what}{action}中... {percent}%")
+
+    # 分享任意檔案給所有聊天室內的client(見chat_files.py)，client直接連到這台server的分享port下載
+    # 計算hash需要讀過整個檔案，在背景thread進行
+    def share_file(self):
+        if not self.core.has_client():
+            self.log("[錯誤] 目前沒有 client 可以接收檔案\n", tag="error")
+            return
+        path = filedialog.askopenfilename(title="選擇要傳送的檔案")
+        if not path:
+            return
+
+        def run():
+            try:
+                share = FileShare(path, on_sent=lambda addr, error: self.ui.post(self.file_sent, path, addr, error))
+                share.start()
+            except OSError as e:
+                self.ui.post(self.log, f"[錯誤] 無法分享檔案: {e}\n", "error")
+                return
+            if self.core.send_file_offer(share.offer()):
+                self.ui.post(self.log, f"[檔案分享中 - {share.name} ({format_size(share.size)})]\n", "system")
             else:
-                self.log_text.tag_configure(tag, foreground="black")
+                share.close()
+        threading.Thread(target=run, daemon=True).start()
 
-        if tag:
-            self.log_text.insert(tk.END, msg, tag)
+    def file_sent(self, path, addr, error):
+        if error is None:
+            self.log(f"[檔案已送出 - {os.path.basename(path)} → {addr[0]}]\n", tag="system")
         else:
-            self.log_text.insert(tk.END, msg)
-        self.log_text.see(tk.END)
-        
-        
-        # server會保存文字聊天紀錄
-        try:
-            with open(self.log_file_path, "a", encoding="utf-8") as f:
-                f.write(msg)
-        except Exception as e:
-            print(f"[log 寫入失敗]: {e}")
+            self.log(f"[錯誤] 檔案傳送給 {addr[0]} 失敗: {error}\n", tag="error")
+
+    # client分享檔案時詢問是否接收，直接向該client下載，在背景thread進行
+    def ask_file(self, sender, offer):
+        info = f"{offer.name} ({format_size(offer.size)})"
+        if not messagebox.askyesno("接收檔案", f"{sender} 分享檔案:\n{info}\n\n是否接收?"):
+            return
+        path = filedialog.asksaveasfilename(title="儲存檔案", initialfile=offer.name)
+        if not path:
+            return
+
+        def run():
+            try:
+                receive_file(offer, offer.host, path,
+                             on_progress=lambda percent: self.ui.post(self.show_progress, "recv", percent, "檔案"))
+            except Exception as e:
+                self.ui.post(self.log, f"[錯誤] 檔案接收失敗: {e}\n", "error")
+                return
+            self.ui.post(self.log, f"[檔案已接收 - {path}]\n", "system")
+        threading.Thread(target=run, daemon=True).start()
+
+    # 於聊天框內顯示訊息並寫入聊天紀錄(紀錄檔由core保存)
+    def log(self, msg, tag=None):
+        self.core.log(msg, tag)
+
+    # 於聊天框內顯示訊息，透過tag區分顏色
+    def show_log(self, msg, tag=None):
+        self.log_view.insert_text(msg, tag)
         
     # 開啟聊天紀錄檔案資料夾
     def open_log_folder(self):
@@ -421,19 +322,103 @@ class ChatServer:
         except Exception as e:
             self.log(f"[錯誤] 無法開啟資料夾: {e}", tag="error")
 
+    # 搜尋歷史訊息(關鍵字以空白分隔)，查詢在背景thread進行
+    def search_history(self):
+        if self.core.history is None:
+            return
+        query = simpledialog.askstring("搜尋紀錄", "關鍵字:", parent=self.window)
+        if not query or not query.strip():
+            return
+
+        def run():
+            try:
+                results = self.core.history.search(query, limit=500)
+            except Exception as e:
+                self.ui.post(self.log, f"[錯誤] 搜尋失敗: {e}\n", "error")
+                return
+            self.ui.post(self.show_search_results, query, results)
+        threading.Thread(target=run, daemon=True).start()
+
+    def show_search_results(self, query, results):
+        top = Toplevel(self.window)
+        top.title(f"搜尋紀錄: {query} ({len(results)} 筆)")
+        text = ScrolledText(top, width=80, height=25)
+        text.pack(fill=tk.BOTH, expand=True)
+        for m in results:
+            when = datetime.fromtimestamp(m.ts).strftime("[%Y-%m-%d %H:%M:%S]")
+            room = f"[房間 {m.room}] " if self.core.max_rooms > 1 else ""
+            text.insert(tk.END, f"{when} {room}{m.body}")
+        if not results:
+            text.insert(tk.END, "沒有符合的訊息\n")
+        text.config(state=tk.DISABLED)
+
     # 結束程式按鈕對應操作(關閉所有連線並關閉程式)
     def close_server(self):
-        if self.text_conn:
-            try: self.text_conn.close()
-            except: pass
-        if self.image_conn:
-            try: self.image_conn.close()
-            except: pass
+        self.core.on_log = None # 視窗即將關閉，之後的訊息只寫入紀錄檔
         self.log("\n伺服器已關閉。\n")
+        self.core.stop()
+        self.core.close_log() # 確保佇列中的紀錄都已寫入檔案
+        self.image_pipeline.shutdown()
+        self.ui.stop()
         self.window.destroy()
 
     def run(self):
         self.window.mainloop()
 
 if __name__ == '__main__':
-    ChatServer().run()
+    parser = argparse.ArgumentParser(description="TCP Chat Server")
+    parser.add_argument("--headless", action="store_true", help="不開啟GUI，只執行server核心")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--text-port", type=int, default=10000)
+    parser.add_argument("--image-port", type=int, default=10001)
+    parser.add_argument("--no-image-port", action="store_true", help="不開啟圖片port，只接受單一連線(frame協定)的client")
+    parser.add_argument("--rooms", type=int, default=1, help="同時進行的聊天室數量")
+    parser.add_argument("--room-size", type=int, default=1, help="每個聊天室可容納的client數")
+    parser.add_argument("--log-fsync", choices=[FSYNC_NEVER, FSYNC_ROTATE, FSYNC_ALWAYS], default=FSYNC_ROTATE,
+                        help="聊天紀錄的fsync時機: 不主動fsync / 換檔與關閉時 / 每次批次寫入後")
+    parser.add_argument("--replay", type=int, default=0, help="client重新連線時補送該房間最近幾則訊息")
+    parser.add_argument("--resume-grace", type=int, default=RESUME_GRACE,
+                        help="client斷線後保留座位的秒數，期間重新連線可接回並補收漏掉的訊息(0為不保留)")
+    parser.add_argument("--heartbeat", type=int, default=HEARTBEAT_INTERVAL,
+                        help="client多少秒沒有送來資料時送出PING(0為不送)")
+    parser.add_argument("--heartbeat-timeout", type=int, default=HEARTBEAT_TIMEOUT,
+                        help="client多少秒沒有送來任何資料(包含PING的回覆)時中斷連線")
+    parser.add_argument("--idle-timeout", type=int, default=IDLE_TIMEOUT,
+                        help="聊天室內的client多少秒沒有發言時請它離開，讓排隊者補上(0為不限制)")
+    parser.add_argument("--no-previews", action="store_true",
+                        help="不產生縮圖，圖片一律完整傳送給client(預設先送縮圖，點開時才傳原圖)")
+    parser.add_argument("--send-budget", type=float, default=SEND_BUDGET / (1024 * 1024),
+                        help="每個client最多暫存多少MB尚未送出的資料")
+    parser.add_argument("--slow-policy", choices=[POLICY_DISCONNECT, POLICY_DROP], default=POLICY_DISCONNECT,
+                        help="client暫存超過上限時: 中斷連線 / 丟棄之後的訊息")
+    parser.add_argument("--metrics-port", type=int, help="在127.0.0.1的這個port提供Prometheus格式的指標")
+    parser.add_argument("--metrics-file", help="每10秒把指標寫入這個檔案")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="以多個行程共用text port(SO_REUSEPORT，僅Linux/macOS)，大於1時為無GUI模式且不開啟圖片port")
+    parser.add_argument("--relay", metavar="HOST:PORT",
+                        help="以叢集模式連到relay(python chat_cluster.py)，與其他server共用房間與排隊名單"
+                             "(多行程模式下每個worker都加入這個relay)")
+    args = parser.parse_args()
+    if args.no_image_port:
+        args.image_port = None
+    send_budget = int(args.send_budget * 1024 * 1024)
+    bus = relay = None
+    if args.relay:
+        relay_host, _, relay_port = args.relay.rpartition(":")
+        relay = (relay_host or "127.0.0.1", int(relay_port))
+        bus = RelayBus(relay)
+    if args.workers > 1:
+        run_workers(args.workers, args.host, args.text_port, args.rooms, args.room_size, log_fsync=args.log_fsync,
+                    replay=args.replay, send_budget=send_budget, slow_policy=args.slow_policy,
+                    metrics_port=args.metrics_port, metrics_file=args.metrics_file, resume_grace=args.resume_grace,
+                    heartbeat=args.heartbeat, heartbeat_timeout=args.heartbeat_timeout, idle_timeout=args.idle_timeout,
+                    previews=not args.no_previews, relay=relay)
+    elif args.headless:
+        run_headless(args.host, args.text_port, args.image_port, args.rooms, args.room_size, args.log_fsync,
+                     args.replay, send_budget, args.slow_policy, args.metrics_port, args.metrics_file, bus,
+                     args.resume_grace, args.heartbeat, args.heartbeat_timeout, args.idle_timeout, not args.no_previews)
+    else:
+        ChatServer(args.host, args.text_port, args.image_port, args.rooms, args.room_size, args.log_fsync,
+                   args.replay, send_budget, args.slow_policy, args.metrics_port, args.metrics_file, bus,
+                   args.resume_grace, args.heartbeat, args.heartbeat_timeout, args.idle_timeout,
+                   not args.no_previews).run()
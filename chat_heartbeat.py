@@ -0,0 +1,85 @@
+import math
+import socket
+
+# 連線存活檢查:
+# - frame協定的client一段時間沒有送來任何資料時，server送出CTRL_PING，client以CTRL_PONG回覆；
+#   收到的任何資料都算是還活著，持續HEARTBEAT_TIMEOUT秒完全沒有資料就視為已斷線(half-open)並中斷連線
+# - 聊天室內的client超過idle_timeout秒沒有發言時請它離開，讓排隊者補上(預設不開啟)
+# - accepted socket另外開啟TCP keepalive，舊版協定的client無法回覆PING，至少由kernel偵測對方主機消失
+# 所有連線共用一個TimerWheel，由事件迴圈內的一個task每TICK秒推進一格，不必每條連線各自一個timer
+
+HEARTBEAT_INTERVAL = 15 # 對方沒有送來資料多少秒後送出PING(0為不送)
+HEARTBEAT_TIMEOUT = 45 # 對方沒有送來任何資料多少秒後中斷連線
+IDLE_TIMEOUT = 0 # 聊天室內的client沒有發言多少秒後請它離開(0為不限制)
+TICK = 1.0 # TimerWheel每一格的秒數，逾時的判斷最多晚這麼多
+
+# TCP keepalive: 閒置多少秒後開始探測、探測間隔、連續幾次沒有回應視為斷線
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+# 開啟TCP keepalive並盡量套用探測參數，平台不支援的選項略過
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"): # Linux
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, "TCP_KEEPALIVE"): # macOS
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        elif hasattr(socket, "SIO_KEEPALIVE_VALS"): # Windows，單位為毫秒，次數固定
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+            return
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except (OSError, AttributeError): # asyncio的TransportSocket沒有ioctl
+        pass
+
+
+# hashed timer wheel: slots格，每格放到期時要檢查的key
+# 超過一圈的延遲記下還要轉幾圈，加入/取消都是O(1)，advance()只看目前這一格
+# 只負責「什麼時候該檢查」，是否真的逾時由呼叫端依時間戳記判斷，所以收到資料時不必重新排程
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=64):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)] # 每格: key -> 剩下的圈數
+        self._where = {} # key -> 所在的格子
+        self._cursor = 0
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    # delay秒後檢查key，已經排程過的改為新的時間
+    def schedule(self, key, delay):
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot][key] = (ticks - 1) // len(self._slots)
+        self._where[key] = slot
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    # 前進一格，回傳到期的key(已從wheel移除)
+    def advance(self):
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        bucket = self._slots[self._cursor]
+        expired = []
+        for key, rounds in bucket.items():
+            if rounds:
+                bucket[key] = rounds - 1
+            else:
+                expired.append(key)
+        for key in expired:
+            del bucket[key]
+            del self._where[key]
+        return expired
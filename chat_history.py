@@ -0,0 +1,164 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+HISTORY_FILE = "history.db"
+
+_CLOSE = object() # 通知背景thread結束
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    room INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    peer_ip TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer_ip, ts);
+CREATE INDEX IF NOT EXISTS messages_room ON messages (room, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (body, content='messages', content_rowid='id',
+                                                           tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body) VALUES (new.id, new.body);
+END;
+"""
+
+
+# 一則歷史訊息
+class HistoryMessage:
+    __slots__ = ("id", "ts", "room", "sender", "peer_ip", "body")
+
+    def __init__(self, id, ts, room, sender, peer_ip, body):
+        self.id = id
+        self.ts = ts
+        self.room = room
+        self.sender = sender
+        self.peer_ip = peer_ip
+        self.body = body
+
+
+# 可搜尋的聊天歷史(SQLite WAL + FTS5全文索引)
+# 全文索引使用trigram，中文沒有空白分詞也能搜尋任意片段(3個字以上)，較短的關鍵字改用LIKE比對
+# 只會新增不會修改，寫入方式與LogWriter相同: add()只放進佇列，背景thread每批一個transaction寫入
+# 查詢可從任何thread呼叫，每次使用獨立的連線，WAL模式下不會被寫入擋住
+# 結果一律依時間由舊到新排列；before_id用於往前翻頁(傳入目前最舊一則的id)
+class HistoryStore:
+    # write_time: 同LogWriter，記錄每批寫入花費的時間
+    def __init__(self, path=os.path.join("chat_logs", HISTORY_FILE), flush_every=256, flush_interval=0.2,
+                 write_time=None):
+        self.path = path
+        self.write_time = write_time
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = sqlite3.connect(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(_SCHEMA)
+        db.close()
+
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    # 新增一則訊息，可從任何thread呼叫
+    def add(self, room, sender, peer_ip, body, ts=None):
+        if not self._closed:
+            self._queue.put((time.time() if ts is None else ts, room, sender, peer_ip, body))
+
+    def close(self, timeout=5):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+
+    # ---- 查詢 ----
+
+    # 最近limit則訊息(重新連線的client補看用)，可限定房間
+    def recent(self, limit=50, room=None, before_id=None):
+        return self._select([("room = ?", room), ("id < ?", before_id)], limit)
+
+    # 某個IP送出的訊息，可限定時間範圍(time.time()秒數)
+    def by_peer(self, peer_ip, since=None, until=None, limit=100, before_id=None):
+        return self._select([("peer_ip = ?", peer_ip), ("ts >= ?", since), ("ts < ?", until),
+                             ("id < ?", before_id)], limit)
+
+    # 時間範圍內的訊息
+    def by_time(self, since=None, until=None, limit=100, before_id=None):
+        return self._select([("ts >= ?", since), ("ts < ?", until), ("id < ?", before_id)], limit)
+
+    # 全文搜尋，query以空白分隔的關鍵字需全部出現，可再加上IP與時間條件
+    def search(self, query, peer_ip=None, since=None, until=None, limit=100, before_id=None):
+        conditions = []
+        for term in query.split():
+            if len(term) >= 3:
+                conditions.append(("id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)",
+                                   '"' + term.replace('"', '""') + '"'))
+            else:
+                conditions.append(("body LIKE ? ESCAPE '\\'", "%" + _escape_like(term) + "%"))
+        conditions += [("peer_ip = ?", peer_ip), ("ts >= ?", since), ("ts < ?", until), ("id < ?", before_id)]
+        return self._select(conditions, limit)
+
+    # 這個IP是否曾經發言過(用來判斷是否為重新連線的client)
+    def has_peer(self, peer_ip):
+        with self._reader() as db:
+            return db.execute("SELECT 1 FROM messages WHERE peer_ip = ? LIMIT 1", (peer_ip,)).fetchone() is not None
+
+    # 條件為(SQL, 參數)，參數為None的條件會被略過；先取最新的limit則再反轉成由舊到新
+    def _select(self, conditions, limit):
+        where = [sql for sql, value in conditions if value is not None]
+        params = [value for _, value in conditions if value is not None]
+        sql = "SELECT id, ts, room, sender, peer_ip, body FROM messages"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        with self._reader() as db:
+            rows = db.execute(sql, params + [limit]).fetchall()
+        return [HistoryMessage(*row) for row in reversed(rows)]
+
+    def _reader(self):
+        return closing(sqlite3.connect(self.path))
+
+    # ---- 背景寫入 ----
+
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA synchronous=NORMAL") # WAL模式下仍能保證資料庫一致
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_every and batch[-1] is not _CLOSE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is _CLOSE:
+                batch.pop()
+                stopping = True
+            if not batch:
+                continue
+            try:
+                start = time.perf_counter()
+                with db:
+                    db.executemany("INSERT INTO messages (ts, room, sender, peer_ip, body) VALUES (?, ?, ?, ?, ?)",
+                                   batch)
+                if self.write_time:
+                    self.write_time.observe(time.perf_counter() - start)
+            except sqlite3.Error as e:
+                print(f"[歷史紀錄寫入失敗]: {e}")
+        db.close()
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
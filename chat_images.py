@@ -0,0 +1,204 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+from chat_store import CONTENT_DIR, ContentStore
+
+THUMBNAIL_SIZE = (200, 200) # 訊息框內顯示的縮圖大小
+THUMBNAIL_BUDGET = 32 * 1024 * 1024 # 記憶體內縮圖的總大小上限(bytes)
+EVICTED_TEXT = "[圖片] 點擊開啟"
+PREVIEW = "preview" # server產生的縮圖在ContentStore中的衍生檔種類
+PREVIEW_QUALITY = 75
+
+
+# 圖片來源可能是檔案路徑(本機選取的圖片)或收到的bytes
+def open_image(source):
+    if isinstance(source, str):
+        return Image.open(source)
+    return Image.open(io.BytesIO(source))
+
+
+# 解碼圖片，size不為None時同時縮圖(在worker thread執行)
+def decode_image(source, size=THUMBNAIL_SIZE):
+    img = open_image(source)
+    if size is not None:
+        # JPEG可以在解碼時直接以1/2、1/4、1/8比例縮小，省下大部分解碼時間與記憶體
+        if img.format == "JPEG":
+            img.draft(img.mode, size)
+        img.thumbnail(size)
+    img.load()
+    return img
+
+
+# server端為收到的圖片產生一次縮圖，client先收縮圖，點開時才下載原圖
+# 不透明的圖片存成progressive JPEG(慢速連線上先出現模糊的全圖)，有透明度的存成WebP(不支援時PNG)
+# 縮圖沒有比原圖小(原圖本身就很小)時回傳空bytes，代表直接傳原圖即可
+def make_preview(source, size=THUMBNAIL_SIZE):
+    img = decode_image(source, size)
+    out = io.BytesIO()
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+        if features.check("webp"):
+            img.save(out, "WEBP", quality=PREVIEW_QUALITY)
+        else:
+            img.save(out, "PNG", optimize=True)
+    else:
+        img.convert("RGB").save(out, "JPEG", quality=PREVIEW_QUALITY, progressive=True, optimize=True)
+    data = out.getvalue()
+    total = os.path.getsize(source) if isinstance(source, str) else len(source)
+    return data if len(data) < total else b""
+
+
+# 聊天室圖片的存放處
+# - 縮圖(PhotoImage)以LRU方式保留在記憶體，總大小超過上限時把最久沒用到的換成文字佔位
+# - 原圖不留在記憶體，交給以內容hash命名的ContentStore，點開大圖時才從磁碟讀取
+# put_original可在worker thread呼叫，其餘方法只能在Tk主執行緒使用
+class ImageStore:
+    # content: 可傳入既有的ContentStore與網路端共用(server GUI使用ChatCore的)
+    def __init__(self, cache_dir=CONTENT_DIR, memory_budget=THUMBNAIL_BUDGET, content: ContentStore = None):
+        self.content = content or ContentStore(cache_dir)
+        self.memory_budget = memory_budget
+        self._thumbs = OrderedDict() # digest -> (PhotoImage, 佔用bytes)
+        self._widgets = {} # digest -> 顯示這張圖的Label
+        self._used = 0
+
+    # 保存原圖並回傳digest
+    def put_original(self, source):
+        return self.content.put(source)
+
+    # 原圖的檔案路徑，找不到時回傳None
+    def original(self, digest):
+        return self.content.path(digest)
+
+    # server送來的縮圖，原圖還沒下載時用來重新產生被換出的縮圖
+    def put_preview(self, digest, data):
+        return self.content.put_variant(digest, PREVIEW, data)
+
+    def preview(self, digest):
+        return self.content.variant(digest, PREVIEW)
+
+    def has_thumbnail(self, digest):
+        return digest in self._thumbs
+
+    # 加入一張縮圖，同一張圖片的多個Label共用同一個PhotoImage
+    def add_thumbnail(self, digest, photo):
+        if digest in self._thumbs:
+            self._thumbs.move_to_end(digest)
+            return
+        self._put_thumb(digest, photo)
+
+    # 登記/取消登記顯示縮圖的Label，縮圖被換出或重新載入時會一起更新
+    def attach_widget(self, digest, widget):
+        self._widgets.setdefault(digest, []).append(widget)
+
+    def detach_widget(self, digest, widget):
+        widgets = self._widgets.get(digest)
+        if widgets and widget in widgets:
+            widgets.remove(widget)
+            if not widgets:
+                del self._widgets[digest]
+
+    # 被換出的縮圖重新載入後放回所有對應的Label
+    def restore_thumbnail(self, digest, photo):
+        if digest not in self._thumbs:
+            self._put_thumb(digest, photo)
+        photo = self._thumbs[digest][0]
+        for widget in self._widgets.get(digest, ()):
+            widget.config(image=photo, text="")
+            widget.image = photo
+
+    def get_thumbnail(self, digest):
+        entry = self._thumbs.get(digest)
+        if entry is None:
+            return None
+        self._thumbs.move_to_end(digest)
+        return entry[0]
+
+    def _put_thumb(self, digest, photo):
+        size = photo.width() * photo.height() * 4
+        self._thumbs[digest] = (photo, size)
+        self._used += size
+        while self._used > self.memory_budget and len(self._thumbs) > 1:
+            old, (_, old_size) = self._thumbs.popitem(last=False)
+            self._used -= old_size
+            for widget in self._widgets.get(old, ()):
+                try:
+                    widget.config(image="", text=EVICTED_TEXT)
+                    widget.image = None
+                except Exception: # widget已被刪除
+                    pass
+
+
+# 圖片處理pipeline: 解碼與縮圖交給背景thread pool，完成的結果才交回Tk主執行緒
+# 同時處理中的圖片數有上限，短時間湧入大量圖片時不會把記憶體吃光
+class ImagePipeline:
+    # post(fn, *args): 把結果交回Tk主執行緒的方式，預設為window.after(0, ...)
+    # decode_time: 有observe(秒數)的物件(例如chat_metrics的Histogram)，記錄每張圖片的處理時間
+    def __init__(self, window, store: ImageStore = None, workers=2, max_pending=8, post=None, decode_time=None):
+        self.window = window
+        self.store = store
+        self.decode_time = decode_time
+        self._post = post or (lambda fn, *args: window.after(0, fn, *args))
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+
+    # 送出一張圖片處理，完成後在Tk主執行緒呼叫callback(PIL Image)，失敗時呼叫on_error(例外)
+    # block=True時佇列已滿會等待(接收thread使用，連帶讓TCP放慢對方傳送)
+    # block=False時佇列已滿直接回傳False(Tk主執行緒與事件迴圈使用，不能被卡住)
+    def submit(self, source, callback, on_error=None, size=THUMBNAIL_SIZE, block=True):
+        return self._submit(decode_image, (source, size), callback, on_error, block)
+
+    # 聊天訊息中的圖片: 原圖交給ImageStore保存後只留digest，callback(縮圖, digest)
+    # post可指定這張圖片結果的交付方式(例如填入UiQueue預留的位置，保持和文字訊息的順序)
+    # size=None時callback收到完整大小的圖片(點開大圖時才下載的原圖)
+    def submit_message_image(self, source, callback, on_error=None, block=True, post=None, size=THUMBNAIL_SIZE):
+        return self._submit(self._store_and_decode, (source, size), lambda result: callback(*result), on_error,
+                            block, post)
+
+    # server送來的縮圖: 以原圖的digest保存，callback(縮圖, digest)
+    def submit_preview(self, digest, data, callback, on_error=None, block=True, post=None):
+        return self._submit(self._store_preview, (digest, data), lambda result: callback(*result), on_error, block,
+                            post)
+
+    def _store_and_decode(self, source, size=THUMBNAIL_SIZE):
+        digest = self.store.put_original(source)
+        return decode_image(source, size), digest
+
+    def _store_preview(self, digest, data):
+        self.store.put_preview(digest, data)
+        return decode_image(data), digest
+
+    def _submit(self, fn, args, callback, on_error, block, post=None):
+        if not self._slots.acquire(blocking=block):
+            return False
+        try:
+            future = self._pool.submit(self._run, fn, args)
+        except RuntimeError: # pipeline已關閉
+            self._slots.release()
+            return False
+        future.add_done_callback(lambda f: self._done(f, callback, on_error, post or self._post))
+        return True
+
+    def _run(self, fn, args):
+        if self.decode_time is None:
+            return fn(*args)
+        with self.decode_time.time():
+            return fn(*args)
+
+    def _done(self, future, callback, on_error, post):
+        self._slots.release()
+        if future.cancelled():
+            return
+        try:
+            exc = future.exception()
+            if exc is None:
+                post(callback, future.result())
+            elif on_error:
+                post(on_error, exc)
+        except RuntimeError: # 視窗已關閉
+            pass
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,122 @@
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+# fsync策略
+FSYNC_NEVER = "never" # 交給作業系統決定何時寫入磁碟
+FSYNC_ROTATE = "rotate" # 換檔與關閉時才fsync
+FSYNC_ALWAYS = "always" # 每次批次寫入後都fsync，最安全但最慢
+
+_CLOSE = object() # 通知背景thread結束
+
+
+# 背景寫入的聊天紀錄檔
+# write()只把文字放進佇列，不在呼叫端(事件迴圈/GUI)做任何檔案I/O
+# 背景thread把累積的訊息合併成一次寫入: 湊滿flush_every則或距離第一則超過flush_interval秒就寫出
+# 檔案超過max_bytes或開啟超過rotate_interval秒時換新檔，檔名為換檔當下的時間
+# write_time: 有observe(秒數)的物件(例如chat_metrics的Histogram)，記錄每批寫入花費的時間
+class LogWriter:
+    def __init__(self, log_dir="chat_logs", prefix="chat_log", flush_every=64, flush_interval=0.2,
+                 fsync=FSYNC_ROTATE, max_bytes=10 * 1024 * 1024, rotate_interval=24 * 60 * 60, write_time=None):
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.write_time = write_time
+        os.makedirs(log_dir, exist_ok=True)
+
+        self.path = None
+        self._file = None
+        self._opened_at = 0
+        self._size = 0
+        self._open()
+
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    # 可從任何thread呼叫
+    def write(self, line):
+        if not self._closed:
+            self._queue.put(line)
+
+    # 寫出佇列內剩下的紀錄並關閉檔案
+    def close(self, timeout=5):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+
+    def _open(self):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(self.log_dir, f"{self.prefix}_{timestamp}.txt")
+        # 同一秒內換檔時加上序號避免覆寫同一個檔案
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(self.log_dir, f"{self.prefix}_{timestamp}_{n}.txt")
+            n += 1
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._opened_at = time.monotonic()
+        self._size = self._file.tell()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _rotate_if_needed(self):
+        if self._size < self.max_bytes and time.monotonic() - self._opened_at < self.rotate_interval:
+            return
+        if self.fsync != FSYNC_NEVER:
+            self._sync()
+        self._file.close()
+        self._open()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # group commit: 在期限內盡量多收幾則再一起寫出
+            while len(batch) < self.flush_every and batch[-1] is not _CLOSE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is _CLOSE:
+                batch.pop()
+                closing = True
+            try:
+                start = time.perf_counter()
+                self._write_batch(batch)
+                if self.write_time and batch:
+                    self.write_time.observe(time.perf_counter() - start)
+            except Exception as e:
+                print(f"[log 寫入失敗]: {e}")
+        try:
+            if self.fsync != FSYNC_NEVER:
+                self._sync()
+            self._file.close()
+        except Exception as e:
+            print(f"[log 寫入失敗]: {e}")
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        data = "".join(batch)
+        self._file.write(data)
+        self._file.flush()
+        self._size = self._file.tell()
+        if self.fsync == FSYNC_ALWAYS:
+            os.fsync(self._file.fileno())
+        self._rotate_if_needed()
@@ -0,0 +1,166 @@
+import bisect
+import os
+import threading
+import time
+
+# 處理時間的bucket(秒)
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05) # 每個frame的處理時間
+SLOW_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # 磁碟寫入、圖片解碼
+
+
+# ---- 基本的指標種類，輸出格式與Prometheus的text format相同 ----
+# 每個指標可以有label(例如port="text")，labels()取得對應的子指標後直接更新，熱路徑上只是整數相加
+# Counter/Gauge只在單一thread(事件迴圈)更新；Histogram可能從背景thread更新，以lock保護
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+# fn不為None時在輸出時呼叫fn()取得目前的值
+class Gauge:
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name, labels, self.fn() if self.fn else self.value
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # 最後一格為+Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # 用法: with histogram.time(): ...
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += n
+            yield f"{name}_bucket", labels + (("le", str(bound)),), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, count
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+# 一個指標名稱與其所有label組合
+class Family:
+    def __init__(self, name, help, kind, label_names, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = label_names
+        self._factory = factory
+        self._children = {}
+        if not label_names:
+            self._children[()] = factory()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._factory())
+        return child
+
+    # 沒有label的指標直接使用
+    def __getattr__(self, attr):
+        return getattr(self._children[()], attr)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.label_names, values))):
+                if labels:
+                    name += "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+                lines.append(f"{name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._families = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Family(name, help, "counter", labels, Counter))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self._add(Family(name, help, "gauge", labels, lambda: Gauge(fn)))
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self._add(Family(name, help, "histogram", labels, lambda: Histogram(buckets)))
+
+    def _add(self, family):
+        self._families.append(family)
+        return family
+
+    def render(self):
+        lines = []
+        for family in self._families:
+            lines += family.render()
+        return "\n".join(lines) + "\n"
+
+    # 寫入暫存檔後再取代，讀取端不會讀到寫一半的內容
+    def dump(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+# server的所有指標，active/waiting為輸出時取得目前人數的函式
+class ServerMetrics:
+    def __init__(self, active=None, waiting=None):
+        r = self.registry = Registry()
+        self.connections = r.counter("chat_connections_total", "已接受的連線數", ("port",))
+        self.active = r.gauge("chat_active_clients", "聊天室內的client數", fn=active)
+        self.waiting = r.gauge("chat_waiting_clients", "排隊中的client數", fn=waiting)
+        self.bytes_in = r.counter("chat_received_bytes_total", "收到的bytes數", ("port",))
+        self.bytes_out = r.counter("chat_sent_bytes_total", "送出的bytes數(放進送出緩衝區)", ("port",))
+        self.frames = r.counter("chat_frames_total", "收到的frame數", ("type",))
+        self.frame_time = r.histogram("chat_frame_handle_seconds", "每個收到的frame的處理時間", FAST_BUCKETS)
+        self.image_decode = r.histogram("chat_image_decode_seconds", "圖片解碼與縮圖時間(GUI)", SLOW_BUCKETS)
+        self.log_write = r.histogram("chat_log_write_seconds", "紀錄檔每批寫入的時間", SLOW_BUCKETS)
+        self.history_write = r.histogram("chat_history_write_seconds", "歷史資料庫每批寫入的時間", SLOW_BUCKETS)
+        self.dropped = r.counter("chat_dropped_frames_total", "暫存超過上限而丟棄的訊息數")
+        self.overflows = r.counter("chat_overflow_disconnects_total", "暫存超過上限而中斷的連線數")
+        self.resumes = r.counter("chat_resumed_sessions_total", "斷線後在保留時間內接回座位的連線數")
+        self.previews = r.counter("chat_image_previews_total", "送出的縮圖數(preview)與client點開後才送出的原圖數(fetch)",
+                                  ("kind",))
+        self.reaped = r.counter("chat_reaped_connections_total", "沒有回應或閒置過久而被中斷的連線數", ("reason",))
+        self.errors = r.counter("chat_errors_total", "被忽略的例外數", ("where",))
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import deque
+
+# 送出緩衝區的水位(bytes)
+SEND_HIGH_WATER = 256 * 1024 # 超過時暫停送出新的圖片片段(背壓)
+SEND_LOW_WATER = 64 * 1024 # 降到這裡以下才繼續
+SEND_BUDGET = 8 * 1024 * 1024 # 每條連線最多暫存的資料量，超過時依policy處理
+SLOW_NOTICE_DELAY = 1.0 # 超過高水位持續這麼多秒才視為對方太慢並通知畫面，一般的圖片傳送不會觸發
+
+# 超過SEND_BUDGET時的處理方式
+POLICY_DROP = "drop" # 丟掉新的訊息，連線保留
+POLICY_DISCONNECT = "disconnect" # 中斷連線
+
+
+# 一條blocking socket的送出佇列(client端)
+# 呼叫端只把資料放進佇列，由專屬的writer thread負責sendall，Tk主執行緒不會被慢的連線卡住
+# - put(block=False): 給Tk主執行緒/接收thread，超過budget時丟棄並回傳False
+# - put(block=True): 給圖片傳送thread，超過高水位時等到降回低水位，不會無限制地把檔案讀進記憶體
+# on_slow(bool): 對方太慢/已恢復時呼叫，為了保持通知的順序是在持有lock時呼叫，callback內不可再呼叫put
+# on_error(exc): 送出失敗時呼叫一次，之後佇列關閉
+class SocketOutbox:
+    def __init__(self, sock, high=SEND_HIGH_WATER, low=SEND_LOW_WATER, budget=SEND_BUDGET,
+                 on_slow=None, on_error=None):
+        self.sock = sock
+        self.high = high
+        self.low = low
+        self.budget = budget
+        self.on_slow = on_slow
+        self.on_error = on_error
+        self.dropped = 0 # 因超過budget被丟掉的訊息數
+        self._queue = deque() # 每一項為要連續送出的多段bytes
+        self._queued = 0 # 佇列內與writer thread正在送出的資料量
+        self._sending = False # writer thread已取出一項、sendall尚未完成
+        self._paused = False # 超過高水位，尚未降回低水位
+        self._paused_since = 0
+        self._slow = False # 已通知畫面對方太慢
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    # 放入一則要送出的資料(bytes或多段bytes的list)，佇列已關閉或被丟棄時回傳False
+    def put(self, data, block=False):
+        parts = data if isinstance(data, list) else [data]
+        size = sum(len(p) for p in parts)
+        with self._cond:
+            if block:
+                while self._paused and not self._closed:
+                    self._cond.wait(SLOW_NOTICE_DELAY)
+                    self._check_slow()
+            if self._closed:
+                accepted = False
+            elif not block and self._queued and self._queued + size > self.budget: # 佇列是空的時不限制單筆大小
+                self.dropped += 1
+                accepted = False
+            else:
+                self._queue.append(parts)
+                self._queued += size
+                if not self._paused and self._queued > self.high:
+                    self._paused = True
+                    self._paused_since = time.monotonic()
+                self._cond.notify_all()
+                accepted = True
+            self._check_slow()
+        return accepted
+
+    # 與put(block=False)相同，但資料由make()產生，只有確定放得進佇列時才會呼叫
+    # 用於有狀態的編碼(例如連續的壓縮context)，編碼後的資料不能被丟掉
+    # size: 預估的資料大小，make()在持有lock時呼叫，放進佇列的順序與編碼的順序一致
+    def put_encoded(self, size, make):
+        with self._cond:
+            if self._closed:
+                accepted = False
+            elif self._queued and self._queued + size > self.budget:
+                self.dropped += 1
+                accepted = False
+            else:
+                data = make()
+                self._queue.append([data])
+                self._queued += len(data)
+                if not self._paused and self._queued > self.high:
+                    self._paused = True
+                    self._paused_since = time.monotonic()
+                self._cond.notify_all()
+                accepted = True
+            self._check_slow()
+        return accepted
+
+    @property
+    def slow(self):
+        return self._slow
+
+    def queued_bytes(self):
+        return self._queued
+
+    # 等待佇列送完(最多timeout秒)，包含writer thread正在sendall的最後一項，回傳是否已送完
+    def flush(self, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: not (self._queue or self._sending) or self._closed, timeout)
+
+    # 停止writer thread，尚未送出的資料直接丟棄
+    # 正在sendall的那一項送完後writer thread不再更新_queued，計數維持為0
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._queued = 0
+            self._cond.notify_all()
+
+    # 高水位維持超過SLOW_NOTICE_DELAY時標記為太慢並通知
+    def _check_slow(self):
+        if self._paused and not self._slow and time.monotonic() - self._paused_since >= SLOW_NOTICE_DELAY:
+            self._slow = True
+            if self.on_slow:
+                self.on_slow(True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                parts = self._queue.popleft()
+                self._sending = True
+            try:
+                for part in parts:
+                    self.sock.sendall(part)
+            except OSError as e:
+                self.close()
+                if self.on_error:
+                    self.on_error(e)
+                return
+            with self._cond:
+                self._sending = False
+                if self._closed: # close()已清空佇列與計數
+                    self._cond.notify_all()
+                    return
+                self._queued -= sum(len(p) for p in parts)
+                if not self._queue:
+                    self._cond.notify_all()
+                if self._paused and self._queued <= self.low:
+                    self._paused = False
+                    self._cond.notify_all()
+                    if self._slow:
+                        self._slow = False
+                        if self.on_slow:
+                            self.on_slow(False)
@@ -0,0 +1,619 @@
+import asyncio
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import namedtuple
+
+# ---- 單一連線的frame協定 ----
+# 舊格式: 4 byte長度 + 內容，文字與圖片各走一條連線
+# 新格式: client連線後先送出HELLO，server回覆同樣的HELLO後，雙方都改用frame溝通，
+#         文字、圖片、控制訊息都在同一條連線上，以type與stream id區分
+# MAGIC若被舊版程式當成長度會是約4GB，正常訊息不可能出現，因此可以和舊格式共存
+# HELLO的最後一個byte為協定版本，版本不同時不改用frame協定(標頭格式不相容)
+# 版本2: 標頭加上序號、傳送者id與時間戳記，傳送者名稱只在第一次出現時以CTRL_MEMBER告知
+# 版本3: client在HELLO之後送出交握用的控制訊息(CTRL_COMPRESS/CTRL_PREVIEW/CTRL_RESUME)，以CTRL_READY結束，
+#        server讀完交握才安排座位，歡迎/排隊訊息一律以frame送出，接回座位的client也不會先被排進隊伍
+
+MAGIC = b'\xffTCF'
+VERSION = 3
+HELLO = MAGIC + bytes([VERSION])
+
+# frame種類
+FRAME_TEXT = 1
+FRAME_IMAGE = 2 # 圖片資料片段: offset(8) + 資料，同一張圖片的片段使用相同stream id(即transfer id)
+FRAME_CONTROL = 3 # 控制訊息，payload第一個byte為控制碼
+FRAME_IMAGE_BEGIN = 4 # 圖片傳輸開始: 總大小(8) + 檔名
+FRAME_RESUME = 5 # 接收端要求從指定offset(8)重新傳送
+FRAME_IMAGE_OFFER = 6 # 傳送圖片前先送出內容hash(32) + 總大小(8) + 檔名，接收端以FRAME_IMAGE_ACCEPT回覆
+FRAME_IMAGE_ACCEPT = 7 # 回覆OFFER: 1 byte，ACCEPT_HAVE時不必傳送，ACCEPT_SEND時照常BEGIN+片段
+FRAME_IMAGE_PREVIEW = 8 # server -> client: 原圖的OFFER(hash + 總大小) + server產生的縮圖，原圖等client要求時才傳送
+FRAME_IMAGE_FETCH = 9 # client -> server: 要求原圖(hash)，server以OFFER+BEGIN+片段送出；找不到時以同一種frame回覆
+FRAME_NAMES = {FRAME_TEXT: "text", FRAME_IMAGE: "image", FRAME_CONTROL: "control", FRAME_IMAGE_BEGIN: "image_begin",
+               FRAME_RESUME: "resume", FRAME_IMAGE_OFFER: "image_offer", FRAME_IMAGE_ACCEPT: "image_accept",
+               FRAME_IMAGE_PREVIEW: "image_preview", FRAME_IMAGE_FETCH: "image_fetch"}
+
+# frame flags
+FLAG_END = 0x01 # 該stream的最後一個frame
+FLAG_COMPRESSED = 0x02 # 文字內容以TextCodec壓縮
+
+# 控制碼
+CTRL_WELCOME = 1 # 已進入聊天室
+CTRL_QUEUE = 2 # 排隊位置更新
+CTRL_MEMBER = 3 # 傳送者id(2) + 名稱，接收端記下後以標頭的傳送者id查表
+CTRL_COMPRESS = 4 # 可以解壓縮FLAG_COMPRESSED的文字，雙方都送過之後才開始壓縮
+CTRL_SESSION = 5 # server -> client: token(16) + 保留秒數(2)，斷線後在保留時間內可以用CTRL_RESUME接回原本的座位
+                 # 交握後送出、不帶序號；接回座位時token不變，token不同代表新的連線，序號從頭開始
+CTRL_RESUME = 6 # client -> server: token(16) + 最後收到的序號(4)；server以同一控制碼回覆結果(文字)
+CTRL_BYE = 7 # client主動離開，server不必保留座位；server送出時(附上原因文字)表示請client離開，不要自動重連
+CTRL_PING = 8 # 確認對方還在，收到後以CTRL_PONG回覆；兩者都不編序號，不會被補送
+CTRL_PONG = 9
+CTRL_FILE_OFFER = 10 # 分享檔案: FILE_OFFER + 分享端位址 + \0 + 檔名，內容不經過聊天連線，由接收端直接連到分享端下載
+CTRL_PREVIEW = 11 # client -> server: 圖片先收縮圖(FRAME_IMAGE_PREVIEW)，點開時才以FRAME_IMAGE_FETCH下載原圖
+CTRL_READY = 12 # client -> server: 交握結束，server收到後才安排座位
+
+# 傳送者id，其餘(2~65535)由server分配給各個client
+SENDER_NONE = 0 # 不屬於任何人(系統訊息，或內容已包含傳送者名稱)
+SENDER_SERVER = 1
+FIRST_SENDER_ID = 2
+
+# OFFER的回覆
+ACCEPT_SEND = 0
+ACCEPT_HAVE = 1
+
+# frame標頭: type(1) flags(1) stream id(2) 序號(4) 傳送者id(2) 時間戳記(毫秒，8) 長度(4)
+# 序號為該連線上送出的文字/控制訊息的編號(從1開始)，圖片相關的frame以stream id與offset區分，序號為0
+HEADER = struct.Struct('!BBHIHQI')
+FrameHeader = namedtuple("FrameHeader", "frame_type flags stream seq sender timestamp length")
+# 長度欄位由對方決定，配置緩衝區前先檢查，超過時丟出ProtocolError
+MAX_FRAME_SIZE = 256 * 1024 # 一個frame內容(圖片片段、文字)與一則舊格式文字訊息的上限
+MAX_TEXT_LENGTH = 64 * 1024 # 單則聊天訊息的上限(bytes)，server轉送時加上名稱、補送時合併多則仍在MAX_FRAME_SIZE之內
+# 圖片傳輸的offset/總大小欄位
+OFFSET = struct.Struct('!Q')
+# 圖片OFFER: 內容hash(BLAKE2b 32 bytes) + 總大小
+OFFER = struct.Struct('!32sQ')
+# FRAME_IMAGE_FETCH: 原圖的內容hash
+FETCH = struct.Struct('!32s')
+# CTRL_MEMBER的傳送者id
+MEMBER = struct.Struct('!H')
+# CTRL_SESSION: token + 保留秒數；CTRL_RESUME: token + 最後收到的序號
+SESSION = struct.Struct('!16sH')
+SESSION_RESUME = struct.Struct('!16sI')
+# CTRL_FILE_OFFER: 下載用的token + 內容hash + 大小 + 分享端的port
+FILE_OFFER = struct.Struct('!16s32sQH')
+# host為空字串時代表分享端就是聊天server本身；client分享時由server填入client的位址再轉送
+FileOffer = namedtuple("FileOffer", "token digest size port host name")
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+# timestamp為None時使用目前時間
+def pack_header(frame_type, length, stream=0, flags=0, seq=0, sender=SENDER_NONE, timestamp=None):
+    return HEADER.pack(frame_type, flags, stream, seq, sender, now_ms() if timestamp is None else timestamp, length)
+
+
+def encode_frame(frame_type, payload=b'', stream=0, flags=0, seq=0, sender=SENDER_NONE, timestamp=None):
+    return pack_header(frame_type, len(payload), stream, flags, seq, sender, timestamp) + payload
+
+
+def encode_text(text: str, seq=0, sender=SENDER_NONE, timestamp=None):
+    return encode_frame(FRAME_TEXT, text.encode(), seq=seq, sender=sender, timestamp=timestamp)
+
+
+def encode_control(code, text="", seq=0):
+    return encode_frame(FRAME_CONTROL, bytes([code]) + text.encode(), seq=seq)
+
+
+# 回傳(控制碼, 文字)；CTRL_MEMBER請改用decode_member
+def decode_control(payload):
+    return payload[0], bytes(payload[1:]).decode(errors="replace")
+
+
+def encode_member(sender, name, seq=0):
+    return encode_frame(FRAME_CONTROL, bytes([CTRL_MEMBER]) + MEMBER.pack(sender) + name.encode(), seq=seq)
+
+
+# 回傳(傳送者id, 名稱)
+def decode_member(payload):
+    return MEMBER.unpack_from(payload, 1)[0], bytes(payload[1 + MEMBER.size:]).decode(errors="replace")
+
+
+def encode_session(token, grace, seq=0):
+    return encode_frame(FRAME_CONTROL, bytes([CTRL_SESSION]) + SESSION.pack(token, grace), seq=seq)
+
+
+# 回傳(token, 保留秒數)
+def decode_session(payload):
+    return SESSION.unpack_from(payload, 1)
+
+
+def encode_session_resume(token, last_seq):
+    return encode_frame(FRAME_CONTROL, bytes([CTRL_RESUME]) + SESSION_RESUME.pack(token, last_seq))
+
+
+# 回傳(token, 最後收到的序號)
+def decode_session_resume(payload):
+    return SESSION_RESUME.unpack_from(payload, 1)
+
+
+def encode_file_offer(offer: FileOffer, seq=0, sender=SENDER_NONE):
+    return encode_frame(FRAME_CONTROL, bytes([CTRL_FILE_OFFER]) + pack_file_offer(offer), seq=seq, sender=sender)
+
+
+# FILE_OFFER + 分享端位址 + \0 + 檔名(叢集內轉送時也使用同樣的格式)
+def pack_file_offer(offer: FileOffer):
+    return (FILE_OFFER.pack(offer.token, bytes.fromhex(offer.digest), offer.size, offer.port)
+            + offer.host.encode() + b"\0" + offer.name.encode())
+
+
+# start: FILE_OFFER在payload內的位置，CTRL_FILE_OFFER的payload第一個byte是控制碼
+def decode_file_offer(payload, start=1) -> FileOffer:
+    token, digest, size, port = FILE_OFFER.unpack_from(payload, start)
+    host, _, name = bytes(payload[start + FILE_OFFER.size:]).partition(b"\0")
+    return FileOffer(token, digest.hex(), size, port, host.decode(errors="replace"), name.decode(errors="replace"))
+
+
+def encode_image_begin(stream, total, name="", sender=SENDER_NONE):
+    return encode_frame(FRAME_IMAGE_BEGIN, OFFSET.pack(total) + name.encode(), stream, sender=sender)
+
+
+# 圖片片段的標頭，資料部分另外傳入以免多複製一次
+def image_chunk_header(stream, offset, length, last, sender=SENDER_NONE):
+    return pack_header(FRAME_IMAGE, OFFSET.size + length, stream, FLAG_END if last else 0,
+                       sender=sender) + OFFSET.pack(offset)
+
+
+def encode_resume(stream, offset):
+    return encode_frame(FRAME_RESUME, OFFSET.pack(offset), stream)
+
+
+# digest為hex字串(與ContentStore的檔名相同)，傳輸時轉回原始bytes
+def encode_image_offer(stream, digest, total, name="", sender=SENDER_NONE):
+    return encode_frame(FRAME_IMAGE_OFFER, OFFER.pack(bytes.fromhex(digest), total) + name.encode(), stream,
+                        sender=sender)
+
+
+# 回傳(digest hex, 總大小, 檔名)
+def decode_image_offer(payload):
+    digest, total = OFFER.unpack_from(payload)
+    return digest.hex(), total, bytes(payload[OFFER.size:]).decode(errors="replace")
+
+
+def encode_image_accept(stream, have):
+    return encode_frame(FRAME_IMAGE_ACCEPT, bytes([ACCEPT_HAVE if have else ACCEPT_SEND]), stream)
+
+
+def encode_image_preview(digest, total, data, sender=SENDER_NONE):
+    return encode_frame(FRAME_IMAGE_PREVIEW, OFFER.pack(bytes.fromhex(digest), total) + data, sender=sender)
+
+
+# 回傳(原圖digest hex, 原圖大小, 縮圖bytes)
+def decode_image_preview(payload):
+    digest, total = OFFER.unpack_from(payload)
+    return digest.hex(), total, bytes(payload[OFFER.size:])
+
+
+def encode_image_fetch(digest):
+    return encode_frame(FRAME_IMAGE_FETCH, FETCH.pack(bytes.fromhex(digest)))
+
+
+def decode_image_fetch(payload):
+    return FETCH.unpack_from(payload)[0].hex()
+
+
+# ---- 文字壓縮 ----
+# 超過門檻的文字frame以raw deflate壓縮，每條連線各自保留一組壓縮/解壓縮的context:
+# 同一條連線上前面的訊息會成為後面訊息的字典，加上預設字典(常見的名稱與系統訊息)，
+# 歷史補送與大段貼上的重複內容可以壓得很小；每則訊息以Z_SYNC_FLUSH結尾，收到就能完整解出
+# 因為context是連續的，壓縮後的frame必須依壓縮的順序送出，接收端也必須依序解壓縮
+
+COMPRESS_THRESHOLD = 256 # 文字超過這麼多bytes才壓縮，太短的壓縮後反而變長
+COMPRESS_LEVEL = 6
+MAX_TEXT_SIZE = MAX_FRAME_SIZE # 解壓縮後的上限
+COMPRESS_DICT = ("Server(Client(127.0.0.1):192.168.10.0.歡迎進入聊天室\n您是第 位等待中，請稍候...\n"
+                 "----- 最近 則訊息 -----\n[圖片已送出 - ] 已連線！").encode()
+
+
+# max_text: 收到的文字(解壓縮後)的上限，server端以MAX_TEXT_LENGTH限制client送來的訊息
+class TextCodec:
+    def __init__(self, threshold=COMPRESS_THRESHOLD, max_text=MAX_TEXT_SIZE):
+        self.threshold = threshold
+        self.max_text = max_text
+        self.enabled = False # 對方已送出CTRL_COMPRESS
+        # 壓縮/解壓縮的context各佔數十KB，第一次真的用到時才建立，沒有協商壓縮的連線不需要
+        self._compressor = None
+        self._decompressor = None
+        # 文字內容壓縮前/實際傳輸的bytes數
+        self.sent_raw = self.sent_wire = 0
+        self.recv_raw = self.recv_wire = 0
+
+    # 與encode_text相同，enabled且超過門檻時壓縮
+    def encode_text(self, text: str, seq=0, sender=SENDER_NONE, timestamp=None):
+        return b"".join(self.encode_parts(text.encode(), seq, sender, timestamp))
+
+    # data為已經編碼好的文字，回傳(標頭, 內容)；不壓縮時內容就是data本身，廣播時所有成員共用同一份
+    def encode_parts(self, data, seq=0, sender=SENDER_NONE, timestamp=None):
+        flags = 0
+        self.sent_raw += len(data)
+        if self.enabled and len(data) >= self.threshold:
+            if self._compressor is None:
+                self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=COMPRESS_DICT)
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            flags = FLAG_COMPRESSED
+        self.sent_wire += len(data)
+        return pack_header(FRAME_TEXT, len(data), flags=flags, seq=seq, sender=sender, timestamp=timestamp), data
+
+    # 解壓縮失敗時丟出zlib.error，超過max_text時丟出ProtocolError
+    def decode_text(self, flags, payload) -> str:
+        self.recv_wire += len(payload)
+        if flags & FLAG_COMPRESSED:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj(-15, zdict=COMPRESS_DICT)
+            data = self._decompressor.decompress(payload, self.max_text)
+            if self._decompressor.unconsumed_tail:
+                raise ProtocolError("文字訊息過長")
+        else:
+            data = payload
+            if len(data) > self.max_text:
+                raise ProtocolError("文字訊息過長")
+        self.recv_raw += len(data)
+        return str(data, "utf-8", "replace")
+
+    # 有壓縮過時回傳統計文字，否則回傳None
+    def summary(self):
+        if self.sent_raw == self.sent_wire and self.recv_raw == self.recv_wire:
+            return None
+        return (f"文字壓縮: 送出 {self.sent_raw} → {self.sent_wire} bytes，"
+                f"接收 {self.recv_wire} → {self.recv_raw} bytes")
+
+
+# 對方送來格式錯誤或超過上限的資料，收到時應中斷該連線
+class ProtocolError(ValueError):
+    pass
+
+
+# stream id產生器，0保留給不屬於任何stream的frame
+class StreamIds:
+    def __init__(self):
+        self._next = 0
+
+    def next(self):
+        self._next = self._next % 0xFFFF + 1
+        return self._next
+
+
+# 訊息序號產生器(4 bytes，從1開始)
+class Sequence:
+    def __init__(self):
+        self.last = 0
+
+    def next(self):
+        self.last = self.last % 0xFFFFFFFF + 1
+        return self.last
+
+
+# ---- 接收端: 預先配置緩衝區 + recv_into ----
+# frame直接在緩衝區內解析，回傳指向緩衝區的memoryview，不需要每段都配置新的bytes
+# 每條連線只保留READ_BUFFER_SIZE的小緩衝區，閒置連線佔用的記憶體很少；
+# 收到較大的frame(例如圖片片段)時才從共用的pool借一塊LARGE_BUFFER_SIZE的緩衝區，資料讀完就還回去
+# 超過大緩衝區(或指定keep=True)的內容另外配置剛好大小的bytearray，剩下的資料直接recv_into進去
+# 共用緩衝區的memoryview只在下一次讀取前有效，需要保留時請先複製或使用keep=True
+# 對方宣告的長度超過上限時在配置之前丟出ProtocolError: frame為MAX_FRAME_SIZE，舊格式訊息由呼叫端指定
+
+READ_BUFFER_SIZE = 16 * 1024 # 每條連線的緩衝區，可容納一般的文字/控制訊息
+LARGE_BUFFER_SIZE = MAX_FRAME_SIZE # 可容納一個完整的圖片片段frame
+LARGE_POOL_SIZE = 32 # pool最多保留幾塊閒置的大緩衝區
+_large_pool = []
+
+
+# length: 舊格式的4 byte長度或frame標頭的長度欄位
+def checked_length(length, limit=MAX_FRAME_SIZE):
+    if not isinstance(length, int):
+        length = int.from_bytes(length, 'big')
+    if length > limit:
+        raise ProtocolError(f"訊息過大({length} bytes)")
+    return length
+
+
+def _take_large():
+    try:
+        return _large_pool.pop()
+    except IndexError: # pool是空的(client端兩個接收thread可能同時取用)
+        return bytearray(LARGE_BUFFER_SIZE)
+
+
+def _give_large(buf):
+    if len(_large_pool) < LARGE_POOL_SIZE:
+        _large_pool.append(buf)
+
+
+# ---- 送出端: 同一輪事件迴圈內寫給同一條連線的資料合併成一次vectored write ----
+# 廣播時每則訊息的內容只編碼一次，每個成員的(標頭, 內容)先暫存在FrameProtocol，
+# 這一輪處理完(例如一次讀進來的多則訊息都轉送完)才以一次writev/sendmsg送出，不必複製內容，系統呼叫也少很多
+# 3.12起transport.writelines本身就以sendmsg送出多段資料，之前的版本會先把各段接成新的bytes，
+# 所以舊版本在送出緩衝區是空的時由FrameProtocol直接writev
+VECTORED_WRITE = hasattr(os, "writev") and sys.version_info < (3, 12)
+CORK_LIMIT = 64 * 1024 # 暫存超過這麼多就立刻送出，圖片片段的背壓(drain)照常運作
+IOV_MAX = 1024 # 一次writev最多的片段數(Linux/macOS的下限)
+
+
+class _ReadBuffer:
+    def __init__(self, size=READ_BUFFER_SIZE):
+        self._small = bytearray(size)
+        self._buf = self._small # 目前使用的緩衝區: _small或從pool借來的大緩衝區
+        self._view = memoryview(self._buf)
+        self._start = 0 # 尚未讀取資料的起點
+        self._end = 0 # 已收到資料的終點
+
+    def _available(self):
+        return self._end - self._start
+
+    def _take(self, n):
+        view = self._view[self._start:self._start + n]
+        self._start += n
+        return view
+
+    # 換成另一塊緩衝區，未讀的資料搬到新緩衝區的開頭
+    def _switch(self, buf):
+        have = self._available()
+        buf[:have] = self._view[self._start:self._end]
+        if self._buf is not self._small:
+            _give_large(self._buf)
+        self._buf, self._view = buf, memoryview(buf)
+        self._start, self._end = 0, have
+
+    # 確保從_start開始有n bytes的連續空間，必要時把未讀資料搬回緩衝區開頭
+    # 小緩衝區放不下時改用大緩衝區，大緩衝區的資料都讀完就換回小緩衝區
+    def _make_room(self, n):
+        if n > len(self._buf):
+            self._switch(_take_large())
+        elif self._start == self._end:
+            if self._buf is not self._small:
+                self._switch(self._small)
+            self._start = self._end = 0
+        elif len(self._buf) - self._start < n:
+            have = self._available()
+            self._buf[:have] = self._buf[self._start:self._end]
+            self._start, self._end = 0, have
+
+    # 配置獨立的bytearray並搬入緩衝區內已有的部分，回傳(bytearray, 已填入的長度)
+    def _detach(self, n):
+        body = bytearray(n)
+        have = min(self._available(), n)
+        body[:have] = self._view[self._start:self._start + have]
+        self._start += have
+        return body, have
+
+
+# blocking socket用(client端)
+class FrameReader(_ReadBuffer):
+    def __init__(self, sock, size=READ_BUFFER_SIZE):
+        super().__init__(size)
+        self.sock = sock
+
+    def _recv_into(self, view):
+        n = self.sock.recv_into(view)
+        if not n:
+            raise ConnectionError("connection closed")
+        return n
+
+    # 讀取剛好n bytes，recv可能只回傳部分資料，會持續讀到滿為止
+    def read_exact(self, n, keep=False):
+        if keep or n > LARGE_BUFFER_SIZE:
+            body, got = self._detach(n)
+            view = memoryview(body)
+            while got < n:
+                got += self._recv_into(view[got:])
+            return view
+        if self._available() < n:
+            self._make_room(n)
+            while self._available() < n:
+                self._end += self._recv_into(self._view[self._end:])
+        return self._take(n)
+
+    # 舊格式: 4 byte長度 + 內容
+    def read_message(self, keep=False, limit=MAX_FRAME_SIZE):
+        return self.read_exact(checked_length(self.read_exact(4), limit), keep)
+
+    # 回傳(FrameHeader, payload)
+    def read_frame(self):
+        header = FrameHeader._make(HEADER.unpack_from(self.read_exact(HEADER.size)))
+        return header, self.read_exact(checked_length(header.length))
+
+
+# asyncio用(server端): 事件迴圈直接把資料recv_into到緩衝區(BufferedProtocol)
+# 同一個物件也提供write/drain/close等寫入介面，取代StreamReader/StreamWriter
+# bytes_in/bytes_out: 有inc(n)的物件(例如chat_metrics的Counter)，累計收送的bytes數
+class FrameProtocol(asyncio.BufferedProtocol, _ReadBuffer):
+    def __init__(self, handler, size=READ_BUFFER_SIZE, bytes_in=None, bytes_out=None):
+        _ReadBuffer.__init__(self, size)
+        self.handler = handler # connection_made後以handler(self, self)啟動處理coroutine
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.transport = None
+        self._fileno = None
+        self._loop = None
+        self._corked = [] # 這一輪事件迴圈內寫入、尚未交給transport的片段
+        self._corked_size = 0
+        self.last_recv = time.monotonic() # 最後一次收到資料的時間，判斷對方是否還活著
+        self._target = None # 正在直接接收的大型內容
+        self._target_pos = 0
+        self._waiter = None
+        self._eof = False
+        self._reading_paused = False
+        self._write_paused = False
+        self._drain_waiter = None
+        self.on_write_paused = None # (paused): 送出緩衝區超過高水位/降回低水位
+
+    # ---- 事件迴圈callback ----
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._loop = asyncio.get_running_loop()
+        if VECTORED_WRITE:
+            sock = transport.get_extra_info('socket')
+            self._fileno = sock.fileno() if sock is not None else None
+        asyncio.get_running_loop().create_task(self.handler(self, self))
+
+    def get_buffer(self, sizehint):
+        if self._target is not None:
+            return self._target[self._target_pos:]
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        if self.bytes_in:
+            self.bytes_in.inc(nbytes)
+        self.last_recv = time.monotonic()
+        if self._target is not None:
+            self._target_pos += nbytes
+        else:
+            self._end += nbytes
+            # 緩衝區滿了先暫停接收，等處理端讀走資料再繼續
+            if self._end == len(self._buf):
+                self.transport.pause_reading()
+                self._reading_paused = True
+        self._wake()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake()
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._corked = []
+        self._corked_size = 0
+        self._wake()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(ConnectionResetError("connection lost"))
+
+    def pause_writing(self):
+        self._write_paused = True
+        if self.on_write_paused:
+            self.on_write_paused(True)
+
+    def resume_writing(self):
+        self._write_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+        if self.on_write_paused:
+            self.on_write_paused(False)
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait_data(self):
+        if self._eof:
+            raise asyncio.IncompleteReadError(b'', None)
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    # ---- 讀取 ----
+
+    async def read_exact(self, n, keep=False):
+        if keep or n > LARGE_BUFFER_SIZE:
+            body, got = self._detach(n)
+            view = memoryview(body)
+            if got < n:
+                self._target, self._target_pos = view, got
+                try:
+                    while self._target_pos < n:
+                        await self._wait_data()
+                finally:
+                    self._target = None
+            return view
+        if self._available() < n:
+            self._make_room(n)
+            while self._available() < n:
+                await self._wait_data()
+        return self._take(n)
+
+    async def read_message(self, keep=False, limit=MAX_FRAME_SIZE):
+        return await self.read_exact(checked_length(await self.read_exact(4), limit), keep)
+
+    # 回傳(FrameHeader, payload)
+    async def read_frame(self):
+        header = FrameHeader._make(HEADER.unpack_from(await self.read_exact(HEADER.size)))
+        return header, await self.read_exact(checked_length(header.length))
+
+    # ---- 寫入 ----
+
+    def write(self, data):
+        self.writelines((data,))
+
+    # 片段只保留參照，呼叫端之後不可再修改(bytes或共用的唯讀內容)
+    def writelines(self, parts):
+        size = sum(len(p) for p in parts)
+        if self.bytes_out:
+            self.bytes_out.inc(size)
+        if not self._corked:
+            self._loop.call_soon(self._uncork)
+        self._corked.extend(parts)
+        self._corked_size += size
+        if self._corked_size >= CORK_LIMIT:
+            self._uncork()
+
+    # 把暫存的片段送出；已經在call_soon排定的那一次發現沒有資料時直接結束
+    def _uncork(self):
+        parts, self._corked, self._corked_size = self._corked, [], 0
+        if not parts or self.transport.is_closing():
+            return
+        if self._fileno is not None and not self.transport.get_write_buffer_size():
+            parts = self._writev(parts)
+        if parts:
+            self.transport.writelines(parts)
+
+    # 與transport.write相同，緩衝區是空的時先直接嘗試送出，回傳沒送完的部分(交給transport排隊)
+    # 送出失敗時原封不動交給transport，由它處理錯誤與中斷連線
+    def _writev(self, parts):
+        try:
+            sent = os.writev(self._fileno, parts[:IOV_MAX])
+        except OSError:
+            return parts
+        for i, part in enumerate(parts):
+            if sent < len(part):
+                return [memoryview(part)[sent:], *parts[i + 1:]]
+            sent -= len(part)
+        return ()
+
+    # 尚未送出的資料量
+    def write_buffer_size(self):
+        return self.transport.get_write_buffer_size() + self._corked_size
+
+    def set_write_buffer_limits(self, high, low):
+        self.transport.set_write_buffer_limits(high, low)
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def close(self):
+        self._uncork()
+        self.transport.close()
+
+    # 不等待送出緩衝區清空，直接中斷連線
+    def abort(self):
+        self._corked, self._corked_size = [], 0
+        self.transport.abort()
+
+    # 送出緩衝區超過上限時等待對方消化
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError("connection closed")
+        if self._write_paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+
+# 排隊名單：以連線id為索引的有序表
+# 加入、依id移除、取出第一位都是O(1)，不需要像queue.Queue那樣線性掃描
+class AdmissionQueue:
+    def __init__(self):
+        self._entries = OrderedDict() # conn_id -> item
+        self._positions = {} # conn_id -> 上一次通知對方的排隊位置
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    # 加入隊伍尾端，回傳排隊位置(從1開始)
+    def push(self, key, item):
+        self._entries[key] = item
+        position = len(self._entries)
+        self._positions[key] = position
+        return position
+
+    # 依id移除，不在隊伍中時回傳None
+    def remove(self, key):
+        self._positions.pop(key, None)
+        return self._entries.pop(key, None)
+
+    # 取出排在最前面的一位
+    def pop(self):
+        key, item = self._entries.popitem(last=False)
+        self._positions.pop(key, None)
+        return item
+
+    # 回傳排隊位置有變動的(item, 新位置)，並記錄為已通知
+    # 有人離開或被叫號後呼叫一次，就能一次把新位置推給所有受影響的人
+    def changed_positions(self):
+        changed = []
+        for position, (key, item) in enumerate(self._entries.items(), start=1):
+            if self._positions.get(key) != position:
+                self._positions[key] = position
+                changed.append((item, position))
+        return changed
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import threading
+
+CONTENT_DIR = "image_cache" # 以內容hash為檔名的原圖快取
+DIGEST_SIZE = 32 # BLAKE2b的輸出長度(bytes)，傳輸時使用原始bytes，檔名使用hex
+
+
+# 計算內容的hash(BLAKE2b)，檔案路徑會分段讀取
+def content_digest(source):
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+    else:
+        h.update(source)
+    return h.hexdigest()
+
+
+# 以內容hash索引的本機儲存，server與client共用
+# - 收到的圖片寫入cache_dir/<digest>
+# - 本機選取送出的圖片不複製，直接記錄原本的路徑
+# - 同一份內容的衍生檔(例如server產生的縮圖)寫入cache_dir/<digest>.<kind>
+# 傳送圖片前先送出hash，對方已經有同一份內容時就不必再傳一次
+# 所有方法都可以在任何thread呼叫
+class ContentStore:
+    def __init__(self, cache_dir=CONTENT_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._paths = {} # digest -> 本機檔案位置
+        self._lock = threading.Lock()
+
+    # 保存內容並回傳digest；已知digest時可傳入省去重算
+    def put(self, source, digest=None):
+        if digest is None:
+            digest = content_digest(source)
+        if isinstance(source, str):
+            path = source
+        else:
+            path = os.path.join(self.cache_dir, digest)
+            if not os.path.exists(path):
+                self._write(path, source)
+        with self._lock:
+            self._paths[digest] = path
+        return digest
+
+    # 內容的檔案路徑，找不到時回傳None
+    def path(self, digest):
+        with self._lock:
+            path = self._paths.get(digest)
+        if path is None:
+            path = os.path.join(self.cache_dir, digest)
+        return path if os.path.exists(path) else None
+
+    def has(self, digest):
+        return self.path(digest) is not None
+
+    # 保存digest的衍生檔並回傳路徑
+    def put_variant(self, digest, kind, data):
+        path = os.path.join(self.cache_dir, f"{digest}.{kind}")
+        self._write(path, data)
+        return path
+
+    # 衍生檔的路徑，還沒產生過時回傳None
+    def variant(self, digest, kind):
+        path = os.path.join(self.cache_dir, f"{digest}.{kind}")
+        return path if os.path.exists(path) else None
+
+    # 先寫到暫存檔再改名，其他thread不會讀到寫一半的內容
+    @staticmethod
+    def _write(path, data):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -0,0 +1,147 @@
+import os
+from chat_protocol import (OFFSET, FLAG_END, SENDER_NONE, ProtocolError, encode_image_begin, encode_image_offer,
+                           image_chunk_header)
+from chat_store import content_digest
+
+CHUNK_SIZE = 64 * 1024 # 每個圖片片段的大小，片段之間可以穿插文字訊息
+OFFER_TIMEOUT = 5 # 送出OFFER後等待回覆的秒數，對方沒有回覆(例如舊版程式)時直接傳送
+MAX_IMAGE_SIZE = 32 * 1024 * 1024 # 單張圖片的大小上限，接收端依BEGIN的總大小預先配置緩衝區
+MAX_TRANSFERS = 4 # server端每條連線同時上傳中的圖片數上限
+MAX_TRANSFER_BYTES = 64 * 1024 * 1024 # server端每條連線所有上傳中圖片的緩衝區總大小上限
+
+
+# 進度百分比有變動時才回傳新的百分比，避免每個片段都更新畫面
+def progress_percent(transfer):
+    done, total = transfer.progress()
+    percent = 100 if total == 0 else done * 100 // total
+    if percent == transfer.last_percent:
+        return None
+    transfer.last_percent = percent
+    return percent
+
+
+# 傳送中的圖片，來源可以是檔案路徑(邊讀邊送)或bytes；sender為frame標頭上的傳送者id(server轉送時使用)
+class OutgoingTransfer:
+    def __init__(self, transfer_id, source, name="", sender=SENDER_NONE):
+        self.transfer_id = transfer_id
+        self.sender = sender
+        self.offset = 0
+        self.last_percent = -1
+        self._finished = False
+        self._source = source
+        if isinstance(source, str):
+            self._file = open(source, "rb")
+            self._data = None
+            self.total = os.fstat(self._file.fileno()).st_size
+            self.name = name or os.path.basename(source)
+        else:
+            self._file = None
+            self._data = memoryview(source)
+            self.total = len(self._data)
+            self.name = name
+
+    def begin_frame(self):
+        return encode_image_begin(self.transfer_id, self.total, self.name, self.sender)
+
+    # 內容hash，檔案來源會整個讀過一次，請在傳送thread/executor內呼叫
+    def digest(self):
+        return content_digest(self._source)
+
+    def offer_frame(self, digest):
+        return encode_image_offer(self.transfer_id, digest, self.total, self.name, self.sender)
+
+    # 對方已經有這張圖片，不需要再傳送
+    def skip(self):
+        self.offset = self.total
+        self._finished = True
+
+    # 從指定位置重新開始送(接收端送來RESUME時)
+    def seek(self, offset):
+        self.offset = max(0, min(offset, self.total))
+        self._finished = False
+
+    # 讀出下一段並回傳[標頭, 資料]；全部送完回傳None
+    def next_frame(self):
+        if self._finished:
+            return None
+        if self._file is not None:
+            self._file.seek(self.offset)
+            chunk = self._file.read(CHUNK_SIZE)
+        else:
+            chunk = self._data[self.offset:self.offset + CHUNK_SIZE]
+        offset = self.offset
+        self.offset += len(chunk)
+        # 檔案讀不到資料(例如傳送中被截短)也視為結尾，避免無窮迴圈
+        self._finished = self.offset >= self.total or not chunk
+        return [image_chunk_header(self.transfer_id, offset, len(chunk), self._finished, self.sender), chunk]
+
+    def progress(self):
+        return min(self.offset, self.total), self.total
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# 接收中的圖片，依BEGIN的總大小預先配置緩衝區，片段直接寫到對應offset
+class IncomingTransfer:
+    def __init__(self, transfer_id, total, name=""):
+        self.transfer_id = transfer_id
+        self.total = total
+        self.name = name
+        self.buf = bytearray(total)
+        self.received = 0
+        self.last_percent = -1
+        self.complete = False
+
+    # 寫入一段資料，offset和預期不同時回傳False(呼叫端應要求對方從received重送)
+    def write(self, offset, data, last):
+        if offset != self.received:
+            return False
+        end = offset + len(data)
+        if end > self.total:
+            return False
+        self.buf[offset:end] = data
+        self.received = end
+        self.complete = bool(last) and end == self.total
+        return True
+
+    def progress(self):
+        return self.received, self.total
+
+
+# 管理一條連線上所有接收中的圖片
+# max_transfers/max_bytes: 同時接收中的圖片數與緩衝區總大小的上限(None為不限制)
+# 超過上限或圖片超過MAX_IMAGE_SIZE時丟出ProtocolError，不配置緩衝區
+class TransferReceiver:
+    def __init__(self, max_transfers=None, max_bytes=None):
+        self.max_transfers = max_transfers
+        self.max_bytes = max_bytes
+        self.transfers = {} # transfer id -> IncomingTransfer
+
+    def begin(self, stream, payload):
+        total = OFFSET.unpack_from(payload)[0]
+        if total > MAX_IMAGE_SIZE:
+            raise ProtocolError(f"圖片過大({total} bytes)")
+        others = [t for s, t in self.transfers.items() if s != stream] # 同一個id重新BEGIN時取代舊的
+        if self.max_transfers is not None and len(others) >= self.max_transfers:
+            raise ProtocolError("同時傳送的圖片過多")
+        if self.max_bytes is not None and sum(t.total for t in others) + total > self.max_bytes:
+            raise ProtocolError("同時傳送的圖片總大小過大")
+        name = bytes(payload[OFFSET.size:]).decode(errors="replace")
+        transfer = IncomingTransfer(stream, total, name)
+        self.transfers[stream] = transfer
+        return transfer
+
+    # 處理一個圖片片段，回傳(transfer, ok)；ok為False代表offset不連續需要重送
+    # 沒有對應的BEGIN時transfer為None
+    def chunk(self, stream, flags, payload):
+        transfer = self.transfers.get(stream)
+        if transfer is None:
+            return None, True
+        offset = OFFSET.unpack_from(payload)[0]
+        ok = transfer.write(offset, memoryview(payload)[OFFSET.size:], flags & FLAG_END)
+        if transfer.complete:
+            del self.transfers[stream]
+        return transfer, ok
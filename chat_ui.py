@@ -0,0 +1,81 @@
+import threading
+import time
+import traceback
+
+TICK_INTERVAL = 30 # ms，畫面更新的週期
+TICK_BUDGET = 0.015 # 每次更新最多花在處理訊息上的秒數，超過的留到下一次，避免畫面卡住
+RESERVE_TIMEOUT = 5 # 預留的位置超過這麼多秒還沒填入(例如圖片處理卡住)就跳過，不擋住後面的訊息
+TEXT_IMAGE_GAP = 0.3 # 文字後這麼多秒內收到的圖片視為同一則訊息，不再重複顯示傳送者標頭
+
+
+# 背景thread交給Tk主執行緒的工作佇列
+# 取代每則訊息各呼叫一次window.after: 任何thread都可以post()，由單一的週期性tick一次處理所有累積的工作
+# 工作依post/reserve的順序執行；圖片這類需要先在背景處理的訊息可先reserve()佔住順序，
+# 處理完再fulfil()，後面的文字訊息會等它，文字和圖片不會因為處理時間不同而順序錯亂
+class UiQueue:
+    def __init__(self, window, interval=TICK_INTERVAL, budget=TICK_BUDGET):
+        self.window = window
+        self.interval = interval
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._items = {} # 順序 -> (fn, args)；已預留但尚未填入時為預留的時間
+        self._next = 0
+        self._head = 0
+        self._after_id = None
+        self.rendered = 0 # 已處理的工作數(效能測試用)
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self.window.after(self.interval, self._tick)
+
+    def stop(self):
+        if self._after_id is not None:
+            self.window.after_cancel(self._after_id)
+            self._after_id = None
+
+    # 可從任何thread呼叫
+    def post(self, fn, *args):
+        with self._lock:
+            self._items[self._next] = (fn, args)
+            self._next += 1
+
+    # 預留一個位置，回傳之後fulfil()要用的編號
+    def reserve(self):
+        with self._lock:
+            seq = self._next
+            self._items[seq] = time.monotonic()
+            self._next += 1
+        return seq
+
+    def fulfil(self, seq, fn, *args):
+        with self._lock:
+            if seq >= self._head: # 已經因逾時被跳過的就不處理
+                self._items[seq] = (fn, args)
+
+    # 取出下一個可以執行的工作，遇到尚未填入的預留位置就停下(回傳None)
+    def _pop(self, now):
+        with self._lock:
+            while self._head < self._next:
+                item = self._items[self._head]
+                if not isinstance(item, tuple) and now - item < RESERVE_TIMEOUT:
+                    return None
+                del self._items[self._head]
+                self._head += 1
+                if isinstance(item, tuple):
+                    return item
+        return None
+
+    # 處理累積的工作直到佇列清空或用完這次的時間，剩下的留到下一次
+    def _tick(self):
+        start = time.monotonic()
+        while time.monotonic() - start < self.budget:
+            item = self._pop(start)
+            if item is None:
+                break
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+            self.rendered += 1
+        self._after_id = self.window.after(self.interval, self._tick)
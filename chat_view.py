@@ -0,0 +1,195 @@
+import tkinter as tk
+from chat_images import EVICTED_TEXT
+
+# 訊息框的文字顏色
+TAG_COLORS = {"error": "red", "info": "blue", "system": "gray"}
+
+
+# 只顯示部分訊息的訊息框，取代一直往ScrolledText塞文字與圖片Label的作法
+# - 所有訊息以(種類, 內容, tag)存在記憶體內的清單，圖片只存digest(縮圖/原圖由ImageStore管理)
+# - Text內最多只保留window_size則訊息，新訊息進來時從最上面移除一則，插入成本不會隨聊天時間變長
+# - 捲到最上/最下時再從清單中一次載入page_size則較舊/較新的訊息，同時移除另一端超出的部分
+# - 使用者往上捲動時新訊息只加進清單，捲回最下面時才顯示
+# 每則訊息在Text內的起點以mark記錄(右gravity，在前面插入時會跟著後移)，刪除時不需要計算字數
+class MessageView(tk.Frame):
+    def __init__(self, master, image_store, on_image_click, window_size=300, page_size=100,
+                 max_entries=100000, **text_options):
+        super().__init__(master)
+        self.image_store = image_store
+        self.on_image_click = on_image_click # (digest): 點擊圖片
+        self.window_size = window_size
+        self.page_size = page_size
+        self.max_entries = max_entries
+
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        self.text = tk.Text(self, wrap=tk.CHAR, **text_options)
+        self.text.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar = tk.Scrollbar(self, command=self.text.yview)
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+        self.text.config(yscrollcommand=self._on_scroll)
+        for tag, color in TAG_COLORS.items():
+            self.text.tag_configure(tag, foreground=color)
+
+        self._entries = [] # (kind, value, tag)，kind為"text"或"image"(value為digest)
+        self._base = 0 # _entries[0]的編號，太舊的訊息被丟掉後往後移
+        self._first = 0 # Text內第一則訊息的編號
+        self._last = 0 # Text內最後一則訊息的下一個編號
+        self._widgets = {} # 編號 -> 顯示中的圖片Label
+        self._paging = False
+        self._following = True # 畫面停在最下面，新訊息進來時直接顯示並自動捲動
+        self._scroll_pending = False
+
+    # ---- 對外介面(Tk主執行緒) ----
+
+    def insert_text(self, text, tag=None):
+        if text: # 空字串沒有長度，mark會和下一則重疊
+            self._append(("text", text, tag))
+
+    def insert_image(self, digest):
+        self._append(("image", digest, None))
+
+    def clear(self):
+        while self._first < self._last:
+            self._remove_last()
+        self._entries = []
+        self._base = self._first = self._last = 0
+        self._following = True
+
+    def see_end(self):
+        if self._last < self._total():
+            self._jump_to_end()
+        self._following = True
+        self.text.see(tk.END)
+
+    # ---- 內部 ----
+
+    def _total(self):
+        return self._base + len(self._entries)
+
+    def _entry(self, index):
+        return self._entries[index - self._base]
+
+    def _mark(self, index):
+        return f"msg{index}"
+
+    def _append(self, entry):
+        following = self._last == self._total() and self._following
+        self._entries.append(entry)
+        if following:
+            self._render_end(self._last)
+            self._last += 1
+            while self._last - self._first > self.window_size:
+                self._remove_first()
+            # 同一批新增的訊息只捲動一次
+            if not self._scroll_pending:
+                self._scroll_pending = True
+                self.after_idle(self._scroll_to_end)
+        self._trim_model()
+
+    def _scroll_to_end(self):
+        self._scroll_pending = False
+        self.text.see(tk.END)
+
+    # 清單超過上限時丟掉最舊的一批(還在畫面上的不丟)，完整的紀錄在聊天紀錄檔與歷史資料庫
+    def _trim_model(self):
+        if len(self._entries) <= self.max_entries:
+            return
+        drop = min(self.max_entries // 10, self._first - self._base)
+        if drop > 0:
+            del self._entries[:drop]
+            self._base += drop
+
+    def _render_end(self, index):
+        start = self.text.index("end-1c")
+        self._render(index, "end-1c")
+        self.text.mark_set(self._mark(index), start)
+
+    def _render_start(self, index):
+        self._render(index, "1.0")
+        self.text.mark_set(self._mark(index), "1.0")
+
+    def _render(self, index, position):
+        kind, value, tag = self._entry(index)
+        if kind == "text":
+            if tag:
+                self.text.insert(position, value, tag)
+            else:
+                self.text.insert(position, value)
+            return
+        photo = self.image_store.get_thumbnail(value)
+        label = tk.Label(self.text, cursor="hand2")
+        if photo is not None:
+            label.config(image=photo)
+            label.image = photo
+        else: # 縮圖已被換出記憶體，點擊開啟時會重新產生
+            label.config(text=EVICTED_TEXT)
+        label.bind("<Button-1>", lambda e, digest=value: self.on_image_click(digest))
+        self.text.window_create(position, window=label)
+        self.image_store.attach_widget(value, label)
+        self._widgets[index] = label
+
+    def _remove_first(self):
+        index = self._first
+        end = self._mark(index + 1) if index + 1 < self._last else "end-1c"
+        self.text.delete(self._mark(index), end)
+        self._forget(index)
+        self._first += 1
+
+    def _remove_last(self):
+        index = self._last - 1
+        self.text.delete(self._mark(index), "end-1c")
+        self._forget(index)
+        self._last -= 1
+
+    def _forget(self, index):
+        self.text.mark_unset(self._mark(index))
+        label = self._widgets.pop(index, None)
+        if label is not None:
+            self.image_store.detach_widget(self._entry(index)[1], label)
+            label.destroy()
+
+    # Text的yscrollcommand: 更新捲軸，並在捲到最上/最下時載入更多訊息
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        first, last = float(first), float(last)
+        if not self._scroll_pending: # 等待捲到最下面的期間畫面位置還沒更新
+            self._following = last >= 1.0 and self._last == self._total()
+        if self._paging:
+            return
+        if first <= 0.0 and self._first > self._base and last < 1.0:
+            self._paging = True
+            self.after_idle(self._page, -1)
+        elif last >= 1.0 and self._last < self._total():
+            self._paging = True
+            self.after_idle(self._page, 1)
+
+    # direction為-1時往前載入較舊的訊息，1時往後載入較新的訊息；畫面停在原本看到的位置
+    def _page(self, direction):
+        try:
+            self.text.mark_set("view_top", "@0,0")
+            if direction < 0:
+                for _ in range(min(self.page_size, self._first - self._base)):
+                    self._first -= 1
+                    self._render_start(self._first)
+                while self._last - self._first > self.window_size:
+                    self._remove_last()
+            else:
+                for _ in range(min(self.page_size, self._total() - self._last)):
+                    self._render_end(self._last)
+                    self._last += 1
+                while self._last - self._first > self.window_size:
+                    self._remove_first()
+            self.text.yview("view_top")
+            self.text.mark_unset("view_top")
+        finally:
+            self._paging = False
+
+    # 直接跳到最新的訊息(例如使用者自己送出訊息時)
+    def _jump_to_end(self):
+        while self._first < self._last:
+            self._remove_last()
+        self._first = self._last = max(self._base, self._total() - self.window_size)
+        while self._last < self._total():
+            self._render_end(self._last)
+            self._last += 1
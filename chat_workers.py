@@ -0,0 +1,83 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import tempfile
+from chat_cluster import Relay, RelayBus
+from chat_core import RESUME_GRACE, ChatCore, raise_fd_limit
+from chat_heartbeat import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, IDLE_TIMEOUT
+from chat_log import FSYNC_ROTATE
+from chat_outbox import SEND_BUDGET, POLICY_DISCONNECT
+from chat_store import CONTENT_DIR
+
+# 多行程模式: N個worker行程以SO_REUSEPORT監聽同一個TEXT_PORT，由kernel把新連線分給各worker
+# 每個worker是完整的ChatCore(自己的事件迴圈、GIL、紀錄檔)，彼此以叢集模式(chat_cluster.py)連在一起:
+# 主行程執行Relay(Unix socket)負責分配座位與全域的排隊，同一間房但在不同worker上的成員經由它轉送訊息
+# 僅支援有SO_REUSEPORT的系統(Linux/macOS)；舊版協定的image port無法跨worker配對，多行程模式下不開啟
+
+
+def _worker(index, address, host, text_port, kwargs, quiet):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # 由主行程統一處理Ctrl-C
+    raise_fd_limit()
+    core = ChatCore(host, text_port, None, bus=RelayBus(address), reuse_port=True, **kwargs)
+    if not quiet:
+        prefix = f"[worker {index}] "
+        core.on_log = lambda line, tag: print(prefix + line, end="", flush=True)
+        core.on_text = lambda peer, message: print(prefix + message, end="", flush=True)
+    signal.signal(signal.SIGTERM, lambda *_: core.stop())
+    core.serve_forever()
+
+
+# 啟動workers個worker與Relay，直到Ctrl-C或SIGTERM
+# 房間數與每間人數由Relay決定，所有worker共用
+# relay: 外部relay的(host, port)，指定時所有worker直接加入該叢集(房間設定由該relay決定)，不另外啟動Relay
+# 每個worker的紀錄檔寫在log_dir/worker<i>；指標port與檔案依序加上worker編號
+# resume_grace: 同ChatCore；重新連線不一定會被分到原本的worker，接不回時以新的連線加入
+# quiet: 不輸出訊息(壓測使用)
+def run_workers(workers, host='0.0.0.0', text_port=10000, max_rooms=1, room_size=1, log_dir="chat_logs",
+                cache_dir=CONTENT_DIR, log_fsync=FSYNC_ROTATE, replay=0, send_budget=SEND_BUDGET,
+                slow_policy=POLICY_DISCONNECT, metrics_port=None, metrics_file=None, resume_grace=RESUME_GRACE,
+                heartbeat=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                previews=True, relay=None, quiet=False):
+    path = None if relay else os.path.join(tempfile.mkdtemp(prefix="chat_relay_"), "relay.sock")
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+        server = await Relay(max_rooms, room_size).start(path) if path else None
+        procs = []
+        for i in range(workers):
+            kwargs = dict(cache_dir=cache_dir, log_fsync=log_fsync, replay=replay, send_budget=send_budget,
+                          slow_policy=slow_policy, resume_grace=resume_grace, heartbeat=heartbeat,
+                          heartbeat_timeout=heartbeat_timeout, idle_timeout=idle_timeout, previews=previews,
+                          log_dir=os.path.join(log_dir, f"worker{i}") if log_dir else None,
+                          metrics_port=metrics_port + i if metrics_port is not None else None,
+                          metrics_file=f"{metrics_file}.{i}" if metrics_file else None)
+            proc = multiprocessing.Process(target=_worker, args=(i, path or relay, host, text_port, kwargs, quiet))
+            proc.start()
+            procs.append(proc)
+        try:
+            await stopped.wait()
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                await loop.run_in_executor(None, proc.join)
+            if server:
+                server.close()
+
+    if not quiet:
+        print(f"以 {workers} 個worker監聽 {host}:{text_port}，按Ctrl-C結束")
+    try:
+        asyncio.run(main())
+    finally:
+        if path:
+            try:
+                os.unlink(path)
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+    if not quiet:
+        print("\n伺服器已關閉。")
@@ -0,0 +1,41 @@
+from chat_heartbeat import TimerWheel
+
+
+def advance(wheel, ticks):
+    expired = []
+    for _ in range(ticks):
+        expired += wheel.advance()
+    return expired
+
+
+def test_expires_after_delay():
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.schedule("a", 3)
+    assert advance(wheel, 2) == []
+    assert wheel.advance() == ["a"]
+    assert "a" not in wheel and len(wheel) == 0
+
+
+# 超過一圈的延遲要轉過足夠的圈數才到期
+def test_delay_longer_than_one_round():
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.schedule("a", 20)
+    assert advance(wheel, 19) == []
+    assert wheel.advance() == ["a"]
+
+
+def test_reschedule_and_cancel():
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.schedule("a", 2)
+    wheel.schedule("b", 2)
+    wheel.schedule("a", 5) # 重新排程取代原本的時間
+    wheel.cancel("b")
+    assert advance(wheel, 4) == []
+    assert wheel.advance() == ["a"]
+    assert len(wheel) == 0
+
+
+def test_minimum_one_tick():
+    wheel = TimerWheel(tick=1, slots=8)
+    wheel.schedule("a", 0)
+    assert wheel.advance() == ["a"]
@@ -0,0 +1,76 @@
+import socket
+import threading
+
+import pytest
+
+from chat_protocol import (HEADER, FRAME_TEXT, FRAME_CONTROL, CTRL_WELCOME, MAX_FRAME_SIZE, MAX_TEXT_LENGTH,
+                           FrameHeader, FrameReader, ProtocolError, pack_header, encode_frame, encode_control,
+                           decode_control)
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    b.settimeout(5)
+    yield a, FrameReader(b)
+    a.close()
+    b.close()
+
+
+def test_header_round_trip():
+    header = pack_header(FRAME_TEXT, 5, stream=7, flags=1, seq=0xFFFFFFFF, sender=300, timestamp=1234567890123)
+    assert len(header) == HEADER.size
+    assert FrameHeader._make(HEADER.unpack(header)) == FrameHeader(FRAME_TEXT, 1, 7, 0xFFFFFFFF, 300,
+                                                                   1234567890123, 5)
+
+
+def test_read_frame_round_trip(pair):
+    sock, reader = pair
+    sock.sendall(encode_frame(FRAME_TEXT, "你好".encode(), seq=3, sender=42, timestamp=99)
+                 + encode_control(CTRL_WELCOME, "歡迎\n", seq=4))
+    header, payload = reader.read_frame()
+    assert (header.frame_type, header.seq, header.sender, header.timestamp) == (FRAME_TEXT, 3, 42, 99)
+    assert bytes(payload).decode() == "你好"
+    header, payload = reader.read_frame()
+    assert (header.frame_type, header.seq) == (FRAME_CONTROL, 4)
+    assert decode_control(payload) == (CTRL_WELCOME, "歡迎\n")
+
+
+# 長度欄位超過上限時，在讀取(配置)內容之前就丟出ProtocolError
+def test_oversized_frame_rejected(pair):
+    sock, reader = pair
+    sock.sendall(pack_header(FRAME_TEXT, MAX_FRAME_SIZE + 1))
+    with pytest.raises(ProtocolError):
+        reader.read_frame()
+
+
+def test_oversized_legacy_message_rejected(pair):
+    sock, reader = pair
+    sock.sendall((MAX_TEXT_LENGTH + 1).to_bytes(4, 'big'))
+    with pytest.raises(ProtocolError):
+        reader.read_message(limit=MAX_TEXT_LENGTH)
+
+
+def test_frame_at_limit_accepted(pair):
+    sock, reader = pair
+    sender = threading.Thread(target=sock.sendall, args=(encode_frame(FRAME_TEXT, b"x" * MAX_FRAME_SIZE),))
+    sender.start() # 超過socket緩衝區，邊送邊讀
+    header, payload = reader.read_frame()
+    sender.join()
+    assert header.length == len(payload) == MAX_FRAME_SIZE
+
+
+def test_truncated_frame(pair):
+    sock, reader = pair
+    sock.sendall(encode_frame(FRAME_TEXT, b"hello")[:-2])
+    sock.close()
+    with pytest.raises(ConnectionError):
+        reader.read_frame()
+
+
+def test_truncated_header(pair):
+    sock, reader = pair
+    sock.sendall(pack_header(FRAME_TEXT, 5)[:HEADER.size - 1])
+    sock.close()
+    with pytest.raises(ConnectionError):
+        reader.read_frame()
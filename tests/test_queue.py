@@ -0,0 +1,33 @@
+from chat_queue import AdmissionQueue
+
+
+def test_push_returns_positions_in_order():
+    queue = AdmissionQueue()
+    assert [queue.push(key, f"peer{key}") for key in (3, 1, 2)] == [1, 2, 3]
+    assert list(queue) == ["peer3", "peer1", "peer2"]
+    assert queue.pop() == "peer3"
+    assert queue.pop() == "peer1"
+    assert len(queue) == 1
+
+
+def test_remove_by_key():
+    queue = AdmissionQueue()
+    for key in range(1, 5):
+        queue.push(key, key)
+    assert queue.remove(2) == 2
+    assert queue.remove(2) is None
+    assert 2 not in queue and 3 in queue
+    assert list(queue) == [1, 3, 4]
+
+
+# 有人離開後只回報位置有變動的人，已回報過的不再重複
+def test_changed_positions_after_removal():
+    queue = AdmissionQueue()
+    for key in range(1, 5):
+        queue.push(key, key)
+    assert queue.changed_positions() == []
+    queue.remove(2)
+    assert queue.changed_positions() == [(3, 2), (4, 3)]
+    assert queue.changed_positions() == []
+    queue.pop()
+    assert queue.changed_positions() == [(3, 1), (4, 2)]
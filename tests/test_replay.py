@@ -0,0 +1,63 @@
+from chat_core import REPLAY_FRAMES, Peer
+from chat_protocol import HEADER, CTRL_QUEUE, FrameHeader
+
+
+# 只記錄寫入的資料，提供Peer用到的transport介面
+class RecordingWriter:
+    def __init__(self):
+        self.parts = []
+        self.on_write_paused = None
+
+    def set_write_buffer_limits(self, high, low):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def write_buffer_size(self):
+        return 0
+
+    def writelines(self, parts):
+        self.parts.extend(bytes(p) for p in parts)
+
+    def seqs(self):
+        return [FrameHeader._make(HEADER.unpack_from(p)).seq for p in self.parts if len(p) >= HEADER.size]
+
+
+def make_peer(sent):
+    peer = Peer(None, RecordingWriter(), ("127.0.0.1", 1234), conn_id=1)
+    peer.framed = True
+    peer.token = b"t" * 16
+    for i in range(sent):
+        peer.send_control(CTRL_QUEUE, f"{i}\n")
+    peer.writer.parts.clear()
+    return peer
+
+
+def test_replay_after_last_seq():
+    peer = make_peer(10)
+    assert peer.replay_since(7) == (3, False)
+    assert peer.writer.seqs() == [8, 9, 10]
+
+
+def test_replay_nothing_missed():
+    peer = make_peer(5)
+    assert peer.replay_since(5) == (0, False)
+    assert peer.writer.parts == []
+
+
+# 較早的訊息已超出保留範圍: 補送還留著的部分，並回報有缺漏
+def test_replay_with_missing_range():
+    peer = make_peer(REPLAY_FRAMES + 10)
+    count, missing = peer.replay_since(3)
+    assert missing
+    assert count == REPLAY_FRAMES
+    assert peer.writer.seqs()[0] == 11
+    assert peer.writer.seqs()[-1] == REPLAY_FRAMES + 10
+
+
+def test_no_replay_without_token():
+    peer = make_peer(0)
+    peer.token = None
+    peer.send_control(CTRL_QUEUE, "x\n")
+    assert peer.replay_since(0) == (0, False)